@@ -0,0 +1,74 @@
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+
+import argparse
+import json
+import logging
+import os
+import sys
+import torch
+from safetensors.torch import save_file
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append('{}/../..'.format(ROOT_DIR))
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='convert llm.pt, flow.pt and hift.pt to safetensors for memory mapped loading')
+    parser.add_argument('--model_dir',
+                        type=str,
+                        default='pretrained_models/CosyVoice2-0.5B',
+                        help='local path')
+    args = parser.parse_args()
+    print(args)
+    return args
+
+
+def dedupe_tied(state_dict):
+    """ Keep one name per shared tensor, e.g. tied qwen2 embed_tokens and lm_head, returns the
+    state dict to write and {alias: kept name}, load_checkpoint() restores the aliases.
+    """
+    kept, tied, names = {}, {}, {}
+    for k, v in state_dict.items():
+        key = (v.untyped_storage().data_ptr(), v.storage_offset(), tuple(v.shape), tuple(v.stride()), v.dtype)
+        if v.numel() > 0 and key in names:
+            tied[k] = names[key]
+            continue
+        names[key] = k
+        kept[k] = v
+    return kept, tied
+
+
+def main():
+    args = get_args()
+    logging.basicConfig(level=logging.DEBUG,
+                        format='%(asctime)s %(levelname)s %(message)s')
+
+    for name in ['llm', 'flow', 'hift']:
+        state_dict = torch.load('{}/{}.pt'.format(args.model_dir, name), map_location='cpu')
+        if name == 'hift':
+            # in case hift_model is a hifigan model
+            state_dict = {k.replace('generator.', ''): v for k, v in state_dict.items()}
+        # NOTE safetensors do not support shared storage, tied tensors are written once and the rest get their own copy
+        state_dict, tied = dedupe_tied(state_dict)
+        state_dict = {k: v.detach().clone().contiguous() for k, v in state_dict.items()}
+        save_file(state_dict, '{}/{}.safetensors'.format(args.model_dir, name), metadata={'format': 'pt', 'tied': json.dumps(tied)})
+        if len(tied) > 0:
+            logging.info('{} tied tensors {}'.format(name, tied))
+        logging.info('successfully export {}.safetensors'.format(name))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import sys
+import threading
+from typing import Tuple
+import torch
+
+
+def peak_rss_mb():
+    """ Peak resident set size of this process in MB """
+    try:
+        import resource
+    except ImportError:
+        return None
+    # NOTE ru_maxrss is in bytes on macos and in KB on linux
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / 1024 / 1024 if sys.platform == 'darwin' else maxrss / 1024
+
+
+class BufferPool:
+    """ Reusable flat buffers for chunk sized mel, source and speech tensors.
+
+    Buffers are keyed by (bucket of numel, dtype, device), bucket rounds numel up with
+    at most 25% waste, so streaming chunks of slightly different length share buffers.
+    acquire() returns a contiguous view of the requested shape together with its flat
+    buffer, recycle() puts the buffer back. At most max_bytes are kept idle, extra
+    buffers are simply dropped and freed by torch.
+
+    Shared by all sessions of a model, so a finished session hands its memory to the
+    next one instead of flushing the global allocator with torch.cuda.empty_cache().
+    """
+
+    def __init__(self, max_bytes: int = 256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.free = {}
+        self.free_bytes = 0
+        self.num_hit = 0
+        self.num_miss = 0
+        self.num_drop = 0
+
+    @staticmethod
+    def bucket(n: int):
+        if n <= 1024:
+            return 1024
+        step = 1 << (n.bit_length() - 3)
+        return (n + step - 1) // step * step
+
+    @staticmethod
+    def key(numel: int, dtype: torch.dtype, device):
+        # NOTE torch.device('cuda') != torch.device('cuda:0'), resolve the index so acquire and recycle agree
+        device = torch.device(device)
+        if device.type == 'cuda' and device.index is None:
+            device = torch.device('cuda', torch.cuda.current_device())
+        return (numel, dtype, device)
+
+    def acquire(self, shape: Tuple[int, ...], dtype: torch.dtype = torch.float32, device: torch.device = torch.device('cpu')):
+        shape = torch.Size(shape)
+        key = self.key(self.bucket(shape.numel()), dtype, device)
+        buffer = None
+        with self.lock:
+            buffers = self.free.get(key)
+            if buffers:
+                buffer = buffers.pop()
+                self.free_bytes -= buffer.numel() * buffer.element_size()
+                self.num_hit += 1
+            else:
+                self.num_miss += 1
+        if buffer is None:
+            buffer = torch.empty(key[0], dtype=dtype, device=key[2])
+        return buffer[:shape.numel()].view(shape), buffer
+
+    def recycle(self, buffer: torch.Tensor):
+        nbytes = buffer.numel() * buffer.element_size()
+        with self.lock:
+            if self.free_bytes + nbytes > self.max_bytes:
+                self.num_drop += 1
+                return
+            self.free.setdefault(self.key(buffer.numel(), buffer.dtype, buffer.device), []).append(buffer)
+            self.free_bytes += nbytes
+
+    def clear(self):
+        """ Drop all idle buffers, call torch.cuda.empty_cache() afterwards to give memory back to the driver """
+        with self.lock:
+            self.free = {}
+            self.free_bytes = 0
+
+    def stats(self):
+        with self.lock:
+            num_acquire = self.num_hit + self.num_miss
+            stats = {'hit': self.num_hit,
+                     'miss': self.num_miss,
+                     'drop': self.num_drop,
+                     'hit_rate': self.num_hit / num_acquire if num_acquire > 0 else 0.0,
+                     'idle_buffers': sum(len(v) for v in self.free.values()),
+                     'idle_mb': self.free_bytes / 1024 / 1024}
+        stats['peak_rss_mb'] = peak_rss_mb()
+        if torch.cuda.is_available():
+            stats['peak_cuda_mb'] = torch.cuda.max_memory_allocated() / 1024 / 1024
+        return stats
@@ -12,58 +12,96 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import os
+import queue
+from functools import partial
+import threading
 import time
 from typing import Generator
 from tqdm import tqdm
 from hyperpyyaml import load_hyperpyyaml
 from modelscope import snapshot_download
 import torch
-from cosyvoice.cli.frontend import CosyVoiceFrontEnd
+from cosyvoice.cli.frontend import CosyVoiceFrontEnd, FRONTEND_COMPONENTS
 from cosyvoice.cli.model import CosyVoiceModel, CosyVoice2Model
-from cosyvoice.utils.file_utils import logging
+from cosyvoice.cli.engine import StageEngine
+from cosyvoice.utils.file_utils import logging, get_checkpoint
 from cosyvoice.utils.class_utils import get_model_type
 
 
+# llm is needed by all inference modes except inference_vc, the others are frontend components
+COMPONENTS = ['llm'] + FRONTEND_COMPONENTS
+
+
 class CosyVoice:
 
-    def __init__(self, model_dir, load_jit=False, load_trt=False, fp16=False, trt_concurrent=1):
+    def __init__(self, model_dir, load_jit=False, load_trt=False, fp16=False, trt_concurrent=1, components=None, window_len=0):
         self.instruct = True if '-Instruct' in model_dir else False
         self.model_dir = model_dir
         self.fp16 = fp16
+        self.engine = None
+        # components loaded here, None means all, the others are loaded on first use,
+        # e.g. components=['campplus', 'speech_tokenizer'] for a vc only deployment
+        components = COMPONENTS if components is None else components
+        for k in components:
+            if k not in COMPONENTS:
+                raise ValueError('unknown component {}, should be one of {}'.format(k, COMPONENTS))
         if not os.path.exists(model_dir):
             model_dir = snapshot_download(model_dir)
         hyper_yaml_path = '{}/cosyvoice.yaml'.format(model_dir)
         if not os.path.exists(hyper_yaml_path):
             raise ValueError('{} not found!'.format(hyper_yaml_path))
+        self.hyper_yaml_path = hyper_yaml_path
         with open(hyper_yaml_path, 'r') as f:
-            configs = load_hyperpyyaml(f)
+            configs = load_hyperpyyaml(f, overrides=None if 'llm' in components else {'llm': None})
         assert get_model_type(configs) != CosyVoice2Model, 'do not use {} for CosyVoice initialization!'.format(model_dir)
         self.frontend = CosyVoiceFrontEnd(configs['get_tokenizer'],
                                           configs['feat_extractor'],
                                           '{}/campplus.onnx'.format(model_dir),
                                           '{}/speech_tokenizer_v1.onnx'.format(model_dir),
                                           '{}/spk2info.pt'.format(model_dir),
-                                          configs['allowed_special'])
+                                          configs['allowed_special'],
+                                          [k for k in components if k != 'llm'])
         self.sample_rate = configs['sample_rate']
         if torch.cuda.is_available() is False and (load_jit is True or load_trt is True or fp16 is True):
             load_jit, load_trt, fp16 = False, False, False
             logging.warning('no cuda device, set load_jit/load_trt/fp16 to False')
-        self.model = CosyVoiceModel(configs['llm'], configs['flow'], configs['hift'], fp16)
-        self.model.load('{}/llm.pt'.format(model_dir),
-                        '{}/flow.pt'.format(model_dir),
-                        '{}/hift.pt'.format(model_dir))
+        self.model = CosyVoiceModel(None, configs['flow'], configs['hift'], fp16)
+        self.model.load(None, get_checkpoint(model_dir, 'flow'), get_checkpoint(model_dir, 'hift'))
         if load_jit:
-            self.model.load_jit('{}/llm.text_encoder.{}.zip'.format(model_dir, 'fp16' if self.fp16 is True else 'fp32'),
-                                '{}/llm.llm.{}.zip'.format(model_dir, 'fp16' if self.fp16 is True else 'fp32'),
-                                '{}/flow.encoder.{}.zip'.format(model_dir, 'fp16' if self.fp16 is True else 'fp32'))
+            self.model.load_jit(None, None, '{}/flow.encoder.{}.zip'.format(model_dir, 'fp16' if self.fp16 is True else 'fp32'))
         if load_trt:
             self.model.load_trt('{}/flow.decoder.estimator.{}.mygpu.plan'.format(model_dir, 'fp16' if self.fp16 is True else 'fp32'),
                                 '{}/flow.decoder.estimator.fp32.onnx'.format(model_dir),
                                 trt_concurrent,
                                 self.fp16)
+        if window_len > 0:
+            self.model.enable_windowed_render(window_len)
+        self.llm_options = {'load_jit': load_jit}
+        self.llm_ready = False
+        self.llm_lock = threading.Lock()
+        if 'llm' in components:
+            self.load_llm(configs['llm'])
         del configs
 
+    def load_llm(self, llm=None):
+        """ Load llm if it is not loaded yet, inference modes which need it call this first """
+        if self.llm_ready is True:
+            return
+        with self.llm_lock:
+            if self.llm_ready is True:
+                return
+            model_dir = os.path.dirname(self.hyper_yaml_path)
+            if llm is None:
+                with open(self.hyper_yaml_path, 'r') as f:
+                    llm = load_hyperpyyaml(f, overrides={'flow': None, 'hift': None})['llm']
+            self.model.load_llm(llm, get_checkpoint(model_dir, 'llm'))
+            if self.llm_options['load_jit']:
+                self.model.load_llm_jit('{}/llm.text_encoder.{}.zip'.format(model_dir, 'fp16' if self.fp16 is True else 'fp32'),
+                                        '{}/llm.llm.{}.zip'.format(model_dir, 'fp16' if self.fp16 is True else 'fp32'))
+            self.llm_ready = True
+
     def list_available_spks(self):
+        self.frontend.load('spk2info')
         spks = list(self.frontend.spk2info.keys())
         return spks
 
@@ -72,67 +110,158 @@ class CosyVoice:
         model_input = self.frontend.frontend_zero_shot('', prompt_text, prompt_speech_16k, self.sample_rate, '')
         del model_input['text']
         del model_input['text_len']
+        self.frontend.load('spk2info')
         self.frontend.spk2info[zero_shot_spk_id] = model_input
         return True
 
     def save_spkinfo(self):
+        self.frontend.load('spk2info')
         torch.save(self.frontend.spk2info, '{}/spk2info.pt'.format(self.model_dir))
 
-    def inference_sft(self, tts_text, spk_id, stream=False, speed=1.0, text_frontend=True):
-        for i in tqdm(self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend)):
-            model_input = self.frontend.frontend_sft(i, spk_id)
+    def enable_engine(self, num_workers=None, queue_size=16, affinity=None, max_batch_size=None):
+        """ Run frontend, llm, flow and hift in separate worker pools, see StageEngine.
+
+        Example: cosyvoice.enable_engine({'flow': 2, 'hift': 2}, affinity={'hift': [4, 5, 6, 7]}),
+        queue depth and utilisation of every stage are reported by cosyvoice.engine.stats()
+        max_batch_size={'flow': 8} runs flow chunks of up to 8 concurrent sessions, queued on the
+        flow stage together, in one flow.inference_batch call.
+        """
+        self.engine = StageEngine(num_workers=num_workers, queue_size=queue_size, affinity=affinity, max_batch_size=max_batch_size)
+        self.model.engine = self.engine
+
+    def memory_stats(self):
+        """ Buffer pool hit rate and peak rss (and peak cuda memory), useful to size instances by memory """
+        stats = self.model.buffer_pool.stats()
+        stats['prompt_cache'] = self.model.prompt_cache.stats()
+        return stats
+
+    def synthesis(self, tts_texts, frontend_fn, stream=False, speed=1.0, cancel_event=None, pipeline=False, **kwargs):
+        """ Run frontend_fn and model tts for every text segment and yield model output in order.
+
+        When pipeline is True, a prefetch thread runs frontend and llm of segment N+1 as soon as
+        llm of segment N ends, so that it overlaps with flow and hift of segment N. At most one
+        segment is prefetched besides the one being rendered, segment N+2 starts once N+1 is taken.
+        Other kwargs are passed to model tts, e.g. hop_policy and flow n_timesteps, inference_cfg_rate and cfg_end.
+        """
+        if self.engine is not None:
+            frontend_fn = partial(self.engine.run, 'frontend', frontend_fn)
+        if pipeline is False:
+            for i in tqdm(tts_texts):
+                if cancel_event is not None and cancel_event.is_set():
+                    break
+                model_input = frontend_fn(i)
+                yield from self.synthesis_segment(i, model_input, stream, speed, cancel_event, **kwargs)
+            return
+        # slot is taken by a prefetched segment until the consumer gets it
+        prefetch_queue, slot, lock, stop = queue.Queue(), threading.Semaphore(1), threading.Lock(), threading.Event()
+
+        def put(item):
+            # NOTE nothing is queued after stop, so the consumer releases every session left in the queue
+            with lock:
+                if stop.is_set():
+                    return False
+                prefetch_queue.put(item)
+                return True
+
+        def prefetch_job():
+            try:
+                for i in tts_texts:
+                    # do not block forever on the slot after the consumer goes away
+                    while not stop.is_set() and not slot.acquire(timeout=0.1):
+                        continue
+                    if stop.is_set() or (cancel_event is not None and cancel_event.is_set()):
+                        break
+                    model_input = frontend_fn(i)
+                    session = self.model.start_tts(**model_input, cancel_event=cancel_event)
+                    if put((i, model_input, session)) is False:
+                        session.cancel()
+                        session.release()
+                        break
+                    # NOTE only one llm job at a time, next segment starts after this llm ends. join the job instead of
+                    # session.wait(), which supports a single waiter, the consumer rendering this session
+                    session.job.join()
+                put(None)
+            except Exception as e:
+                put(e)
+        p = threading.Thread(target=prefetch_job, daemon=True)
+        p.start()
+        try:
+            with tqdm(total=len(tts_texts)) as pbar:
+                while True:
+                    item = prefetch_queue.get()
+                    if item is None:
+                        break
+                    if isinstance(item, Exception):
+                        raise item
+                    slot.release()
+                    i, model_input, session = item
+                    # the session is released by model tts when it ends or is closed
+                    yield from self.synthesis_segment(i, model_input, stream, speed, cancel_event, session=session, **kwargs)
+                    pbar.update(1)
+        finally:
+            # cancel and release prefetched segments when the consumer goes away
+            with lock:
+                stop.set()
+            while not prefetch_queue.empty():
+                item = prefetch_queue.get_nowait()
+                if isinstance(item, tuple):
+                    item[2].cancel()
+                    item[2].release()
+
+    def synthesis_segment(self, tts_text, model_input, stream=False, speed=1.0, cancel_event=None, session=None, **kwargs):
+        start_time = time.time()
+        logging.info('synthesis text {}'.format(tts_text))
+        for model_output in self.model.tts(**model_input, stream=stream, speed=speed, cancel_event=cancel_event, session=session, **kwargs):
+            speech_len = model_output['tts_speech'].shape[1] / self.sample_rate
+            logging.info('yield speech len {}, rtf {}'.format(speech_len, (time.time() - start_time) / speech_len))
+            yield model_output
             start_time = time.time()
-            logging.info('synthesis text {}'.format(i))
-            for model_output in self.model.tts(**model_input, stream=stream, speed=speed):
-                speech_len = model_output['tts_speech'].shape[1] / self.sample_rate
-                logging.info('yield speech len {}, rtf {}'.format(speech_len, (time.time() - start_time) / speech_len))
-                yield model_output
-                start_time = time.time()
-
-    def inference_zero_shot(self, tts_text, prompt_text, prompt_speech_16k, zero_shot_spk_id='', stream=False, speed=1.0, text_frontend=True):
+
+    def inference_sft(self, tts_text, spk_id, stream=False, speed=1.0, text_frontend=True, cancel_event=None, pipeline=False, hop_policy='fixed',
+                      n_timesteps=10, inference_cfg_rate=None, cfg_end=1.0):
+        self.load_llm()
+        tts_texts = self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend)
+        yield from self.synthesis(tts_texts, lambda i: self.frontend.frontend_sft(i, spk_id), stream, speed, cancel_event, pipeline, hop_policy=hop_policy,
+                                  n_timesteps=n_timesteps, inference_cfg_rate=inference_cfg_rate, cfg_end=cfg_end)
+
+    def inference_zero_shot(self, tts_text, prompt_text, prompt_speech_16k, zero_shot_spk_id='', stream=False, speed=1.0, text_frontend=True,
+                            cancel_event=None, pipeline=False, hop_policy='fixed', n_timesteps=10, inference_cfg_rate=None, cfg_end=1.0):
+        self.load_llm()
         prompt_text = self.frontend.text_normalize(prompt_text, split=False, text_frontend=text_frontend)
-        for i in tqdm(self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend)):
+
+        def frontend_fn(i):
             if (not isinstance(i, Generator)) and len(i) < 0.5 * len(prompt_text):
                 logging.warning('synthesis text {} too short than prompt text {}, this may lead to bad performance'.format(i, prompt_text))
-            model_input = self.frontend.frontend_zero_shot(i, prompt_text, prompt_speech_16k, self.sample_rate, zero_shot_spk_id)
-            start_time = time.time()
-            logging.info('synthesis text {}'.format(i))
-            for model_output in self.model.tts(**model_input, stream=stream, speed=speed):
-                speech_len = model_output['tts_speech'].shape[1] / self.sample_rate
-                logging.info('yield speech len {}, rtf {}'.format(speech_len, (time.time() - start_time) / speech_len))
-                yield model_output
-                start_time = time.time()
-
-    def inference_cross_lingual(self, tts_text, prompt_speech_16k, zero_shot_spk_id='', stream=False, speed=1.0, text_frontend=True):
-        for i in tqdm(self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend)):
-            model_input = self.frontend.frontend_cross_lingual(i, prompt_speech_16k, self.sample_rate, zero_shot_spk_id)
-            start_time = time.time()
-            logging.info('synthesis text {}'.format(i))
-            for model_output in self.model.tts(**model_input, stream=stream, speed=speed):
-                speech_len = model_output['tts_speech'].shape[1] / self.sample_rate
-                logging.info('yield speech len {}, rtf {}'.format(speech_len, (time.time() - start_time) / speech_len))
-                yield model_output
-                start_time = time.time()
-
-    def inference_instruct(self, tts_text, spk_id, instruct_text, stream=False, speed=1.0, text_frontend=True):
+            return self.frontend.frontend_zero_shot(i, prompt_text, prompt_speech_16k, self.sample_rate, zero_shot_spk_id)
+        tts_texts = self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend)
+        yield from self.synthesis(tts_texts, frontend_fn, stream, speed, cancel_event, pipeline, hop_policy=hop_policy,
+                                  n_timesteps=n_timesteps, inference_cfg_rate=inference_cfg_rate, cfg_end=cfg_end)
+
+    def inference_cross_lingual(self, tts_text, prompt_speech_16k, zero_shot_spk_id='', stream=False, speed=1.0, text_frontend=True,
+                                cancel_event=None, pipeline=False, hop_policy='fixed', n_timesteps=10, inference_cfg_rate=None, cfg_end=1.0):
+        self.load_llm()
+        tts_texts = self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend)
+        yield from self.synthesis(tts_texts, lambda i: self.frontend.frontend_cross_lingual(i, prompt_speech_16k, self.sample_rate, zero_shot_spk_id),
+                                  stream, speed, cancel_event, pipeline, hop_policy=hop_policy,
+                                  n_timesteps=n_timesteps, inference_cfg_rate=inference_cfg_rate, cfg_end=cfg_end)
+
+    def inference_instruct(self, tts_text, spk_id, instruct_text, stream=False, speed=1.0, text_frontend=True, cancel_event=None, pipeline=False,
+                           hop_policy='fixed', n_timesteps=10, inference_cfg_rate=None, cfg_end=1.0):
         assert isinstance(self.model, CosyVoiceModel), 'inference_instruct is only implemented for CosyVoice!'
         if self.instruct is False:
             raise ValueError('{} do not support instruct inference'.format(self.model_dir))
+        self.load_llm()
         instruct_text = self.frontend.text_normalize(instruct_text, split=False, text_frontend=text_frontend)
-        for i in tqdm(self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend)):
-            model_input = self.frontend.frontend_instruct(i, spk_id, instruct_text)
-            start_time = time.time()
-            logging.info('synthesis text {}'.format(i))
-            for model_output in self.model.tts(**model_input, stream=stream, speed=speed):
-                speech_len = model_output['tts_speech'].shape[1] / self.sample_rate
-                logging.info('yield speech len {}, rtf {}'.format(speech_len, (time.time() - start_time) / speech_len))
-                yield model_output
-                start_time = time.time()
-
-    def inference_vc(self, source_speech_16k, prompt_speech_16k, stream=False, speed=1.0):
+        tts_texts = self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend)
+        yield from self.synthesis(tts_texts, lambda i: self.frontend.frontend_instruct(i, spk_id, instruct_text), stream, speed, cancel_event, pipeline,
+                                  hop_policy=hop_policy, n_timesteps=n_timesteps, inference_cfg_rate=inference_cfg_rate, cfg_end=cfg_end)
+
+    def inference_vc(self, source_speech_16k, prompt_speech_16k, stream=False, speed=1.0, cancel_event=None, hop_policy='fixed',
+                     n_timesteps=10, inference_cfg_rate=None, cfg_end=1.0):
         model_input = self.frontend.frontend_vc(source_speech_16k, prompt_speech_16k, self.sample_rate)
         start_time = time.time()
-        for model_output in self.model.tts(**model_input, stream=stream, speed=speed):
+        for model_output in self.model.tts(**model_input, stream=stream, speed=speed, cancel_event=cancel_event, hop_policy=hop_policy,
+                                           n_timesteps=n_timesteps, inference_cfg_rate=inference_cfg_rate, cfg_end=cfg_end):
             speech_len = model_output['tts_speech'].shape[1] / self.sample_rate
             logging.info('yield speech len {}, rtf {}'.format(speech_len, (time.time() - start_time) / speech_len))
             yield model_output
@@ -141,34 +270,43 @@ class CosyVoice:
 
 class CosyVoice2(CosyVoice):
 
-    def __init__(self, model_dir, load_jit=False, load_trt=False, load_vllm=False, fp16=False, trt_concurrent=1):
+    def __init__(self, model_dir, load_jit=False, load_trt=False, load_vllm=False, fp16=False, trt_concurrent=1,
+                 continuous_batching=False, max_batch_size=16, components=None, estimator_cache=False, window_len=0):
         self.instruct = True if '-Instruct' in model_dir else False
         self.model_dir = model_dir
         self.fp16 = fp16
+        self.engine = None
+        # components loaded here, None means all, the others are loaded on first use
+        components = COMPONENTS if components is None else components
+        for k in components:
+            if k not in COMPONENTS:
+                raise ValueError('unknown component {}, should be one of {}'.format(k, COMPONENTS))
         if not os.path.exists(model_dir):
             model_dir = snapshot_download(model_dir)
         hyper_yaml_path = '{}/cosyvoice2.yaml'.format(model_dir)
         if not os.path.exists(hyper_yaml_path):
             raise ValueError('{} not found!'.format(hyper_yaml_path))
+        self.hyper_yaml_path = hyper_yaml_path
+        # NOTE qwen weights are overwritten by llm checkpoint, so do not load pretrained qwen weights
+        overrides = {'qwen_pretrain_path': os.path.join(model_dir, 'CosyVoice-BlankEN'), 'llm': {'llm': {'load_pretrained': False}}}
+        if 'llm' not in components:
+            overrides['llm'] = None
         with open(hyper_yaml_path, 'r') as f:
-            configs = load_hyperpyyaml(f, overrides={'qwen_pretrain_path': os.path.join(model_dir, 'CosyVoice-BlankEN')})
+            configs = load_hyperpyyaml(f, overrides=overrides)
         assert get_model_type(configs) == CosyVoice2Model, 'do not use {} for CosyVoice2 initialization!'.format(model_dir)
         self.frontend = CosyVoiceFrontEnd(configs['get_tokenizer'],
                                           configs['feat_extractor'],
                                           '{}/campplus.onnx'.format(model_dir),
                                           '{}/speech_tokenizer_v2.onnx'.format(model_dir),
                                           '{}/spk2info.pt'.format(model_dir),
-                                          configs['allowed_special'])
+                                          configs['allowed_special'],
+                                          [k for k in components if k != 'llm'])
         self.sample_rate = configs['sample_rate']
         if torch.cuda.is_available() is False and (load_jit is True or load_trt is True or fp16 is True):
             load_jit, load_trt, fp16 = False, False, False
             logging.warning('no cuda device, set load_jit/load_trt/fp16 to False')
-        self.model = CosyVoice2Model(configs['llm'], configs['flow'], configs['hift'], fp16)
-        self.model.load('{}/llm.pt'.format(model_dir),
-                        '{}/flow.pt'.format(model_dir),
-                        '{}/hift.pt'.format(model_dir))
-        if load_vllm:
-            self.model.load_vllm('{}/vllm'.format(model_dir))
+        self.model = CosyVoice2Model(None, configs['flow'], configs['hift'], fp16)
+        self.model.load(None, get_checkpoint(model_dir, 'flow'), get_checkpoint(model_dir, 'hift'))
         if load_jit:
             self.model.load_jit('{}/flow.encoder.{}.zip'.format(model_dir, 'fp16' if self.fp16 is True else 'fp32'))
         if load_trt:
@@ -176,19 +314,44 @@ class CosyVoice2(CosyVoice):
                                 '{}/flow.decoder.estimator.fp32.onnx'.format(model_dir),
                                 trt_concurrent,
                                 self.fp16)
+        if estimator_cache:
+            self.model.enable_estimator_cache()
+        if window_len > 0:
+            self.model.enable_windowed_render(window_len)
+        self.llm_options = {'load_vllm': load_vllm, 'continuous_batching': continuous_batching, 'max_batch_size': max_batch_size}
+        self.llm_ready = False
+        self.llm_lock = threading.Lock()
+        if 'llm' in components:
+            self.load_llm(configs['llm'])
         del configs
 
+    def load_llm(self, llm=None):
+        """ Load llm if it is not loaded yet, inference modes which need it call this first """
+        if self.llm_ready is True:
+            return
+        with self.llm_lock:
+            if self.llm_ready is True:
+                return
+            model_dir = os.path.dirname(self.hyper_yaml_path)
+            if llm is None:
+                with open(self.hyper_yaml_path, 'r') as f:
+                    llm = load_hyperpyyaml(f, overrides={'qwen_pretrain_path': os.path.join(model_dir, 'CosyVoice-BlankEN'), 'llm': {'llm': {'load_pretrained': False}},
+                                                         'flow': None, 'hift': None})['llm']
+            self.model.load_llm(llm, get_checkpoint(model_dir, 'llm'))
+            if self.llm_options['load_vllm']:
+                self.model.load_vllm('{}/vllm'.format(model_dir))
+            if self.llm_options['continuous_batching']:
+                self.model.enable_continuous_batching(self.llm_options['max_batch_size'])
+            self.llm_ready = True
+
     def inference_instruct(self, *args, **kwargs):
         raise NotImplementedError('inference_instruct is not implemented for CosyVoice2!')
 
-    def inference_instruct2(self, tts_text, instruct_text, prompt_speech_16k, zero_shot_spk_id='', stream=False, speed=1.0, text_frontend=True):
+    def inference_instruct2(self, tts_text, instruct_text, prompt_speech_16k, zero_shot_spk_id='', stream=False, speed=1.0, text_frontend=True,
+                            cancel_event=None, pipeline=False, hop_policy='fixed', n_timesteps=10, inference_cfg_rate=None, cfg_end=1.0):
         assert isinstance(self.model, CosyVoice2Model), 'inference_instruct2 is only implemented for CosyVoice2!'
-        for i in tqdm(self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend)):
-            model_input = self.frontend.frontend_instruct2(i, instruct_text, prompt_speech_16k, self.sample_rate, zero_shot_spk_id)
-            start_time = time.time()
-            logging.info('synthesis text {}'.format(i))
-            for model_output in self.model.tts(**model_input, stream=stream, speed=speed):
-                speech_len = model_output['tts_speech'].shape[1] / self.sample_rate
-                logging.info('yield speech len {}, rtf {}'.format(speech_len, (time.time() - start_time) / speech_len))
-                yield model_output
-                start_time = time.time()
+        self.load_llm()
+        tts_texts = self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend)
+        yield from self.synthesis(tts_texts, lambda i: self.frontend.frontend_instruct2(i, instruct_text, prompt_speech_16k, self.sample_rate, zero_shot_spk_id),
+                                  stream, speed, cancel_event, pipeline, hop_policy=hop_policy,
+                                  n_timesteps=n_timesteps, inference_cfg_rate=inference_cfg_rate, cfg_end=cfg_end)
@@ -0,0 +1,200 @@
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+import queue
+import threading
+import time
+from typing import Dict, List, Optional
+from cosyvoice.utils.file_utils import logging
+
+STAGES = ['frontend', 'llm', 'flow', 'hift']
+
+
+class StageTask:
+
+    def __init__(self, fn, args, kwargs, batch_key=None):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        # tasks of submit_batch, queued ones with the same fn and batch_key run as one fn call
+        self.batch_key = batch_key
+        self.output = None
+        self.error = None
+        self.done = threading.Event()
+
+    def join(self):
+        self.done.wait()
+        if self.error is not None:
+            raise RuntimeError('stage task failed') from self.error
+
+    def result(self):
+        self.join()
+        return self.output
+
+
+class StageExecutor:
+    """ Worker threads of one stage, fed by a bounded queue.
+
+    submit() blocks when queue is full, so a slow stage applies back pressure to its
+    producers instead of piling up work. When cpus is given, every worker thread is
+    pinned to these cores (linux only). Tasks of submit_batch() that are queued together
+    with the same fn and key run as one fn call of at most max_batch_size items.
+    """
+
+    def __init__(self, name: str, num_workers: int = 1, queue_size: int = 16, cpus: Optional[List[int]] = None, max_batch_size: int = 1):
+        assert num_workers >= 1, 'stage {} needs at least one worker'.format(name)
+        assert max_batch_size >= 1, 'stage {} needs max_batch_size of at least one'.format(name)
+        self.name = name
+        self.num_workers = num_workers
+        self.cpus = cpus
+        self.max_batch_size = max_batch_size
+        self.task_queue = queue.Queue(maxsize=queue_size)
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.busy_time = 0.0
+        self.num_busy = 0
+        self.num_done = 0
+        self.num_calls = 0
+        self.workers = [threading.Thread(target=self.loop, name='{}_{}'.format(name, i), daemon=True) for i in range(num_workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def loop(self):
+        if self.cpus is not None:
+            if hasattr(os, 'sched_setaffinity'):
+                # NOTE pid 0 is the calling thread on linux
+                os.sched_setaffinity(0, self.cpus)
+            else:
+                logging.warning('cpu affinity is not supported on this platform, ignore cpus of stage {}'.format(self.name))
+        while True:
+            task = self.task_queue.get()
+            if task is None:
+                break
+            batch, others = self.collect(task)
+            self.run(batch)
+            # NOTE tasks taken while collecting the batch run right after it, a shutdown sentinel among them stops this worker
+            for task in others:
+                if task is not None:
+                    self.run([task])
+            if None in others:
+                break
+
+    def collect(self, task):
+        """ Batch of task and the queued tasks of the same fn and batch_key, and the other tasks taken meanwhile """
+        batch, others = [task], []
+        if task.batch_key is None:
+            return batch, others
+        while len(batch) < self.max_batch_size:
+            try:
+                queued = self.task_queue.get_nowait()
+            except queue.Empty:
+                break
+            # NOTE bound methods are new objects on every access, compare them by ==
+            if queued is not None and queued.batch_key == task.batch_key and queued.fn == task.fn:
+                batch.append(queued)
+            else:
+                others.append(queued)
+            # NOTE stop at a shutdown sentinel, so that every worker takes exactly one
+            if queued is None:
+                break
+        return batch, others
+
+    def run(self, batch):
+        with self.lock:
+            self.num_busy += 1
+        start_time = time.time()
+        try:
+            if batch[0].batch_key is None:
+                batch[0].output = batch[0].fn(*batch[0].args, **batch[0].kwargs)
+            else:
+                outputs = batch[0].fn([task.args[0] for task in batch])
+                for task, output in zip(batch, outputs):
+                    task.output = output
+        except Exception as e:
+            for task in batch:
+                task.error = e
+        with self.lock:
+            self.num_busy -= 1
+            self.num_done += len(batch)
+            self.num_calls += 1
+            self.busy_time += time.time() - start_time
+        for task in batch:
+            task.done.set()
+
+    def submit(self, fn, *args, **kwargs):
+        task = StageTask(fn, args, kwargs)
+        self.task_queue.put(task)
+        return task
+
+    def submit_batch(self, fn, key, item):
+        """ Queue item for fn(items), which returns one output per item, key tells which items may share a call """
+        task = StageTask(fn, (item,), {}, batch_key=key)
+        self.task_queue.put(task)
+        return task
+
+    def stats(self):
+        with self.lock:
+            elapsed = time.time() - self.start_time
+            return {'workers': self.num_workers,
+                    'queue_depth': self.task_queue.qsize(),
+                    'busy_workers': self.num_busy,
+                    'done': self.num_done,
+                    'batch_size': self.num_done / self.num_calls if self.num_calls > 0 else 0.0,
+                    'utilisation': self.busy_time / (elapsed * self.num_workers)}
+
+    def shutdown(self):
+        for _ in self.workers:
+            self.task_queue.put(None)
+        for worker in self.workers:
+            worker.join()
+
+
+class StageEngine:
+    """ Run frontend, llm, flow and hift in separate worker pools.
+
+    Each stage owns its thread count, queue size, cpu affinity and max batch size, so cores
+    can be sized per stage and one slow stage does not starve the others. Model weights are
+    shared by all workers, so workers are threads, torch kernels release the gil.
+    """
+
+    def __init__(self, num_workers: Optional[Dict[str, int]] = None, queue_size: int = 16, affinity: Optional[Dict[str, List[int]]] = None,
+                 max_batch_size: Optional[Dict[str, int]] = None):
+        num_workers = {} if num_workers is None else num_workers
+        affinity = {} if affinity is None else affinity
+        max_batch_size = {} if max_batch_size is None else max_batch_size
+        for k in list(num_workers.keys()) + list(affinity.keys()) + list(max_batch_size.keys()):
+            if k not in STAGES:
+                raise ValueError('unknown stage {}, should be one of {}'.format(k, STAGES))
+        # NOTE llm jobs hold a worker for the whole decoding, so llm needs more workers than other stages
+        default_workers = {'frontend': 1, 'llm': 4, 'flow': 1, 'hift': 1}
+        self.executors = {k: StageExecutor(k, num_workers.get(k, default_workers[k]), queue_size, affinity.get(k), max_batch_size.get(k, 1)) for k in STAGES}
+
+    def submit(self, stage, fn, *args, **kwargs):
+        return self.executors[stage].submit(fn, *args, **kwargs)
+
+    def run(self, stage, fn, *args, **kwargs):
+        return self.submit(stage, fn, *args, **kwargs).result()
+
+    def run_batch(self, stage, fn, key, item):
+        return self.executors[stage].submit_batch(fn, key, item).result()
+
+    def max_batch_size(self, stage):
+        return self.executors[stage].max_batch_size
+
+    def stats(self):
+        return {k: v.stats() for k, v in self.executors.items()}
+
+    def shutdown(self):
+        for executor in self.executors.values():
+            executor.shutdown()
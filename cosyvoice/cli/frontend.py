@@ -18,7 +18,8 @@ import onnxruntime
 import torch
 import numpy as np
 import whisper
-from typing import Callable
+from typing import Callable, List, Optional
+import threading
 import torchaudio.compliance.kaldi as kaldi
 import torchaudio
 import os
@@ -36,6 +37,10 @@ from cosyvoice.utils.file_utils import logging
 from cosyvoice.utils.frontend_utils import contains_chinese, replace_blank, replace_corner_mark, remove_bracket, spell_out_number, split_paragraph, is_only_punctuation
 
 
+# text: tokenizer and text normalizer, spk2info: speaker presets, campplus: speaker embedding, speech_tokenizer: prompt speech tokens
+FRONTEND_COMPONENTS = ['text', 'spk2info', 'campplus', 'speech_tokenizer']
+
+
 class CosyVoiceFrontEnd:
 
     def __init__(self,
@@ -44,23 +49,52 @@ class CosyVoiceFrontEnd:
                  campplus_model: str,
                  speech_tokenizer_model: str,
                  spk2info: str = '',
-                 allowed_special: str = 'all'):
-        self.tokenizer = get_tokenizer()
+                 allowed_special: str = 'all',
+                 components: Optional[List[str]] = None):
+        self.get_tokenizer = get_tokenizer
         self.feat_extractor = feat_extractor
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-        option = onnxruntime.SessionOptions()
-        option.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
-        option.intra_op_num_threads = 1
-        self.campplus_session = onnxruntime.InferenceSession(campplus_model, sess_options=option, providers=["CPUExecutionProvider"])
-        self.speech_tokenizer_session = onnxruntime.InferenceSession(speech_tokenizer_model, sess_options=option,
-                                                                     providers=["CUDAExecutionProvider" if torch.cuda.is_available() else
-                                                                                "CPUExecutionProvider"])
-        if os.path.exists(spk2info):
-            self.spk2info = torch.load(spk2info, map_location=self.device)
-        else:
-            self.spk2info = {}
+        self.campplus_model = campplus_model
+        self.speech_tokenizer_model = speech_tokenizer_model
+        self.spk2info_path = spk2info
         self.allowed_special = allowed_special
         self.use_ttsfrd = use_ttsfrd
+        # components loaded here, None means all, the others are loaded on first use
+        components = FRONTEND_COMPONENTS if components is None else components
+        self.loaded = set()
+        self.load_lock = threading.Lock()
+        for name in components:
+            self.load(name)
+
+    def load(self, name):
+        if name in self.loaded:
+            return
+        if name not in FRONTEND_COMPONENTS:
+            raise ValueError('unknown frontend component {}, should be one of {}'.format(name, FRONTEND_COMPONENTS))
+        with self.load_lock:
+            if name in self.loaded:
+                return
+            if name == 'text':
+                self.load_text()
+            elif name == 'spk2info':
+                if os.path.exists(self.spk2info_path):
+                    self.spk2info = torch.load(self.spk2info_path, map_location=self.device)
+                else:
+                    self.spk2info = {}
+            else:
+                option = onnxruntime.SessionOptions()
+                option.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+                option.intra_op_num_threads = 1
+                if name == 'campplus':
+                    self.campplus_session = onnxruntime.InferenceSession(self.campplus_model, sess_options=option, providers=["CPUExecutionProvider"])
+                else:
+                    self.speech_tokenizer_session = onnxruntime.InferenceSession(self.speech_tokenizer_model, sess_options=option,
+                                                                                 providers=["CUDAExecutionProvider" if torch.cuda.is_available() else
+                                                                                            "CPUExecutionProvider"])
+            self.loaded.add(name)
+
+    def load_text(self):
+        self.tokenizer = self.get_tokenizer()
         if self.use_ttsfrd:
             self.frd = ttsfrd.TtsFrontendEngine()
             ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -73,6 +107,7 @@ class CosyVoiceFrontEnd:
             self.inflect_parser = inflect.engine()
 
     def _extract_text_token(self, text):
+        self.load('text')
         if isinstance(text, Generator):
             logging.info('get tts_text generator, will return _extract_text_token_generator!')
             # NOTE add a dummy text_token_len for compatibility
@@ -91,6 +126,7 @@ class CosyVoiceFrontEnd:
 
     def _extract_speech_token(self, speech):
         assert speech.shape[1] / 16000 <= 30, 'do not support extract speech token for audio longer than 30s'
+        self.load('speech_tokenizer')
         feat = whisper.log_mel_spectrogram(speech, n_mels=128)
         speech_token = self.speech_tokenizer_session.run(None,
                                                          {self.speech_tokenizer_session.get_inputs()[0].name:
@@ -102,6 +138,7 @@ class CosyVoiceFrontEnd:
         return speech_token, speech_token_len
 
     def _extract_spk_embedding(self, speech):
+        self.load('campplus')
         feat = kaldi.fbank(speech,
                            num_mel_bins=80,
                            dither=0,
@@ -125,6 +162,7 @@ class CosyVoiceFrontEnd:
         if text_frontend is False or text == '':
             return [text] if split is True else text
         text = text.strip()
+        self.load('text')
         if self.use_ttsfrd:
             texts = [i["text"] for i in json.loads(self.frd.do_voicegen_frd(text))["sentences"]]
             text = ''.join(texts)
@@ -150,6 +188,7 @@ class CosyVoiceFrontEnd:
 
     def frontend_sft(self, tts_text, spk_id):
         tts_text_token, tts_text_token_len = self._extract_text_token(tts_text)
+        self.load('spk2info')
         embedding = self.spk2info[spk_id]['embedding']
         model_input = {'text': tts_text_token, 'text_len': tts_text_token_len, 'llm_embedding': embedding, 'flow_embedding': embedding}
         return model_input
@@ -173,6 +212,7 @@ class CosyVoiceFrontEnd:
                            'prompt_speech_feat': speech_feat, 'prompt_speech_feat_len': speech_feat_len,
                            'llm_embedding': embedding, 'flow_embedding': embedding}
         else:
+            self.load('spk2info')
             model_input = self.spk2info[zero_shot_spk_id]
         model_input['text'] = tts_text_token
         model_input['text_len'] = tts_text_token_len
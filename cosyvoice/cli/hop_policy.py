@@ -0,0 +1,97 @@
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+class HostRTF:
+    """ Moving average of the cost (wall seconds) to stream one speech token on this host.
+
+    It is shared by all sessions of a model, so a new session starts from the current
+    load of the host instead of an optimistic guess.
+    """
+
+    def __init__(self, alpha: float = 0.2):
+        self.alpha = alpha
+        self.token_cost = None
+
+    def update(self, token_cost: float):
+        # NOTE a plain float assignment, races between sessions only lose one sample
+        if self.token_cost is None:
+            self.token_cost = token_cost
+        else:
+            self.token_cost = (1 - self.alpha) * self.token_cost + self.alpha * token_cost
+
+
+class AdaptiveHopPolicy:
+    """ Choose the streaming hop length of one session from measured rtf.
+
+    The first chunk uses min_hop_len for low TTFB. Afterwards the playback buffer
+    (audio yielded minus wall time since the first chunk) is tracked, and the next hop
+    is the largest one whose estimated cost still finishes before the buffer drains,
+    keeping margin seconds in reserve. Larger hops mean fewer chunks, so better quality
+    and less per chunk overhead, and they are only taken when the buffer allows it.
+    Once the buffer has drained on a host slower than real time, underruns can not be
+    avoided anyway, then the hop grows by hop_step every chunk to amortize the per chunk
+    overhead.
+
+    Args:
+        token_rate: speech tokens per second of audio
+        min_hop_len, max_hop_len: hop length bounds in tokens
+        hop_step: hop length granularity, CosyVoice2 hops must be multiple of its chunk size
+        host: HostRTF shared by all sessions
+        margin: seconds of audio to keep in the playback buffer
+    """
+
+    def __init__(self, token_rate: float, min_hop_len: int, max_hop_len: int, hop_step: int = 1, host: HostRTF = None, margin: float = 0.3, alpha: float = 0.5):
+        assert min_hop_len % hop_step == 0 and max_hop_len % hop_step == 0, 'hop length should be multiple of hop_step {}'.format(hop_step)
+        assert min_hop_len <= max_hop_len, 'min_hop_len should not be greater than max_hop_len'
+        self.token_rate = token_rate
+        self.min_hop_len = min_hop_len
+        self.max_hop_len = max_hop_len
+        self.hop_step = hop_step
+        self.host = host if host is not None else HostRTF()
+        self.margin = margin
+        self.alpha = alpha
+        self.token_cost = None
+        self.play_start_time = None
+        self.audio_len = 0.0
+        self.last_hop_len = min_hop_len
+
+    def buffer_len(self, now: float):
+        """ Seconds of audio the client has buffered and not played yet """
+        if self.play_start_time is None:
+            return 0.0
+        return self.audio_len - (now - self.play_start_time)
+
+    def next_hop_len(self, now: float):
+        token_cost = self.token_cost if self.token_cost is not None else self.host.token_cost
+        if self.play_start_time is None or token_cost is None:
+            return self.min_hop_len
+        hop_len = int((self.buffer_len(now) - self.margin) / max(token_cost, 1e-6))
+        hop_len = hop_len // self.hop_step * self.hop_step
+        if self.buffer_len(now) <= 0 and token_cost * self.token_rate >= 1:
+            hop_len = self.last_hop_len + self.hop_step
+        return min(max(hop_len, self.min_hop_len), self.max_hop_len)
+
+    def update(self, start_time: float, end_time: float, hop_len: int):
+        """ Record one chunk of hop_len tokens, started at start_time and yielded at end_time """
+        token_cost = (end_time - start_time) / hop_len
+        if self.token_cost is None:
+            self.token_cost = token_cost
+        else:
+            self.token_cost = (1 - self.alpha) * self.token_cost + self.alpha * token_cost
+        self.host.update(token_cost)
+        self.last_hop_len = hop_len
+        if self.play_start_time is None:
+            self.play_start_time = end_time
+        self.audio_len += hop_len / self.token_rate
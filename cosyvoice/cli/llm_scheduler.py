@@ -0,0 +1,214 @@
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import queue
+import threading
+from contextlib import nullcontext
+from typing import Callable, List, Optional
+import torch
+import torch.nn.functional as F
+from cosyvoice.utils.common import TokenWindow
+from cosyvoice.utils.file_utils import logging
+
+
+class LLMRequest:
+
+    def __init__(self, lm_input: torch.Tensor, min_len: int, max_len: int, sampling: int,
+                 token_callback: Callable, end_callback: Callable, is_cancelled: Optional[Callable] = None):
+        self.lm_input = lm_input
+        self.min_len = min_len
+        self.max_len = max_len
+        self.sampling = sampling
+        self.token_callback = token_callback
+        self.end_callback = end_callback
+        self.is_cancelled = is_cancelled if is_cancelled is not None else lambda: False
+        self.out_tokens = []
+        # number of valid positions in the kv cache, also the position id of next input
+        self.seq_len = 0
+        self.done = threading.Event()
+        self.error = None
+
+    def join(self):
+        self.done.wait()
+        if self.error is not None:
+            raise RuntimeError('llm scheduler failed') from self.error
+
+    def finish(self, error=None):
+        self.error = error
+        self.end_callback()
+        self.done.set()
+
+
+class ContinuousBatchScheduler:
+    """ Own a single Qwen2LM decode loop and batch the decode step of all live sessions.
+
+    New requests are prefilled one by one when they are admitted, then joined into
+    a left padded batch kv cache. Every iteration samples one token for each live
+    session, retires the finished ones and runs one batched forward for the rest.
+    """
+
+    def __init__(self, llm: torch.nn.Module, max_batch_size: int = 16, fp16: bool = False):
+        self.llm = llm
+        self.max_batch_size = max_batch_size
+        self.fp16 = fp16
+        self.device = next(llm.parameters()).device
+        self.llm_context = torch.cuda.stream(torch.cuda.Stream(self.device)) if torch.cuda.is_available() else nullcontext()
+        self.pending = queue.Queue()
+        # batch state, row i of cache/masks belongs to self.active[i]
+        self.active: List[LLMRequest] = []
+        self.cache = None
+        self.masks = None
+        # recent tokens of every live session for repetition aware sampling
+        self.window = None
+        # submit and shutdown hold the lock, so no request is queued after shutdown drained the queue
+        self.lock = threading.Lock()
+        self.closed = threading.Event()
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    @torch.inference_mode()
+    def submit(self, text, prompt_text, llm_prompt_speech_token, llm_embedding, token_callback, end_callback, is_cancelled=None,
+               sampling=25, max_token_text_ratio=20, min_token_text_ratio=2):
+        lm_input, min_len, max_len = self.llm.prepare_lm_input(text=text.to(self.device),
+                                                               text_len=torch.tensor([text.shape[1]], dtype=torch.int32).to(self.device),
+                                                               prompt_text=prompt_text.to(self.device),
+                                                               prompt_text_len=torch.tensor([prompt_text.shape[1]], dtype=torch.int32).to(self.device),
+                                                               prompt_speech_token=llm_prompt_speech_token.to(self.device),
+                                                               prompt_speech_token_len=torch.tensor([llm_prompt_speech_token.shape[1]], dtype=torch.int32).to(self.device),
+                                                               max_token_text_ratio=max_token_text_ratio,
+                                                               min_token_text_ratio=min_token_text_ratio)
+        request = LLMRequest(lm_input, min_len, max_len, sampling, token_callback, end_callback, is_cancelled)
+        with self.lock:
+            if self.closed.is_set():
+                raise RuntimeError('llm scheduler is shut down')
+            self.pending.put(request)
+        return request
+
+    def shutdown(self):
+        """ Stop the decode loop, live and pending requests are finished with an error """
+        with self.lock:
+            self.closed.set()
+            # NOTE wake up the loop when it blocks on an empty queue
+            self.pending.put(None)
+        self.thread.join()
+        error = RuntimeError('llm scheduler is shut down')
+        for request in self.active:
+            request.finish(error=error)
+        self.active, self.cache, self.masks, self.window = [], None, None, None
+        while not self.pending.empty():
+            request = self.pending.get()
+            if request is not None:
+                request.finish(error=error)
+
+    def loop(self):
+        while not self.closed.is_set():
+            try:
+                with self.llm_context, torch.cuda.amp.autocast(self.fp16), torch.inference_mode():
+                    self.step()
+            except Exception as e:
+                logging.exception('llm scheduler step failed, abort {} live sessions'.format(len(self.active)))
+                for request in self.active:
+                    request.finish(error=e)
+                self.active, self.cache, self.masks, self.window = [], None, None, None
+
+    def step(self):
+        # 1. decode one step for all live sessions
+        logps = []
+        if len(self.active) != 0:
+            xs = torch.concat([self.llm.speech_embedding.weight[r.out_tokens[-1]].reshape(1, 1, -1) for r in self.active], dim=0)
+            self.masks = F.pad(self.masks, (0, 1), value=True)
+            position_ids = torch.tensor([[r.seq_len] for r in self.active], device=self.device)
+            y_pred, self.cache = self.llm.llm.forward_batch_step(xs, self.masks, position_ids, self.cache)
+            for r in self.active:
+                r.seq_len += 1
+            logps = list(self.llm.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1).unbind(dim=0))
+        # 2. admit new sessions, block when there is nothing to decode
+        while len(self.active) == 0 or (len(self.active) < self.max_batch_size and not self.pending.empty()):
+            request = self.pending.get()
+            if request is None:
+                # shutdown, requests are finished by shutdown()
+                return
+            if request.is_cancelled():
+                request.finish()
+                continue
+            # NOTE the request is not live until admit succeeds, a failed prefill only fails this request
+            try:
+                logps.append(self.admit(request))
+            except Exception as e:
+                logging.exception('llm scheduler prefill failed')
+                request.finish(error=e)
+        # 3. sample next token for all live sessions at once, and retire finished or cancelled ones
+        logp = torch.stack(logps, dim=0)
+        ignore_eos = torch.tensor([len(r.out_tokens) < r.min_len for r in self.active], device=self.device)
+        # NOTE sampling is not used by ras_sampling, sessions share the configured sampling function
+        top_ids = self.llm.sampling_ids(logp, self.window, self.active[0].sampling, ignore_eos=ignore_eos)
+        self.window.append(top_ids)
+        keep = []
+        for i, (request, top_ids) in enumerate(zip(self.active, top_ids.squeeze(dim=1).tolist())):
+            if request.is_cancelled():
+                request.finish()
+                continue
+            if top_ids == self.llm.speech_token_size:
+                request.finish()
+                continue
+            request.token_callback(top_ids)
+            request.out_tokens.append(top_ids)
+            if len(request.out_tokens) == request.max_len:
+                request.finish()
+                continue
+            keep.append(i)
+        if len(keep) != len(self.active):
+            self.retire(keep)
+
+    def admit(self, request):
+        """ Prefill a new session alone and append it to the batch cache """
+        lm_input = request.lm_input
+        seq_len = lm_input.shape[1]
+        masks = torch.ones((1, seq_len), dtype=torch.bool, device=self.device)
+        position_ids = torch.arange(seq_len, device=self.device).unsqueeze(dim=0)
+        y_pred, cache = self.llm.llm.forward_batch_step(lm_input, masks, position_ids)
+        logp = self.llm.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1).squeeze(dim=0)
+        # NOTE build the joined batch state first and assign it at the end, so a failure leaves the batch untouched
+        if self.cache is None:
+            window = TokenWindow(device=self.device)
+        else:
+            old_cache, old_masks = self.cache, self.masks
+            cache_len = old_masks.shape[1]
+            if seq_len > cache_len:
+                old_cache = [(F.pad(k, (0, 0, seq_len - cache_len, 0)), F.pad(v, (0, 0, seq_len - cache_len, 0))) for k, v in old_cache]
+                old_masks = F.pad(old_masks, (seq_len - cache_len, 0), value=False)
+            elif seq_len < cache_len:
+                cache = [(F.pad(k, (0, 0, cache_len - seq_len, 0)), F.pad(v, (0, 0, cache_len - seq_len, 0))) for k, v in cache]
+                masks = F.pad(masks, (cache_len - seq_len, 0), value=False)
+            cache = [(torch.concat([k1, k2], dim=0), torch.concat([v1, v2], dim=0)) for (k1, v1), (k2, v2) in zip(old_cache, cache)]
+            masks = torch.concat([old_masks, masks], dim=0)
+            window = self.window
+            window.extend(1)
+        self.cache, self.masks, self.window = cache, masks, window
+        request.seq_len = seq_len
+        request.lm_input = None
+        self.active.append(request)
+        return logp
+
+    def retire(self, keep):
+        self.active = [self.active[i] for i in keep]
+        if len(self.active) == 0:
+            self.cache, self.masks, self.window = None, None, None
+            return
+        index = torch.tensor(keep, device=self.device)
+        self.window.select(index)
+        masks = self.masks.index_select(0, index)
+        # drop left padding columns that no live session needs any more
+        start = int((~masks.any(dim=0)).long().cumprod(dim=0).sum().item())
+        self.masks = masks[:, start:]
+        self.cache = [(k.index_select(0, index)[:, :, start:], v.index_select(0, index)[:, :, start:]) for k, v in self.cache]
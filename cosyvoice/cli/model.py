@@ -22,8 +22,13 @@ from torch.nn import functional as F
 from contextlib import nullcontext
 import uuid
 from cosyvoice.utils.common import fade_in_out
-from cosyvoice.utils.file_utils import convert_onnx_to_trt, export_cosyvoice2_vllm
+from cosyvoice.utils.file_utils import convert_onnx_to_trt, export_cosyvoice2_vllm, load_checkpoint, load_state_dict
 from cosyvoice.utils.common import TrtContextWrapper
+from cosyvoice.cli.llm_scheduler import ContinuousBatchScheduler
+from cosyvoice.cli.session import TTSSession
+from cosyvoice.cli.buffer_pool import BufferPool
+from cosyvoice.cli.prompt_cache import PromptCache
+from cosyvoice.cli.hop_policy import HostRTF, AdaptiveHopPolicy
 
 
 class CosyVoiceModel:
@@ -39,7 +44,6 @@ class CosyVoiceModel:
         self.hift = hift
         self.fp16 = fp16
         if self.fp16 is True:
-            self.llm.half()
             self.flow.half()
         self.token_min_hop_len = 2 * self.flow.input_frame_rate
         self.token_max_hop_len = 4 * self.flow.input_frame_rate
@@ -55,32 +59,51 @@ class CosyVoiceModel:
         # rtf and decoding related
         self.stream_scale_factor = 1
         assert self.stream_scale_factor >= 1, 'stream_scale_factor should be greater than 1, change it according to your actual rtf'
+        # hop length bounds of hop_policy='adaptive', host_rtf is shared by all sessions
+        self.adaptive_hop_len = (self.token_min_hop_len // 2, self.token_max_hop_len, 10)
+        self.host_rtf = HostRTF()
+        # chunk buffers shared by all sessions, see buffer_pool.stats() for hit rate and peak memory
+        self.buffer_pool = BufferPool()
+        # flow prompt conditioning shared by requests with the same prompt, see prompt_cache.stats()
+        self.prompt_cache = PromptCache()
         self.llm_context = torch.cuda.stream(torch.cuda.Stream(self.device)) if torch.cuda.is_available() else nullcontext()
-        self.lock = threading.Lock()
-        # dict used to store session related variable
-        self.tts_speech_token_dict = {}
-        self.llm_end_dict = {}
-        self.mel_overlap_dict = {}
-        self.flow_cache_dict = {}
-        self.hift_cache_dict = {}
+        # stage worker pools, None means every stage runs on the caller thread
+        self.engine = None
+        # speech tokens per window of non streaming render, 0 means the whole utterance at once, see enable_windowed_render
+        self.window_len = 0
 
     def load(self, llm_model, flow_model, hift_model):
-        self.llm.load_state_dict(torch.load(llm_model, map_location=self.device), strict=True)
-        self.llm.to(self.device).eval()
-        self.flow.load_state_dict(torch.load(flow_model, map_location=self.device), strict=True)
+        # NOTE llm is None when it is loaded later by load_llm
+        if self.llm is not None:
+            self.load_llm(self.llm, llm_model)
+        # NOTE safetensors are assigned instead of copied, so parameters stay memory mapped
+        load_state_dict(self.flow, load_checkpoint(flow_model, self.device), assign=flow_model.endswith('.safetensors'))
+        if self.fp16 is True:
+            self.flow.half()
         self.flow.to(self.device).eval()
         # in case hift_model is a hifigan model
-        hift_state_dict = {k.replace('generator.', ''): v for k, v in torch.load(hift_model, map_location=self.device).items()}
-        self.hift.load_state_dict(hift_state_dict, strict=True)
+        hift_state_dict = {k.replace('generator.', ''): v for k, v in load_checkpoint(hift_model, self.device).items()}
+        load_state_dict(self.hift, hift_state_dict, assign=hift_model.endswith('.safetensors'))
         self.hift.to(self.device).eval()
 
+    def load_llm(self, llm, llm_model):
+        load_state_dict(llm, load_checkpoint(llm_model, self.device), assign=llm_model.endswith('.safetensors'))
+        if self.fp16 is True:
+            llm.half()
+        llm.to(self.device).eval()
+        self.llm = llm
+
     def load_jit(self, llm_text_encoder_model, llm_llm_model, flow_encoder_model):
+        if self.llm is not None:
+            self.load_llm_jit(llm_text_encoder_model, llm_llm_model)
+        flow_encoder = torch.jit.load(flow_encoder_model, map_location=self.device)
+        self.flow.encoder = flow_encoder
+
+    def load_llm_jit(self, llm_text_encoder_model, llm_llm_model):
         llm_text_encoder = torch.jit.load(llm_text_encoder_model, map_location=self.device)
         self.llm.text_encoder = llm_text_encoder
         llm_llm = torch.jit.load(llm_llm_model, map_location=self.device)
         self.llm.llm = llm_llm
-        flow_encoder = torch.jit.load(flow_encoder_model, map_location=self.device)
-        self.flow.encoder = flow_encoder
 
     def load_trt(self, flow_decoder_estimator_model, flow_decoder_onnx_model, trt_concurrent, fp16):
         assert torch.cuda.is_available(), 'tensorrt only supports gpu!'
@@ -94,147 +117,268 @@ class CosyVoiceModel:
         self.flow.decoder.estimator = TrtContextWrapper(estimator_engine, trt_concurrent=trt_concurrent, device=self.device)
 
     def get_trt_kwargs(self):
-        min_shape = [(2, 80, 4), (2, 1, 4), (2, 80, 4), (2, 80, 4)]
-        opt_shape = [(2, 80, 500), (2, 1, 500), (2, 80, 500), (2, 80, 500)]
-        max_shape = [(2, 80, 3000), (2, 1, 3000), (2, 80, 3000), (2, 80, 3000)]
-        input_names = ["x", "mask", "mu", "cond"]
+        # NOTE min batch 1 for steps without classifier free guidance
+        min_shape = [(1, 80, 4), (1, 1, 4), (1, 80, 4), (1,), (1, 80), (1, 80, 4)]
+        opt_shape = [(2, 80, 500), (2, 1, 500), (2, 80, 500), (2,), (2, 80), (2, 80, 500)]
+        max_shape = [(2, 80, 3000), (2, 1, 3000), (2, 80, 3000), (2,), (2, 80), (2, 80, 3000)]
+        input_names = ["x", "mask", "mu", "t", "spks", "cond"]
         return {'min_shape': min_shape, 'opt_shape': opt_shape, 'max_shape': max_shape, 'input_names': input_names}
 
-    def llm_job(self, text, prompt_text, llm_prompt_speech_token, llm_embedding, uuid):
-        with self.llm_context, torch.cuda.amp.autocast(self.fp16 is True and hasattr(self.llm, 'vllm') is False):
-            if isinstance(text, Generator):
-                assert isinstance(self, CosyVoice2Model) and not hasattr(self.llm, 'vllm'), 'streaming input text is only implemented for CosyVoice2 and do not support vllm!'
-                for i in self.llm.inference_bistream(text=text,
-                                                     prompt_text=prompt_text.to(self.device),
-                                                     prompt_text_len=torch.tensor([prompt_text.shape[1]], dtype=torch.int32).to(self.device),
-                                                     prompt_speech_token=llm_prompt_speech_token.to(self.device),
-                                                     prompt_speech_token_len=torch.tensor([llm_prompt_speech_token.shape[1]], dtype=torch.int32).to(self.device),
-                                                     embedding=llm_embedding.to(self.device)):
-                    self.tts_speech_token_dict[uuid].append(i)
-            else:
-                for i in self.llm.inference(text=text.to(self.device),
-                                            text_len=torch.tensor([text.shape[1]], dtype=torch.int32).to(self.device),
-                                            prompt_text=prompt_text.to(self.device),
-                                            prompt_text_len=torch.tensor([prompt_text.shape[1]], dtype=torch.int32).to(self.device),
-                                            prompt_speech_token=llm_prompt_speech_token.to(self.device),
-                                            prompt_speech_token_len=torch.tensor([llm_prompt_speech_token.shape[1]], dtype=torch.int32).to(self.device),
-                                            embedding=llm_embedding.to(self.device),
-                                            uuid=uuid):
-                    self.tts_speech_token_dict[uuid].append(i)
-        self.llm_end_dict[uuid] = True
-
-    def vc_job(self, source_speech_token, uuid):
-        self.tts_speech_token_dict[uuid] = source_speech_token.flatten().tolist()
-        self.llm_end_dict[uuid] = True
-
-    def token2wav(self, token, prompt_token, prompt_feat, embedding, uuid, finalize=False, speed=1.0):
+    def llm_job(self, text, prompt_text, llm_prompt_speech_token, llm_embedding, session):
+        try:
+            with self.llm_context, torch.cuda.amp.autocast(self.fp16 is True and hasattr(self.llm, 'vllm') is False):
+                if isinstance(text, Generator):
+                    assert isinstance(self, CosyVoice2Model) and not hasattr(self.llm, 'vllm'), 'streaming input text is only implemented for CosyVoice2 and do not support vllm!'
+                    for i in self.llm.inference_bistream(text=text,
+                                                         prompt_text=prompt_text.to(self.device),
+                                                         prompt_text_len=torch.tensor([prompt_text.shape[1]], dtype=torch.int32).to(self.device),
+                                                         prompt_speech_token=llm_prompt_speech_token.to(self.device),
+                                                         prompt_speech_token_len=torch.tensor([llm_prompt_speech_token.shape[1]], dtype=torch.int32).to(self.device),
+                                                         embedding=llm_embedding.to(self.device)):
+                        if session.cancelled:
+                            break
+                        session.append(i)
+                else:
+                    for i in self.llm.inference(text=text.to(self.device),
+                                                text_len=torch.tensor([text.shape[1]], dtype=torch.int32).to(self.device),
+                                                prompt_text=prompt_text.to(self.device),
+                                                prompt_text_len=torch.tensor([prompt_text.shape[1]], dtype=torch.int32).to(self.device),
+                                                prompt_speech_token=llm_prompt_speech_token.to(self.device),
+                                                prompt_speech_token_len=torch.tensor([llm_prompt_speech_token.shape[1]], dtype=torch.int32).to(self.device),
+                                                embedding=llm_embedding.to(self.device),
+                                                uuid=session.uuid):
+                        if session.cancelled:
+                            break
+                        session.append(i)
+        finally:
+            # always wake up token2wav, even if llm fails
+            session.close()
+
+    def vc_job(self, source_speech_token, session):
+        session.extend(source_speech_token)
+        session.close()
+
+    def start_llm_job(self, text, prompt_text, llm_prompt_speech_token, llm_embedding, session):
+        if self.engine is not None:
+            return self.engine.submit('llm', self.llm_job, text, prompt_text, llm_prompt_speech_token, llm_embedding, session)
+        p = threading.Thread(target=self.llm_job, args=(text, prompt_text, llm_prompt_speech_token, llm_embedding, session))
+        p.start()
+        return p
+
+    def start_tts(self, text=torch.zeros(1, 0, dtype=torch.int32), llm_embedding=torch.zeros(0, 192),
+                  prompt_text=torch.zeros(1, 0, dtype=torch.int32),
+                  llm_prompt_speech_token=torch.zeros(1, 0, dtype=torch.int32),
+                  source_speech_token=torch.zeros(1, 0, dtype=torch.int32), cancel_event=None, **kwargs):
+        """ Create a session and start its llm (or vc) job, speech tokens are consumed later by tts() """
+        # session holds all variables related to this inference thread, uuid is used by vllm
+        session = TTSSession(str(uuid.uuid1()), cancel_event=cancel_event, pool=self.buffer_pool)
+        if source_speech_token.shape[1] == 0:
+            session.job = self.start_llm_job(text, prompt_text, llm_prompt_speech_token, llm_embedding, session)
+        else:
+            session.job = threading.Thread(target=self.vc_job, args=(source_speech_token, session))
+            session.job.start()
+        return session
+
+    def enable_windowed_render(self, window_len):
+        """ Render non streaming requests window_len speech tokens at a time
+
+        Windows go through the streaming token2wav path, i.e. flow cache, mel overlap and hift cache
+        cross fades, so flow and hift input are bounded by window_len instead of utterance length,
+        and every window is yielded once rendered. Requests with speed != 1.0 still render in one shot.
+        """
+        assert window_len > 0, 'window_len should be greater than 0'
+        self.window_len = window_len
+
+    def get_hop_policy(self, hop_policy):
+        if hop_policy == 'fixed':
+            return None
+        if hop_policy == 'adaptive':
+            min_hop_len, max_hop_len, hop_step = self.adaptive_hop_len
+            return AdaptiveHopPolicy(self.flow.input_frame_rate, min_hop_len, max_hop_len, hop_step, host=self.host_rtf)
+        raise ValueError('unknown hop_policy {}, should be fixed or adaptive'.format(hop_policy))
+
+    def run_stage(self, stage, fn, *args, **kwargs):
+        # run inline, or in the worker pool of this stage when stage engine is enabled
+        if self.engine is None:
+            return fn(*args, **kwargs)
+        return self.engine.run(stage, fn, *args, **kwargs)
+
+    def prompt_condition(self, prompt_token, prompt_feat, embedding, stream=False):
+        """ Flow conditioning of the prompt, computed once per prompt and kept in prompt_cache """
+        key = PromptCache.key(prompt_token, prompt_feat, embedding)
+        prompt_cache = self.prompt_cache.get(key)
+        if prompt_cache is None:
+            with torch.cuda.amp.autocast(self.fp16):
+                prompt_cache = self.flow.prompt_condition(prompt_token.to(self.device), prompt_feat.to(self.device), embedding.to(self.device))
+            self.prompt_cache.put(key, prompt_cache)
+        return prompt_cache
+
+    def batch_flow(self):
+        # NOTE chunks of sessions queued on the flow stage together share one ode solve, see StageEngine max_batch_size
+        return self.engine is not None and self.engine.max_batch_size('flow') > 1
+
+    def token2wav(self, token, prompt_token, prompt_feat, embedding, session, finalize=False, speed=1.0):
+        if self.batch_flow():
+            tts_mel = self.engine.run_batch('flow', self.token2mel_batch, tuple(session.flow_kwargs.items()), (token, prompt_token, prompt_feat, embedding, session))
+        else:
+            tts_mel = self.run_stage('flow', self.token2mel, token, prompt_token, prompt_feat, embedding, session)
+        return self.run_stage('hift', self.mel2wav, tts_mel, session, finalize, speed)
+
+    def flow_input(self, token, prompt_token, prompt_feat, embedding, session):
+        return {'token': token.to(self.device),
+                'token_len': torch.tensor([token.shape[1]], dtype=torch.int32).to(self.device),
+                'prompt_token': prompt_token.to(self.device),
+                'prompt_token_len': torch.tensor([prompt_token.shape[1]], dtype=torch.int32).to(self.device),
+                'prompt_feat': prompt_feat.to(self.device),
+                'prompt_feat_len': torch.tensor([prompt_feat.shape[1]], dtype=torch.int32).to(self.device),
+                'embedding': embedding.to(self.device),
+                'flow_cache': session.flow_cache,
+                'prompt_cache': session.prompt_cache}
+
+    def token2mel(self, token, prompt_token, prompt_feat, embedding, session):
         with torch.cuda.amp.autocast(self.fp16):
-            tts_mel, self.flow_cache_dict[uuid] = self.flow.inference(token=token.to(self.device),
-                                                                      token_len=torch.tensor([token.shape[1]], dtype=torch.int32).to(self.device),
-                                                                      prompt_token=prompt_token.to(self.device),
-                                                                      prompt_token_len=torch.tensor([prompt_token.shape[1]], dtype=torch.int32).to(self.device),
-                                                                      prompt_feat=prompt_feat.to(self.device),
-                                                                      prompt_feat_len=torch.tensor([prompt_feat.shape[1]], dtype=torch.int32).to(self.device),
-                                                                      embedding=embedding.to(self.device),
-                                                                      flow_cache=self.flow_cache_dict[uuid])
+            tts_mel, session.flow_cache = self.flow.inference(**self.flow_input(token, prompt_token, prompt_feat, embedding, session), **session.flow_kwargs)
 
         # mel overlap fade in out
-        if self.mel_overlap_dict[uuid].shape[2] != 0:
-            tts_mel = fade_in_out(tts_mel, self.mel_overlap_dict[uuid], self.mel_window)
-        # append hift cache
-        if self.hift_cache_dict[uuid] is not None:
-            hift_cache_mel, hift_cache_source = self.hift_cache_dict[uuid]['mel'], self.hift_cache_dict[uuid]['source']
-            tts_mel = torch.concat([hift_cache_mel, tts_mel], dim=2)
+        if session.mel_overlap.shape[2] != 0:
+            tts_mel = fade_in_out(tts_mel, session.mel_overlap, self.mel_window)
+        return tts_mel
+
+    def token2mel_batch(self, requests):
+        """ token2mel of every request, token2mel arguments of sessions with the same flow_kwargs, see flow.inference_batch """
+        with torch.cuda.amp.autocast(self.fp16):
+            outputs = self.flow.inference_batch([self.flow_input(*r) for r in requests], **requests[0][-1].flow_kwargs)
+        tts_mels = []
+        for (_, _, _, _, session), (tts_mel, flow_cache) in zip(requests, outputs):
+            session.flow_cache = flow_cache
+            if session.mel_overlap.shape[2] != 0:
+                tts_mel = fade_in_out(tts_mel, session.mel_overlap, self.mel_window)
+            tts_mels.append(tts_mel)
+        return tts_mels
+
+    def mel2wav(self, tts_mel, session, finalize=False, speed=1.0):
+        # append hift cache, concatenated mel lives in a pooled buffer
+        hift_cache = session.hift_cache
+        if hift_cache is not None:
+            hift_cache_mel, hift_cache_source = hift_cache['mel'], hift_cache['source']
+            cache_mel = session.acquire((tts_mel.shape[0], tts_mel.shape[1], hift_cache_mel.shape[2] + tts_mel.shape[2]), tts_mel.dtype, tts_mel.device)
+            tts_mel = torch.concat([hift_cache_mel, tts_mel], dim=2, out=cache_mel)
         else:
             hift_cache_source = torch.zeros(1, 1, 0)
-        # keep overlap mel and hift cache
+        # keep overlap mel and hift cache, copied so that they do not pin the whole chunk
         if finalize is False:
-            self.mel_overlap_dict[uuid] = tts_mel[:, :, -self.mel_overlap_len:]
+            session.recycle(session.mel_overlap)
+            session.mel_overlap = session.keep(tts_mel[:, :, -self.mel_overlap_len:])
             tts_mel = tts_mel[:, :, :-self.mel_overlap_len]
             tts_speech, tts_source = self.hift.inference(speech_feat=tts_mel, cache_source=hift_cache_source)
-            if self.hift_cache_dict[uuid] is not None:
-                tts_speech = fade_in_out(tts_speech, self.hift_cache_dict[uuid]['speech'], self.speech_window)
-            self.hift_cache_dict[uuid] = {'mel': tts_mel[:, :, -self.mel_cache_len:],
-                                          'source': tts_source[:, :, -self.source_cache_len:],
-                                          'speech': tts_speech[:, -self.source_cache_len:]}
+            if hift_cache is not None:
+                tts_speech = fade_in_out(tts_speech, hift_cache['speech'], self.speech_window)
+            session.hift_cache = {'mel': session.keep(tts_mel[:, :, -self.mel_cache_len:]),
+                                  'source': session.keep(tts_source[:, :, -self.source_cache_len:]),
+                                  'speech': session.keep(tts_speech[:, -self.source_cache_len:])}
             tts_speech = tts_speech[:, :-self.source_cache_len]
         else:
             if speed != 1.0:
-                assert self.hift_cache_dict[uuid] is None, 'speed change only support non-stream inference mode'
+                assert hift_cache is None, 'speed change only support non-stream inference mode'
                 tts_mel = F.interpolate(tts_mel, size=int(tts_mel.shape[2] / speed), mode='linear')
             tts_speech, tts_source = self.hift.inference(speech_feat=tts_mel, cache_source=hift_cache_source)
-            if self.hift_cache_dict[uuid] is not None:
-                tts_speech = fade_in_out(tts_speech, self.hift_cache_dict[uuid]['speech'], self.speech_window)
+            if hift_cache is not None:
+                tts_speech = fade_in_out(tts_speech, hift_cache['speech'], self.speech_window)
+        if hift_cache is not None:
+            session.recycle(cache_mel, *hift_cache.values())
         return tts_speech
 
     def tts(self, text=torch.zeros(1, 0, dtype=torch.int32), flow_embedding=torch.zeros(0, 192), llm_embedding=torch.zeros(0, 192),
             prompt_text=torch.zeros(1, 0, dtype=torch.int32),
             llm_prompt_speech_token=torch.zeros(1, 0, dtype=torch.int32),
             flow_prompt_speech_token=torch.zeros(1, 0, dtype=torch.int32),
-            prompt_speech_feat=torch.zeros(1, 0, 80), source_speech_token=torch.zeros(1, 0, dtype=torch.int32), stream=False, speed=1.0, **kwargs):
-        # this_uuid is used to track variables related to this inference thread
-        this_uuid = str(uuid.uuid1())
-        with self.lock:
-            self.tts_speech_token_dict[this_uuid], self.llm_end_dict[this_uuid] = [], False
-            self.hift_cache_dict[this_uuid] = None
-            self.mel_overlap_dict[this_uuid] = torch.zeros(1, 80, 0)
-            self.flow_cache_dict[this_uuid] = torch.zeros(1, 80, 0, 2)
-        if source_speech_token.shape[1] == 0:
-            p = threading.Thread(target=self.llm_job, args=(text, prompt_text, llm_prompt_speech_token, llm_embedding, this_uuid))
-        else:
-            p = threading.Thread(target=self.vc_job, args=(source_speech_token, this_uuid))
-        p.start()
-        if stream is True:
-            token_hop_len = self.token_min_hop_len
-            while True:
-                time.sleep(0.1)
-                if len(self.tts_speech_token_dict[this_uuid]) >= token_hop_len + self.token_overlap_len:
-                    this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid][:token_hop_len + self.token_overlap_len]) \
-                        .unsqueeze(dim=0)
+            prompt_speech_feat=torch.zeros(1, 0, 80), source_speech_token=torch.zeros(1, 0, dtype=torch.int32), stream=False, speed=1.0,
+            cancel_event=None, session=None, hop_policy='fixed', n_timesteps=10, inference_cfg_rate=None, cfg_end=1.0, **kwargs):
+        # session is already started when llm is prefetched by CosyVoice.synthesis
+        if session is None:
+            session = self.start_tts(text=text, llm_embedding=llm_embedding, prompt_text=prompt_text,
+                                     llm_prompt_speech_token=llm_prompt_speech_token, source_speech_token=source_speech_token,
+                                     cancel_event=cancel_event)
+        p = session.job
+        session.flow_kwargs = {'n_timesteps': n_timesteps, 'inference_cfg_rate': inference_cfg_rate, 'cfg_end': cfg_end}
+        try:
+            session.prompt_cache = self.run_stage('flow', self.prompt_condition, flow_prompt_speech_token, prompt_speech_feat, flow_embedding, stream)
+            if stream is True:
+                policy = self.get_hop_policy(hop_policy)
+                token_hop_len = self.token_min_hop_len if policy is None else policy.next_hop_len(time.time())
+                chunk_start_time = time.time()
+                # block until next chunk is ready, return False when llm ends with not enough tokens
+                while session.wait(session.token_offset + token_hop_len + self.token_overlap_len) and not session.cancelled:
+                    this_tts_speech_token = session.tokens(session.token_offset, session.token_offset + token_hop_len + self.token_overlap_len)
                     this_tts_speech = self.token2wav(token=this_tts_speech_token,
                                                      prompt_token=flow_prompt_speech_token,
                                                      prompt_feat=prompt_speech_feat,
                                                      embedding=flow_embedding,
-                                                     uuid=this_uuid,
+                                                     session=session,
                                                      finalize=False)
+                    if policy is not None:
+                        policy.update(chunk_start_time, time.time(), token_hop_len)
                     yield {'tts_speech': this_tts_speech.cpu()}
-                    with self.lock:
-                        self.tts_speech_token_dict[this_uuid] = self.tts_speech_token_dict[this_uuid][token_hop_len:]
-                    # increase token_hop_len for better speech quality
-                    token_hop_len = min(self.token_max_hop_len, int(token_hop_len * self.stream_scale_factor))
-                if self.llm_end_dict[this_uuid] is True and len(self.tts_speech_token_dict[this_uuid]) < token_hop_len + self.token_overlap_len:
-                    break
-            p.join()
-            # deal with remain tokens, make sure inference remain token len equals token_hop_len when cache_speech is not None
-            this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
-            this_tts_speech = self.token2wav(token=this_tts_speech_token,
-                                             prompt_token=flow_prompt_speech_token,
-                                             prompt_feat=prompt_speech_feat,
-                                             embedding=flow_embedding,
-                                             uuid=this_uuid,
-                                             finalize=True)
-            yield {'tts_speech': this_tts_speech.cpu()}
-        else:
-            # deal with all tokens
-            p.join()
-            this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
-            this_tts_speech = self.token2wav(token=this_tts_speech_token,
-                                             prompt_token=flow_prompt_speech_token,
-                                             prompt_feat=prompt_speech_feat,
-                                             embedding=flow_embedding,
-                                             uuid=this_uuid,
-                                             finalize=True,
-                                             speed=speed)
-            yield {'tts_speech': this_tts_speech.cpu()}
-        with self.lock:
-            self.tts_speech_token_dict.pop(this_uuid)
-            self.llm_end_dict.pop(this_uuid)
-            self.mel_overlap_dict.pop(this_uuid)
-            self.hift_cache_dict.pop(this_uuid)
-            self.flow_cache_dict.pop(this_uuid)
-        if torch.cuda.is_available():
-            torch.cuda.empty_cache()
-            torch.cuda.current_stream().synchronize()
+                    chunk_start_time = time.time()
+                    session.token_offset += token_hop_len
+                    if policy is None:
+                        # increase token_hop_len for better speech quality
+                        token_hop_len = min(self.token_max_hop_len, int(token_hop_len * self.stream_scale_factor))
+                    else:
+                        token_hop_len = policy.next_hop_len(chunk_start_time)
+                p.join()
+                if session.cancelled:
+                    return
+                # deal with remain tokens, make sure inference remain token len equals token_hop_len when cache_speech is not None
+                this_tts_speech_token = session.tokens(session.token_offset)
+                this_tts_speech = self.token2wav(token=this_tts_speech_token,
+                                                 prompt_token=flow_prompt_speech_token,
+                                                 prompt_feat=prompt_speech_feat,
+                                                 embedding=flow_embedding,
+                                                 session=session,
+                                                 finalize=True)
+                yield {'tts_speech': this_tts_speech.cpu()}
+            elif self.window_len > 0 and speed == 1.0:
+                # NOTE windowed render is streaming with a fixed window_len hop, flow and hift memory do not grow with utterance length
+                while session.wait(session.token_offset + self.window_len + self.token_overlap_len) and not session.cancelled:
+                    this_tts_speech_token = session.tokens(session.token_offset, session.token_offset + self.window_len + self.token_overlap_len)
+                    this_tts_speech = self.token2wav(token=this_tts_speech_token,
+                                                     prompt_token=flow_prompt_speech_token,
+                                                     prompt_feat=prompt_speech_feat,
+                                                     embedding=flow_embedding,
+                                                     session=session,
+                                                     finalize=False)
+                    yield {'tts_speech': this_tts_speech.cpu()}
+                    session.token_offset += self.window_len
+                p.join()
+                if session.cancelled:
+                    return
+                this_tts_speech_token = session.tokens(session.token_offset)
+                this_tts_speech = self.token2wav(token=this_tts_speech_token,
+                                                 prompt_token=flow_prompt_speech_token,
+                                                 prompt_feat=prompt_speech_feat,
+                                                 embedding=flow_embedding,
+                                                 session=session,
+                                                 finalize=True)
+                yield {'tts_speech': this_tts_speech.cpu()}
+            else:
+                # deal with all tokens
+                p.join()
+                if session.cancelled:
+                    return
+                this_tts_speech_token = session.tokens()
+                this_tts_speech = self.token2wav(token=this_tts_speech_token,
+                                                 prompt_token=flow_prompt_speech_token,
+                                                 prompt_feat=prompt_speech_feat,
+                                                 embedding=flow_embedding,
+                                                 session=session,
+                                                 finalize=True,
+                                                 speed=speed)
+                yield {'tts_speech': this_tts_speech.cpu()}
+        finally:
+            # stop llm job at its next step if the consumer goes away, and give session buffers back to the pool
+            session.cancel()
+            session.release()
 
 
 class CosyVoice2Model(CosyVoiceModel):
@@ -250,7 +394,6 @@ class CosyVoice2Model(CosyVoiceModel):
         self.hift = hift
         self.fp16 = fp16
         if self.fp16 is True:
-            self.llm.half()
             self.flow.half()
         # NOTE must matching training static_chunk_size
         self.token_hop_len = 25
@@ -261,11 +404,26 @@ class CosyVoice2Model(CosyVoiceModel):
         self.speech_window = np.hamming(2 * self.source_cache_len)
         # rtf and decoding related
         self.llm_context = torch.cuda.stream(torch.cuda.Stream(self.device)) if torch.cuda.is_available() else nullcontext()
-        self.lock = threading.Lock()
-        # dict used to store session related variable
-        self.tts_speech_token_dict = {}
-        self.llm_end_dict = {}
-        self.hift_cache_dict = {}
+        # hop length bounds of hop_policy='adaptive', always multiple of token_hop_len
+        self.adaptive_hop_len = (self.token_hop_len, 4 * self.token_hop_len, self.token_hop_len)
+        self.host_rtf = HostRTF()
+        # chunk buffers shared by all sessions, see buffer_pool.stats() for hit rate and peak memory
+        self.buffer_pool = BufferPool()
+        # flow prompt conditioning shared by requests with the same prompt, see prompt_cache.stats()
+        self.prompt_cache = PromptCache()
+        # stage worker pools, None means every stage runs on the caller thread
+        self.engine = None
+        # shared decode loop, None means every session runs its own llm_job thread
+        self.llm_scheduler = None
+        # streaming chunks only run the flow estimator on new frames, see enable_estimator_cache
+        self.estimator_cache = False
+        # windowed render, flow runs on window_context_len extra tokens on both sides of a window,
+        # and window_overlap_len tokens of mel cross fade with the previous window
+        self.window_len = 0
+        self.window_context_len = self.token_hop_len
+        self.window_overlap_len = 10
+        self.mel_overlap_len = self.window_overlap_len * self.flow.token_mel_ratio
+        self.mel_window = np.hamming(2 * self.mel_overlap_len)
 
     def load_jit(self, flow_encoder_model):
         flow_encoder = torch.jit.load(flow_encoder_model, map_location=self.device)
@@ -282,105 +440,240 @@ class CosyVoice2Model(CosyVoiceModel):
         self.llm.lock = threading.Lock()
         del self.llm.llm.model.model.layers
 
-    def token2wav(self, token, prompt_token, prompt_feat, embedding, token_offset, uuid, stream=False, finalize=False, speed=1.0):
+    def enable_continuous_batching(self, max_batch_size=16):
+        assert not hasattr(self.llm, 'vllm'), 'vllm already does continuous batching, do not enable both!'
+        self.llm_scheduler = ContinuousBatchScheduler(self.llm, max_batch_size=max_batch_size, fp16=self.fp16)
+
+    def enable_static_cache(self):
+        """ Decode non vllm, non bistream requests with a preallocated kv cache of fixed shape
+
+        Meant for cuda graph capture or torch.compile, which need static shapes. In eager mode the
+        growing cache of forward_one_step is faster, and the static cache reserves prompt + max_len
+        positions, max_len is max_token_text_ratio times the text length, per request up front.
+        """
+        assert not hasattr(self.llm, 'vllm'), 'vllm does not use the static cache, do not enable both!'
+        self.llm.static_cache = True
+
+    def enable_estimator_cache(self, num_decoding_left_chunks=None):
+        """ Cache flow estimator conv/attention states of every timestep across streaming chunks
+
+        Cached states take flow estimator blocks * n_timesteps key/value per frame, with
+        num_decoding_left_chunks >= 0 only prompt frames and the last left chunks are kept,
+        which bounds memory and per chunk cost, but no longer matches the uncached output exactly.
+        """
+        assert isinstance(self.flow.decoder.estimator, torch.nn.Module), 'estimator cache does not support trt estimator!'
+        if num_decoding_left_chunks is not None:
+            self.flow.decoder.estimator.num_decoding_left_chunks = num_decoding_left_chunks
+        self.estimator_cache = True
+
+    def enable_windowed_render(self, window_len):
+        """ Render non streaming requests window_len speech tokens at a time
+
+        Every window runs flow non streaming on at most window_len + 2 * window_context_len tokens
+        after the prompt, see window2mel, and hift with its streaming cache, so peak memory is bounded
+        by window_len instead of utterance length. Requests with speed != 1.0 still render in one shot.
+        """
+        assert window_len > self.window_overlap_len, 'window_len should be greater than window_overlap_len {}'.format(self.window_overlap_len)
+        self.window_len = window_len
+
+    def start_llm_job(self, text, prompt_text, llm_prompt_speech_token, llm_embedding, session):
+        # NOTE streaming input text can not be batched, it still runs in its own thread
+        if self.llm_scheduler is not None and not isinstance(text, Generator):
+            return self.llm_scheduler.submit(text, prompt_text, llm_prompt_speech_token, llm_embedding,
+                                             token_callback=session.append,
+                                             end_callback=session.close,
+                                             is_cancelled=lambda: session.cancelled)
+        return super().start_llm_job(text, prompt_text, llm_prompt_speech_token, llm_embedding, session)
+
+    def prompt_condition(self, prompt_token, prompt_feat, embedding, stream=False, n_timesteps=10, inference_cfg_rate=None, cfg_end=1.0):
+        """ Flow conditioning of the prompt, computed once per prompt and kept in prompt_cache """
+        # NOTE streaming entries also keep encoder (and estimator) caches of the leading prompt chunks
+        key = PromptCache.key(prompt_token, prompt_feat, embedding, stream, self.estimator_cache,
+                              self.flow.decoder.solver, n_timesteps, inference_cfg_rate, cfg_end)
+        prompt_cache = self.prompt_cache.get(key)
+        if prompt_cache is None:
+            with torch.cuda.amp.autocast(self.fp16):
+                prompt_cache = self.flow.prompt_condition(prompt_token.to(self.device), prompt_feat.to(self.device), embedding.to(self.device),
+                                                          streaming=stream, cache_estimator=self.estimator_cache,
+                                                          n_timesteps=n_timesteps, inference_cfg_rate=inference_cfg_rate, cfg_end=cfg_end)
+            self.prompt_cache.put(key, prompt_cache)
+        return prompt_cache
+
+    def token2wav(self, token, prompt_token, prompt_feat, embedding, token_offset, session, stream=False, finalize=False, speed=1.0):
+        # NOTE inference_batch does not support estimator cache
+        if self.batch_flow() and self.estimator_cache is False:
+            tts_mel = self.engine.run_batch('flow', self.token2mel_batch, (stream, tuple(session.flow_kwargs.items())),
+                                            (token, prompt_token, prompt_feat, embedding, token_offset, session, stream, finalize))
+        else:
+            tts_mel = self.run_stage('flow', self.token2mel, token, prompt_token, prompt_feat, embedding, token_offset, session, stream, finalize)
+        return self.run_stage('hift', self.mel2wav, tts_mel, session, finalize, speed)
+
+    def flow_input(self, token, prompt_token, prompt_feat, embedding, session, stream=False, finalize=False):
+        return {'token': token.to(self.device),
+                'token_len': torch.tensor([token.shape[1]], dtype=torch.int32).to(self.device),
+                'prompt_token': prompt_token.to(self.device),
+                'prompt_token_len': torch.tensor([prompt_token.shape[1]], dtype=torch.int32).to(self.device),
+                'prompt_feat': prompt_feat.to(self.device),
+                'prompt_feat_len': torch.tensor([prompt_feat.shape[1]], dtype=torch.int32).to(self.device),
+                'embedding': embedding.to(self.device),
+                'streaming': stream,
+                'finalize': finalize,
+                'chunk_cache': session.chunk_cache,
+                'prompt_cache': session.prompt_cache}
+
+    def token2mel(self, token, prompt_token, prompt_feat, embedding, token_offset, session, stream=False, finalize=False):
+        with torch.cuda.amp.autocast(self.fp16):
+            # NOTE streaming chunks only encode new tokens, the last chunk is encoded again without chunk mask
+            tts_mel, session.chunk_cache = self.flow.inference(**self.flow_input(token, prompt_token, prompt_feat, embedding, session, stream, finalize),
+                                                               cache_estimator=self.estimator_cache, **session.flow_kwargs)
+        # NOTE with estimator cache, streaming chunks only return mel of new tokens
+        if self.estimator_cache is False or stream is False or finalize is True:
+            tts_mel = tts_mel[:, :, token_offset * self.flow.token_mel_ratio:]
+        return tts_mel
+
+    def token2mel_batch(self, requests):
+        """ token2mel of every request, token2mel arguments of sessions with the same stream and flow_kwargs, see flow.inference_batch """
         with torch.cuda.amp.autocast(self.fp16):
-            tts_mel, _ = self.flow.inference(token=token.to(self.device),
-                                             token_len=torch.tensor([token.shape[1]], dtype=torch.int32).to(self.device),
-                                             prompt_token=prompt_token.to(self.device),
-                                             prompt_token_len=torch.tensor([prompt_token.shape[1]], dtype=torch.int32).to(self.device),
-                                             prompt_feat=prompt_feat.to(self.device),
-                                             prompt_feat_len=torch.tensor([prompt_feat.shape[1]], dtype=torch.int32).to(self.device),
-                                             embedding=embedding.to(self.device),
-                                             streaming=stream,
-                                             finalize=finalize)
-        tts_mel = tts_mel[:, :, token_offset * self.flow.token_mel_ratio:]
-        # append hift cache
-        if self.hift_cache_dict[uuid] is not None:
-            hift_cache_mel, hift_cache_source = self.hift_cache_dict[uuid]['mel'], self.hift_cache_dict[uuid]['source']
-            tts_mel = torch.concat([hift_cache_mel, tts_mel], dim=2)
+            outputs = self.flow.inference_batch([self.flow_input(token, prompt_token, prompt_feat, embedding, session, stream, finalize)
+                                                 for token, prompt_token, prompt_feat, embedding, _, session, stream, finalize in requests],
+                                                **requests[0][5].flow_kwargs)
+        tts_mels = []
+        for (_, _, _, _, token_offset, session, _, _), (tts_mel, chunk_cache) in zip(requests, outputs):
+            session.chunk_cache = chunk_cache
+            tts_mels.append(tts_mel[:, :, token_offset * self.flow.token_mel_ratio:])
+        return tts_mels
+
+    def window2wav(self, prompt_token, prompt_feat, embedding, session, finalize=False):
+        tts_mel = self.run_stage('flow', self.window2mel, prompt_token, prompt_feat, embedding, session, finalize)
+        return self.run_stage('hift', self.mel2wav, tts_mel, session, finalize)
+
+    def window2mel(self, prompt_token, prompt_feat, embedding, session, finalize=False):
+        """ Mel of tokens [token_offset, token_offset + window_len), or of all remaining tokens when finalize """
+        start = max(0, session.token_offset - self.window_context_len)
+        end = None if finalize is True else session.token_offset + self.window_len + self.window_context_len
+        tts_mel = self.token2mel(session.tokens(start, end), prompt_token, prompt_feat, embedding, 0, session, stream=False, finalize=True)
+        # keep window_overlap_len tokens before the window for mel fade in out, and drop right context
+        overlap_len = min(self.window_overlap_len, session.token_offset)
+        tts_mel = tts_mel[:, :, (session.token_offset - overlap_len - start) * self.flow.token_mel_ratio:]
+        if finalize is False:
+            tts_mel = tts_mel[:, :, :(overlap_len + self.window_len) * self.flow.token_mel_ratio]
+        if session.mel_overlap.shape[2] != 0:
+            tts_mel = fade_in_out(tts_mel, session.mel_overlap, self.mel_window)
+        if finalize is False:
+            session.recycle(session.mel_overlap)
+            session.mel_overlap = session.keep(tts_mel[:, :, -self.mel_overlap_len:])
+            tts_mel = tts_mel[:, :, :-self.mel_overlap_len]
+        return tts_mel
+
+    def mel2wav(self, tts_mel, session, finalize=False, speed=1.0):
+        # append hift cache, concatenated mel lives in a pooled buffer
+        hift_cache = session.hift_cache
+        if hift_cache is not None:
+            hift_cache_mel, hift_cache_source = hift_cache['mel'], hift_cache['source']
+            cache_mel = session.acquire((tts_mel.shape[0], tts_mel.shape[1], hift_cache_mel.shape[2] + tts_mel.shape[2]), tts_mel.dtype, tts_mel.device)
+            tts_mel = torch.concat([hift_cache_mel, tts_mel], dim=2, out=cache_mel)
         else:
             hift_cache_source = torch.zeros(1, 1, 0)
-        # keep overlap mel and hift cache
+        # keep hift cache, copied so that it does not pin the whole chunk
         if finalize is False:
             tts_speech, tts_source = self.hift.inference(speech_feat=tts_mel, cache_source=hift_cache_source)
-            if self.hift_cache_dict[uuid] is not None:
-                tts_speech = fade_in_out(tts_speech, self.hift_cache_dict[uuid]['speech'], self.speech_window)
-            self.hift_cache_dict[uuid] = {'mel': tts_mel[:, :, -self.mel_cache_len:],
-                                          'source': tts_source[:, :, -self.source_cache_len:],
-                                          'speech': tts_speech[:, -self.source_cache_len:]}
+            if hift_cache is not None:
+                tts_speech = fade_in_out(tts_speech, hift_cache['speech'], self.speech_window)
+            session.hift_cache = {'mel': session.keep(tts_mel[:, :, -self.mel_cache_len:]),
+                                  'source': session.keep(tts_source[:, :, -self.source_cache_len:]),
+                                  'speech': session.keep(tts_speech[:, -self.source_cache_len:])}
             tts_speech = tts_speech[:, :-self.source_cache_len]
         else:
             if speed != 1.0:
-                assert self.hift_cache_dict[uuid] is None, 'speed change only support non-stream inference mode'
+                assert hift_cache is None, 'speed change only support non-stream inference mode'
                 tts_mel = F.interpolate(tts_mel, size=int(tts_mel.shape[2] / speed), mode='linear')
             tts_speech, tts_source = self.hift.inference(speech_feat=tts_mel, cache_source=hift_cache_source)
-            if self.hift_cache_dict[uuid] is not None:
-                tts_speech = fade_in_out(tts_speech, self.hift_cache_dict[uuid]['speech'], self.speech_window)
+            if hift_cache is not None:
+                tts_speech = fade_in_out(tts_speech, hift_cache['speech'], self.speech_window)
+        if hift_cache is not None:
+            session.recycle(cache_mel, *hift_cache.values())
         return tts_speech
 
     def tts(self, text=torch.zeros(1, 0, dtype=torch.int32), flow_embedding=torch.zeros(0, 192), llm_embedding=torch.zeros(0, 192),
             prompt_text=torch.zeros(1, 0, dtype=torch.int32),
             llm_prompt_speech_token=torch.zeros(1, 0, dtype=torch.int32),
             flow_prompt_speech_token=torch.zeros(1, 0, dtype=torch.int32),
-            prompt_speech_feat=torch.zeros(1, 0, 80), source_speech_token=torch.zeros(1, 0, dtype=torch.int32), stream=False, speed=1.0, **kwargs):
-        # this_uuid is used to track variables related to this inference thread
-        this_uuid = str(uuid.uuid1())
-        with self.lock:
-            self.tts_speech_token_dict[this_uuid], self.llm_end_dict[this_uuid] = [], False
-            self.hift_cache_dict[this_uuid] = None
-        if source_speech_token.shape[1] == 0:
-            p = threading.Thread(target=self.llm_job, args=(text, prompt_text, llm_prompt_speech_token, llm_embedding, this_uuid))
-        else:
-            p = threading.Thread(target=self.vc_job, args=(source_speech_token, this_uuid))
-        p.start()
-        if stream is True:
-            token_offset = 0
-            prompt_token_pad = int(np.ceil(flow_prompt_speech_token.shape[1] / self.token_hop_len) * self.token_hop_len - flow_prompt_speech_token.shape[1])
-            while True:
-                time.sleep(0.1)
-                this_token_hop_len = self.token_hop_len + prompt_token_pad if token_offset == 0 else self.token_hop_len
-                if len(self.tts_speech_token_dict[this_uuid]) - token_offset >= this_token_hop_len + self.flow.pre_lookahead_len:
-                    this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid][:token_offset + this_token_hop_len + self.flow.pre_lookahead_len]).unsqueeze(dim=0)
+            prompt_speech_feat=torch.zeros(1, 0, 80), source_speech_token=torch.zeros(1, 0, dtype=torch.int32), stream=False, speed=1.0,
+            cancel_event=None, session=None, hop_policy='fixed', n_timesteps=10, inference_cfg_rate=None, cfg_end=1.0, **kwargs):
+        # session is already started when llm is prefetched by CosyVoice.synthesis
+        if session is None:
+            session = self.start_tts(text=text, llm_embedding=llm_embedding, prompt_text=prompt_text,
+                                     llm_prompt_speech_token=llm_prompt_speech_token, source_speech_token=source_speech_token,
+                                     cancel_event=cancel_event)
+        p = session.job
+        session.flow_kwargs = {'n_timesteps': n_timesteps, 'inference_cfg_rate': inference_cfg_rate, 'cfg_end': cfg_end}
+        try:
+            session.prompt_cache = self.run_stage('flow', self.prompt_condition, flow_prompt_speech_token, prompt_speech_feat, flow_embedding,
+                                                  stream, **session.flow_kwargs)
+            if stream is True:
+                prompt_token_pad = int(np.ceil(flow_prompt_speech_token.shape[1] / self.token_hop_len) * self.token_hop_len - flow_prompt_speech_token.shape[1])
+                policy = self.get_hop_policy(hop_policy)
+                chunk_start_time = time.time()
+                while True:
+                    token_hop_len = self.token_hop_len if policy is None else policy.next_hop_len(time.time())
+                    this_token_hop_len = token_hop_len + prompt_token_pad if session.token_offset == 0 else token_hop_len
+                    # block until next chunk is ready, break when llm ends with not enough tokens
+                    if session.wait(session.token_offset + this_token_hop_len + self.flow.pre_lookahead_len) is False or session.cancelled:
+                        break
+                    this_tts_speech_token = session.tokens(0, session.token_offset + this_token_hop_len + self.flow.pre_lookahead_len)
                     this_tts_speech = self.token2wav(token=this_tts_speech_token,
                                                      prompt_token=flow_prompt_speech_token,
                                                      prompt_feat=prompt_speech_feat,
                                                      embedding=flow_embedding,
-                                                     token_offset=token_offset,
-                                                     uuid=this_uuid,
+                                                     token_offset=session.token_offset,
+                                                     session=session,
                                                      stream=stream,
                                                      finalize=False)
-                    token_offset += this_token_hop_len
+                    session.token_offset += this_token_hop_len
+                    if policy is not None:
+                        policy.update(chunk_start_time, time.time(), this_token_hop_len)
                     yield {'tts_speech': this_tts_speech.cpu()}
-                if self.llm_end_dict[this_uuid] is True and len(self.tts_speech_token_dict[this_uuid]) - token_offset < this_token_hop_len + self.flow.pre_lookahead_len:
-                    break
-            p.join()
-            # deal with remain tokens, make sure inference remain token len equals token_hop_len when cache_speech is not None
-            this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
-            this_tts_speech = self.token2wav(token=this_tts_speech_token,
-                                             prompt_token=flow_prompt_speech_token,
-                                             prompt_feat=prompt_speech_feat,
-                                             embedding=flow_embedding,
-                                             token_offset=token_offset,
-                                             uuid=this_uuid,
-                                             finalize=True)
-            yield {'tts_speech': this_tts_speech.cpu()}
-        else:
-            # deal with all tokens
-            p.join()
-            this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
-            this_tts_speech = self.token2wav(token=this_tts_speech_token,
-                                             prompt_token=flow_prompt_speech_token,
-                                             prompt_feat=prompt_speech_feat,
-                                             embedding=flow_embedding,
-                                             token_offset=0,
-                                             uuid=this_uuid,
-                                             finalize=True,
-                                             speed=speed)
-            yield {'tts_speech': this_tts_speech.cpu()}
-        with self.lock:
-            self.tts_speech_token_dict.pop(this_uuid)
-            self.llm_end_dict.pop(this_uuid)
-            self.hift_cache_dict.pop(this_uuid)
-        if torch.cuda.is_available():
-            torch.cuda.empty_cache()
-            torch.cuda.current_stream().synchronize()
+                    chunk_start_time = time.time()
+                p.join()
+                if session.cancelled:
+                    return
+                # deal with remain tokens, make sure inference remain token len equals token_hop_len when cache_speech is not None
+                this_tts_speech_token = session.tokens()
+                this_tts_speech = self.token2wav(token=this_tts_speech_token,
+                                                 prompt_token=flow_prompt_speech_token,
+                                                 prompt_feat=prompt_speech_feat,
+                                                 embedding=flow_embedding,
+                                                 token_offset=session.token_offset,
+                                                 session=session,
+                                                 finalize=True)
+                yield {'tts_speech': this_tts_speech.cpu()}
+            elif self.window_len > 0 and speed == 1.0:
+                # NOTE windowed render, flow input is bounded by window_len + 2 * window_context_len tokens after the prompt
+                while session.wait(session.token_offset + self.window_len + self.window_context_len) and not session.cancelled:
+                    this_tts_speech = self.window2wav(flow_prompt_speech_token, prompt_speech_feat, flow_embedding, session, finalize=False)
+                    yield {'tts_speech': this_tts_speech.cpu()}
+                    session.token_offset += self.window_len
+                p.join()
+                if session.cancelled:
+                    return
+                this_tts_speech = self.window2wav(flow_prompt_speech_token, prompt_speech_feat, flow_embedding, session, finalize=True)
+                yield {'tts_speech': this_tts_speech.cpu()}
+            else:
+                # deal with all tokens
+                p.join()
+                if session.cancelled:
+                    return
+                this_tts_speech_token = session.tokens()
+                this_tts_speech = self.token2wav(token=this_tts_speech_token,
+                                                 prompt_token=flow_prompt_speech_token,
+                                                 prompt_feat=prompt_speech_feat,
+                                                 embedding=flow_embedding,
+                                                 token_offset=0,
+                                                 session=session,
+                                                 finalize=True,
+                                                 speed=speed)
+                yield {'tts_speech': this_tts_speech.cpu()}
+        finally:
+            # stop llm job at its next step if the consumer goes away, and give session buffers back to the pool
+            session.cancel()
+            session.release()
@@ -0,0 +1,95 @@
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import hashlib
+import threading
+from collections import OrderedDict
+import torch
+
+
+def nbytes(obj):
+    """ Total size of tensors in nested dict/list/tuple """
+    if isinstance(obj, torch.Tensor):
+        return obj.numel() * obj.element_size()
+    if isinstance(obj, dict):
+        return sum(nbytes(v) for v in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return sum(nbytes(v) for v in obj)
+    return 0
+
+
+class PromptCache:
+    """ LRU cache of flow prompt conditioning, see flow.prompt_condition().
+
+    Entries are keyed by a hash of the prompt tensors (and flags which change the entry),
+    so registered speakers and repeated zero shot prompts share one entry. Entries are
+    read only once cached. The least recently used entries are evicted when the total
+    size exceeds max_bytes, an entry larger than max_bytes is not cached at all.
+    """
+
+    def __init__(self, max_bytes: int = 512 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.num_hit = 0
+        self.num_miss = 0
+        self.num_drop = 0
+
+    @staticmethod
+    def key(*items):
+        h = hashlib.sha1()
+        for item in items:
+            if isinstance(item, torch.Tensor):
+                item = item.detach().cpu().contiguous()
+                h.update('{}{}'.format(item.dtype, tuple(item.shape)).encode())
+                h.update(item.flatten().view(torch.uint8).numpy().tobytes())
+            else:
+                h.update(repr(item).encode())
+        return h.hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.num_hit += 1
+                return self.entries[key][0]
+            self.num_miss += 1
+            return None
+
+    def put(self, key, entry):
+        size = nbytes(entry)
+        with self.lock:
+            if size > self.max_bytes:
+                self.num_drop += 1
+                return
+            if key in self.entries:
+                self.total_bytes -= self.entries.pop(key)[1]
+            self.entries[key] = (entry, size)
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.total_bytes -= evicted_size
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+    def stats(self):
+        with self.lock:
+            total = self.num_hit + self.num_miss
+            return {'hit': self.num_hit, 'miss': self.num_miss, 'drop': self.num_drop,
+                    'hit_rate': self.num_hit / total if total > 0 else 0.0,
+                    'entries': len(self.entries),
+                    'mb': self.total_bytes / 1024 / 1024}
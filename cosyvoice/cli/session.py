@@ -0,0 +1,145 @@
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import threading
+from typing import Optional
+import torch
+from cosyvoice.cli.buffer_pool import BufferPool
+
+
+class TTSSession:
+    """ All state of one tts request, owned by this request only.
+
+    Speech tokens are written by the llm job into a preallocated int32 buffer and read
+    by the token2wav loop through views, token_offset is the cursor of tokens already
+    synthesized. The reader blocks in wait() until enough tokens arrive or the llm ends,
+    the writer only wakes it up when the requested length is reached.
+
+    cancel() or setting the optional cancel_event stops the llm job at its next step.
+
+    Chunk buffers taken by acquire() come from the model BufferPool and go back to it in
+    recycle() or at the latest in release().
+    """
+    __slots__ = ('uuid', 'token', 'num_token', 'token_offset', 'end', 'wait_len', 'cond',
+                 'cancel_flag', 'cancel_event', 'job', 'mel_overlap', 'flow_cache', 'chunk_cache',
+                 'hift_cache', 'prompt_cache', 'flow_kwargs', 'pool', 'buffers')
+
+    def __init__(self, uuid: str, capacity: int = 1024, cancel_event: Optional[threading.Event] = None, pool: Optional[BufferPool] = None):
+        self.uuid = uuid
+        self.token = torch.zeros(capacity, dtype=torch.int32)
+        self.num_token = 0
+        self.token_offset = 0
+        self.end = False
+        self.wait_len = float('inf')
+        self.cond = threading.Condition()
+        self.cancel_flag = False
+        self.cancel_event = cancel_event
+        # llm/vc job producing the tokens, a thread or a scheduler request, both support join()
+        self.job = None
+        # CosyVoiceModel streaming caches
+        self.mel_overlap = torch.zeros(1, 80, 0)
+        self.flow_cache = torch.zeros(1, 80, 0, 2)
+        # CosyVoice2Model streaming flow encoder/estimator caches, {} before the first chunk
+        self.chunk_cache = {}
+        self.hift_cache = None
+        # flow prompt conditioning, shared with other sessions of the same prompt through the model PromptCache
+        self.prompt_cache = None
+        # flow inference options of this request, e.g. n_timesteps and classifier free guidance
+        self.flow_kwargs = {}
+        self.pool = pool
+        self.buffers = []
+
+    def reserve(self, n):
+        # NOTE views returned by tokens() keep pointing to the old buffer, which is never modified again
+        if n > self.token.shape[0]:
+            token = torch.zeros(max(n, 2 * self.token.shape[0]), dtype=torch.int32)
+            token[:self.num_token] = self.token[:self.num_token]
+            self.token = token
+
+    def append(self, token):
+        with self.cond:
+            self.reserve(self.num_token + 1)
+            self.token[self.num_token] = token
+            self.num_token += 1
+            if self.num_token >= self.wait_len:
+                self.cond.notify()
+
+    def extend(self, tokens):
+        tokens = torch.as_tensor(tokens, dtype=torch.int32).flatten()
+        with self.cond:
+            self.reserve(self.num_token + tokens.shape[0])
+            self.token[self.num_token:self.num_token + tokens.shape[0]] = tokens
+            self.num_token += tokens.shape[0]
+            self.cond.notify()
+
+    def close(self):
+        with self.cond:
+            self.end = True
+            self.cond.notify()
+
+    @property
+    def cancelled(self):
+        return self.cancel_flag or (self.cancel_event is not None and self.cancel_event.is_set())
+
+    def cancel(self):
+        with self.cond:
+            self.cancel_flag = True
+            self.end = True
+            self.cond.notify()
+
+    def release(self):
+        """ Free token buffer and streaming caches, the session can not be used any more """
+        self.token = torch.zeros(0, dtype=torch.int32)
+        self.num_token, self.token_offset = 0, 0
+        self.mel_overlap, self.flow_cache, self.chunk_cache, self.hift_cache, self.prompt_cache = None, None, None, None, None
+        if self.pool is not None:
+            for _, buffer in self.buffers:
+                self.pool.recycle(buffer)
+        self.buffers = []
+
+    def acquire(self, shape, dtype=torch.float32, device=torch.device('cpu')):
+        """ Uninitialized chunk buffer of shape, owned by this session until recycled """
+        if self.pool is None:
+            return torch.empty(shape, dtype=dtype, device=device)
+        tensor, buffer = self.pool.acquire(shape, dtype, device)
+        self.buffers.append((tensor, buffer))
+        return tensor
+
+    def keep(self, tensor):
+        """ Copy tensor, usually a small view of a chunk, into a pooled buffer so the chunk can be freed """
+        return self.acquire(tensor.shape, tensor.dtype, tensor.device).copy_(tensor)
+
+    def recycle(self, *tensors):
+        """ Give buffers returned by acquire() back to the pool, tensors must not be used afterwards """
+        if self.pool is None:
+            return
+        buffers = []
+        for tensor, buffer in self.buffers:
+            if any(tensor is t for t in tensors):
+                self.pool.recycle(buffer)
+            else:
+                buffers.append((tensor, buffer))
+        self.buffers = buffers
+
+    def wait(self, n):
+        """ Block until n tokens are generated or llm ends, return True if n tokens are available """
+        with self.cond:
+            self.wait_len = n
+            self.cond.wait_for(lambda: self.num_token >= n or self.end)
+            self.wait_len = float('inf')
+            return self.num_token >= n
+
+    def tokens(self, start=0, end=None):
+        """ (1, T) int32 view of generated tokens, no copy """
+        end = self.num_token if end is None else min(end, self.num_token)
+        return self.token[start:end].unsqueeze(dim=0)
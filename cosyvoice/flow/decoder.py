@@ -11,13 +11,12 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-from typing import Tuple
+from typing import Optional, Tuple
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from einops import pack, rearrange, repeat
-from cosyvoice.utils.common import mask_to_bias
-from cosyvoice.utils.mask import add_optional_chunk_mask
+from cosyvoice.utils.mask import subsequent_chunk_mask
 from matcha.models.components.decoder import SinusoidalPosEmb, Block1D, ResnetBlock1D, Downsample1D, TimestepEmbedding, Upsample1D
 from matcha.models.components.transformer import BasicTransformerBlock
 
@@ -61,6 +60,16 @@ class CausalConv1d(torch.nn.Conv1d):
         x = super(CausalConv1d, self).forward(x)
         return x
 
+    def forward_chunk(self, x: torch.Tensor, cache: Optional[torch.Tensor] = None) -> Tuple[torch.Tensor, torch.Tensor]:
+        # cache: last causal_padding inputs of previous chunk, None for the first chunk
+        if cache is None:
+            x = F.pad(x, (self.causal_padding, 0), value=0.0)
+        else:
+            x = torch.concat([cache, x], dim=2)
+        new_cache = x[:, :, x.size(2) - self.causal_padding:]
+        x = super(CausalConv1d, self).forward(x)
+        return x, new_cache
+
 
 class CausalBlock1D(Block1D):
     def __init__(self, dim: int, dim_out: int):
@@ -77,6 +86,11 @@ class CausalBlock1D(Block1D):
         output = self.block(x * mask)
         return output * mask
 
+    def forward_chunk(self, x: torch.Tensor, mask: torch.Tensor, cache: Optional[torch.Tensor] = None) -> Tuple[torch.Tensor, torch.Tensor]:
+        output, new_cache = self.block[0].forward_chunk(x * mask, cache)
+        output = self.block[1:](output)
+        return output * mask, new_cache
+
 
 class CausalResnetBlock1D(ResnetBlock1D):
     def __init__(self, dim: int, dim_out: int, time_emb_dim: int, groups: int = 8):
@@ -84,6 +98,83 @@ class CausalResnetBlock1D(ResnetBlock1D):
         self.block1 = CausalBlock1D(dim, dim_out)
         self.block2 = CausalBlock1D(dim_out, dim_out)
 
+    def forward_chunk(self, x: torch.Tensor, mask: torch.Tensor, time_emb: torch.Tensor,
+                      cache: Optional[Tuple[torch.Tensor, torch.Tensor]] = None) -> Tuple[torch.Tensor, Tuple[torch.Tensor, torch.Tensor]]:
+        cache1, cache2 = cache if cache is not None else (None, None)
+        h, cache1 = self.block1.forward_chunk(x, mask, cache1)
+        h += self.mlp(time_emb).unsqueeze(-1)
+        h, cache2 = self.block2.forward_chunk(h, mask, cache2)
+        output = h + self.res_conv(x * mask)
+        return output, (cache1, cache2)
+
+
+class SDPABasicTransformerBlock(BasicTransformerBlock):
+    """BasicTransformerBlock whose self attention also runs with F.scaled_dot_product_attention
+    on a key padding mask or a chunk structure, without a time x time additive bias."""
+
+    def attention(self, query: torch.Tensor, key: torch.Tensor, value: torch.Tensor,
+                  attn_mask: Optional[torch.Tensor] = None) -> torch.Tensor:
+        """ (batch, time, inner_dim) projections to attention output, attn_mask is bool (batch, 1 or time, key time) """
+        attn = self.attn1
+        batch_size, head_dim = query.size(0), query.size(2) // attn.heads
+        query = query.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+        key = key.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+        value = value.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+        attn_output = F.scaled_dot_product_attention(query, key, value, attn_mask=attn_mask.unsqueeze(1) if attn_mask is not None else None)
+        return attn_output.transpose(1, 2).reshape(batch_size, -1, attn.heads * head_dim).to(query.dtype)
+
+    def forward_sdpa(self, hidden_states: torch.Tensor, key_padding_mask: Optional[torch.Tensor] = None, chunk_size: int = 0) -> torch.Tensor:
+        """Same as forward() with a bias of key_padding_mask (and chunk mask).
+
+        Args:
+            hidden_states: (batch, time, dim)
+            key_padding_mask: bool (batch, 1, time), False for padded frames
+            chunk_size: > 0 for chunk causal attention, frames of a chunk attend to this and all previous chunks
+        Returns:
+            hidden_states (batch, time, dim)
+        """
+        assert self.use_ada_layer_norm is False and self.use_ada_layer_norm_zero is False and self.attn2 is None
+        attn = self.attn1
+        norm_hidden_states = self.norm1(hidden_states)
+        query, key, value = attn.to_q(norm_hidden_states), attn.to_k(norm_hidden_states), attn.to_v(norm_hidden_states)
+        if chunk_size <= 0:
+            attn_output = self.attention(query, key, value, key_padding_mask)
+        else:
+            # NOTE one call per query chunk over the keys up to its end, no time x time chunk mask
+            attn_output = torch.concat([self.attention(query[:, i:i + chunk_size], key[:, :i + chunk_size], value[:, :i + chunk_size],
+                                                       key_padding_mask[:, :, :i + chunk_size] if key_padding_mask is not None else None)
+                                        for i in range(0, hidden_states.size(1), chunk_size)], dim=1)
+        hidden_states = attn.to_out[1](attn.to_out[0](attn_output)) + hidden_states
+        return self.ff(self.norm3(hidden_states)) + hidden_states
+
+
+class CausalBasicTransformerBlock(SDPABasicTransformerBlock):
+    def forward_chunk(self, hidden_states: torch.Tensor, attention_mask: torch.Tensor,
+                      cache: Optional[torch.Tensor] = None) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Self attention of new frames over cached and new frames.
+
+        Args:
+            hidden_states: new frames (batch, time, dim)
+            attention_mask: bool (1, time, cache_t + time)
+            cache: key and value of previous frames (batch, cache_t, inner_dim * 2), None for the first chunk
+        Returns:
+            hidden_states (batch, time, dim) and cache (batch, cache_t + time, inner_dim * 2)
+        """
+        assert self.use_ada_layer_norm is False and self.use_ada_layer_norm_zero is False and self.attn2 is None
+        attn = self.attn1
+        norm_hidden_states = self.norm1(hidden_states)
+        query = attn.to_q(norm_hidden_states)
+        new_cache = torch.concat([attn.to_k(norm_hidden_states), attn.to_v(norm_hidden_states)], dim=2)
+        if cache is not None:
+            new_cache = torch.concat([cache, new_cache], dim=1)
+        key, value = new_cache.chunk(2, dim=2)
+        attn_output = self.attention(query, key, value, attention_mask)
+        attn_output = attn.to_out[1](attn.to_out[0](attn_output))
+        hidden_states = attn_output + hidden_states
+
+        hidden_states = self.ff(self.norm3(hidden_states)) + hidden_states
+        return hidden_states, new_cache
+
 
 class ConditionalDecoder(nn.Module):
     def __init__(
@@ -126,7 +217,7 @@ class ConditionalDecoder(nn.Module):
             resnet = ResnetBlock1D(dim=input_channel, dim_out=output_channel, time_emb_dim=time_embed_dim)
             transformer_blocks = nn.ModuleList(
                 [
-                    BasicTransformerBlock(
+                    SDPABasicTransformerBlock(
                         dim=output_channel,
                         num_attention_heads=num_heads,
                         attention_head_dim=attention_head_dim,
@@ -148,7 +239,7 @@ class ConditionalDecoder(nn.Module):
 
             transformer_blocks = nn.ModuleList(
                 [
-                    BasicTransformerBlock(
+                    SDPABasicTransformerBlock(
                         dim=output_channel,
                         num_attention_heads=num_heads,
                         attention_head_dim=attention_head_dim,
@@ -173,7 +264,7 @@ class ConditionalDecoder(nn.Module):
             )
             transformer_blocks = nn.ModuleList(
                 [
-                    BasicTransformerBlock(
+                    SDPABasicTransformerBlock(
                         dim=output_channel,
                         num_attention_heads=num_heads,
                         attention_head_dim=attention_head_dim,
@@ -224,71 +315,82 @@ class ConditionalDecoder(nn.Module):
         Returns:
             _type_: _description_
         """
+        context = self.prepare(mask, mu, spks, cond, streaming=streaming)
+        return self.forward_prepared(x, self.time_embedding(t), context)
 
+    def time_embedding(self, t):
         t = self.time_embeddings(t).to(t.dtype)
-        t = self.time_mlp(t)
+        return self.time_mlp(t)
 
-        x = pack([x, mu], "b * t")[0]
+    def attention_mask(self, mask, streaming=False):
+        """ Key padding mask and chunk size of SDPABasicTransformerBlock.forward_sdpa() """
+        return mask.bool(), 0
+
+    def prepare(self, mask, mu, spks=None, cond=None, streaming=False):
+        """Inputs of forward_prepared() which do not change between ode steps.
+
+        Packs [mu, spks, cond] and builds the mask and attention bias of every resolution, so an
+        ode solver runs it once per utterance instead of once per step. Time embeddings of all
+        steps can be computed at once with time_embedding().
 
+        Returns:
+            dict: 'cond' (batch_size, condition_channels, time), 'masks' and 'attn_masks' per resolution
+        """
+        x = mu
         if spks is not None:
             spks = repeat(spks, "b c -> b c t", t=x.shape[-1])
             x = pack([x, spks], "b * t")[0]
         if cond is not None:
             x = pack([x, cond], "b * t")[0]
-
-        hiddens = []
         masks = [mask]
-        for resnet, transformer_blocks, downsample in self.down_blocks:
-            mask_down = masks[-1]
-            x = resnet(x, mask_down, t)
+        for _ in range(len(self.down_blocks) - 1):
+            masks.append(masks[-1][:, :, ::2])
+        return {'cond': x, 'masks': masks, 'attn_masks': [self.attention_mask(m, streaming) for m in masks]}
+
+    def forward_prepared(self, x, t, context):
+        """Forward pass with the context of prepare().
+
+        Args:
+            x (torch.Tensor): shape (batch_size, in_channels, time), batch_size may be smaller than that of context
+            t (torch.Tensor): time embedding, shape (batch_size, time_embed_dim)
+            context (dict): returned by prepare()
+        """
+        batch_size = x.size(0)
+        masks = [m[:batch_size] for m in context['masks']]
+        attn_masks = context['attn_masks']
+
+        def run_transformer_blocks(transformer_blocks, x, level):
             x = rearrange(x, "b c t -> b t c").contiguous()
-            attn_mask = add_optional_chunk_mask(x, mask_down.bool(), False, False, 0, 0, -1).repeat(1, x.size(1), 1)
-            attn_mask = mask_to_bias(attn_mask, x.dtype)
+            key_padding_mask, chunk_size = attn_masks[level]
             for transformer_block in transformer_blocks:
-                x = transformer_block(
-                    hidden_states=x,
-                    attention_mask=attn_mask,
-                    timestep=t,
-                )
-            x = rearrange(x, "b t c -> b c t").contiguous()
+                x = transformer_block.forward_sdpa(x, key_padding_mask[:batch_size], chunk_size)
+            return rearrange(x, "b t c -> b c t").contiguous()
+
+        x = pack([x, context['cond'][:batch_size]], "b * t")[0]
+
+        hiddens = []
+        for level, (resnet, transformer_blocks, downsample) in enumerate(self.down_blocks):
+            mask_down = masks[level]
+            x = resnet(x, mask_down, t)
+            x = run_transformer_blocks(transformer_blocks, x, level)
             hiddens.append(x)  # Save hidden states for skip connections
             x = downsample(x * mask_down)
-            masks.append(mask_down[:, :, ::2])
-        masks = masks[:-1]
         mask_mid = masks[-1]
 
         for resnet, transformer_blocks in self.mid_blocks:
             x = resnet(x, mask_mid, t)
-            x = rearrange(x, "b c t -> b t c").contiguous()
-            attn_mask = add_optional_chunk_mask(x, mask_mid.bool(), False, False, 0, 0, -1).repeat(1, x.size(1), 1)
-            attn_mask = mask_to_bias(attn_mask, x.dtype)
-            for transformer_block in transformer_blocks:
-                x = transformer_block(
-                    hidden_states=x,
-                    attention_mask=attn_mask,
-                    timestep=t,
-                )
-            x = rearrange(x, "b t c -> b c t").contiguous()
+            x = run_transformer_blocks(transformer_blocks, x, len(masks) - 1)
 
-        for resnet, transformer_blocks, upsample in self.up_blocks:
-            mask_up = masks.pop()
+        for level, (resnet, transformer_blocks, upsample) in zip(reversed(range(len(masks))), self.up_blocks):
+            mask_up = masks[level]
             skip = hiddens.pop()
             x = pack([x[:, :, :skip.shape[-1]], skip], "b * t")[0]
             x = resnet(x, mask_up, t)
-            x = rearrange(x, "b c t -> b t c").contiguous()
-            attn_mask = add_optional_chunk_mask(x, mask_up.bool(), False, False, 0, 0, -1).repeat(1, x.size(1), 1)
-            attn_mask = mask_to_bias(attn_mask, x.dtype)
-            for transformer_block in transformer_blocks:
-                x = transformer_block(
-                    hidden_states=x,
-                    attention_mask=attn_mask,
-                    timestep=t,
-                )
-            x = rearrange(x, "b t c -> b c t").contiguous()
+            x = run_transformer_blocks(transformer_blocks, x, level)
             x = upsample(x * mask_up)
         x = self.final_block(x, mask_up)
         output = self.final_proj(x * mask_up)
-        return output * mask
+        return output * masks[0]
 
 
 class CausalConditionalDecoder(ConditionalDecoder):
@@ -335,7 +437,7 @@ class CausalConditionalDecoder(ConditionalDecoder):
             resnet = CausalResnetBlock1D(dim=input_channel, dim_out=output_channel, time_emb_dim=time_embed_dim)
             transformer_blocks = nn.ModuleList(
                 [
-                    BasicTransformerBlock(
+                    CausalBasicTransformerBlock(
                         dim=output_channel,
                         num_attention_heads=num_heads,
                         attention_head_dim=attention_head_dim,
@@ -357,7 +459,7 @@ class CausalConditionalDecoder(ConditionalDecoder):
 
             transformer_blocks = nn.ModuleList(
                 [
-                    BasicTransformerBlock(
+                    CausalBasicTransformerBlock(
                         dim=output_channel,
                         num_attention_heads=num_heads,
                         attention_head_dim=attention_head_dim,
@@ -382,7 +484,7 @@ class CausalConditionalDecoder(ConditionalDecoder):
             )
             transformer_blocks = nn.ModuleList(
                 [
-                    BasicTransformerBlock(
+                    CausalBasicTransformerBlock(
                         dim=output_channel,
                         num_attention_heads=num_heads,
                         attention_head_dim=attention_head_dim,
@@ -402,93 +504,83 @@ class CausalConditionalDecoder(ConditionalDecoder):
         self.final_proj = nn.Conv1d(channels[-1], self.out_channels, 1)
         self.initialize_weights()
 
-    def forward(self, x, mask, mu, t, spks=None, cond=None, streaming=False):
-        """Forward pass of the UNet1DConditional model.
+    def attention_mask(self, mask, streaming=False):
+        return mask.bool(), self.static_chunk_size if streaming is True else 0
 
-        Args:
-            x (torch.Tensor): shape (batch_size, in_channels, time)
-            mask (_type_): shape (batch_size, 1, time)
-            t (_type_): shape (batch_size)
-            spks (_type_, optional): shape: (batch_size, condition_channels). Defaults to None.
-            cond (_type_, optional): placeholder for future use. Defaults to None.
+    def forward_chunk(self, x, mu, t, spks, cond, cache=None, prompt_len=0):
+        """Streaming forward of new frames only, carrying conv and attention caches across chunks.
 
-        Raises:
-            ValueError: _description_
-            ValueError: _description_
+        Every chunk must start at a multiple of static_chunk_size, then the output equals
+        the new frames of forward(all frames, streaming=True) as long as the attention cache is
+        not truncated. With num_decoding_left_chunks >= 0, only the first prompt_len frames and
+        the last num_decoding_left_chunks chunks are kept in the attention cache, so the cost
+        of a chunk does not grow with the utterance length.
+
+        Args:
+            x (torch.Tensor): shape (batch_size, in_channels, time), new frames without padding
+            t (torch.Tensor): shape (batch_size)
+            cache (list): returned by previous forward_chunk, None for the first chunk
+            prompt_len (int): number of prompt frames at the start of the first chunk
 
         Returns:
-            _type_: _description_
+            output (batch_size, out_channels, time) and cache for next chunk
         """
-        t = self.time_embeddings(t).to(t.dtype)
-        t = self.time_mlp(t)
+        assert len(self.down_blocks) == 1, 'Downsample1D is not causal, forward_chunk only supports one down block'
+        t = self.time_embedding(t)
 
         x = pack([x, mu], "b * t")[0]
-
         if spks is not None:
             spks = repeat(spks, "b c -> b c t", t=x.shape[-1])
             x = pack([x, spks], "b * t")[0]
         if cond is not None:
             x = pack([x, cond], "b * t")[0]
 
-        hiddens = []
-        masks = [mask]
-        for resnet, transformer_blocks, downsample in self.down_blocks:
-            mask_down = masks[-1]
-            x = resnet(x, mask_down, t)
+        mask = torch.ones(x.size(0), 1, x.size(2), device=x.device, dtype=x.dtype)
+        cache = iter(cache) if cache is not None else None
+        new_cache = []
+
+        def run_resnet(resnet, x):
+            x, resnet_cache = resnet.forward_chunk(x, mask, t, next(cache) if cache is not None else None)
+            new_cache.append(resnet_cache)
+            return x
+
+        def run_transformer_blocks(transformer_blocks, x):
             x = rearrange(x, "b c t -> b t c").contiguous()
-            if streaming is True:
-                attn_mask = add_optional_chunk_mask(x, mask_down.bool(), False, False, 0, self.static_chunk_size, -1)
-            else:
-                attn_mask = add_optional_chunk_mask(x, mask_down.bool(), False, False, 0, 0, -1).repeat(1, x.size(1), 1)
-            attn_mask = mask_to_bias(attn_mask, x.dtype)
             for transformer_block in transformer_blocks:
-                x = transformer_block(
-                    hidden_states=x,
-                    attention_mask=attn_mask,
-                    timestep=t,
-                )
-            x = rearrange(x, "b t c -> b c t").contiguous()
+                block_cache = next(cache) if cache is not None else None
+                cache_len = block_cache.size(1) if block_cache is not None else 0
+                attn_mask = torch.concat([torch.ones(x.size(1), cache_len, dtype=torch.bool, device=x.device),
+                                          subsequent_chunk_mask(x.size(1), self.static_chunk_size, device=x.device)], dim=1)
+                x, block_cache = transformer_block.forward_chunk(x, attn_mask.unsqueeze(0), block_cache)
+                if self.num_decoding_left_chunks >= 0 and block_cache.size(1) > prompt_len + self.num_decoding_left_chunks * self.static_chunk_size:
+                    block_cache = torch.concat([block_cache[:, :prompt_len],
+                                                block_cache[:, block_cache.size(1) - self.num_decoding_left_chunks * self.static_chunk_size:]], dim=1)
+                new_cache.append(block_cache)
+            return rearrange(x, "b t c -> b c t").contiguous()
+
+        def run_conv(conv, x):
+            x, conv_cache = conv.forward_chunk(x, next(cache) if cache is not None else None)
+            new_cache.append(conv_cache)
+            return x
+
+        hiddens = []
+        for resnet, transformer_blocks, downsample in self.down_blocks:
+            x = run_resnet(resnet, x)
+            x = run_transformer_blocks(transformer_blocks, x)
             hiddens.append(x)  # Save hidden states for skip connections
-            x = downsample(x * mask_down)
-            masks.append(mask_down[:, :, ::2])
-        masks = masks[:-1]
-        mask_mid = masks[-1]
+            x = run_conv(downsample, x)
 
         for resnet, transformer_blocks in self.mid_blocks:
-            x = resnet(x, mask_mid, t)
-            x = rearrange(x, "b c t -> b t c").contiguous()
-            if streaming is True:
-                attn_mask = add_optional_chunk_mask(x, mask_mid.bool(), False, False, 0, self.static_chunk_size, -1)
-            else:
-                attn_mask = add_optional_chunk_mask(x, mask_mid.bool(), False, False, 0, 0, -1).repeat(1, x.size(1), 1)
-            attn_mask = mask_to_bias(attn_mask, x.dtype)
-            for transformer_block in transformer_blocks:
-                x = transformer_block(
-                    hidden_states=x,
-                    attention_mask=attn_mask,
-                    timestep=t,
-                )
-            x = rearrange(x, "b t c -> b c t").contiguous()
+            x = run_resnet(resnet, x)
+            x = run_transformer_blocks(transformer_blocks, x)
 
         for resnet, transformer_blocks, upsample in self.up_blocks:
-            mask_up = masks.pop()
             skip = hiddens.pop()
             x = pack([x[:, :, :skip.shape[-1]], skip], "b * t")[0]
-            x = resnet(x, mask_up, t)
-            x = rearrange(x, "b c t -> b t c").contiguous()
-            if streaming is True:
-                attn_mask = add_optional_chunk_mask(x, mask_up.bool(), False, False, 0, self.static_chunk_size, -1)
-            else:
-                attn_mask = add_optional_chunk_mask(x, mask_up.bool(), False, False, 0, 0, -1).repeat(1, x.size(1), 1)
-            attn_mask = mask_to_bias(attn_mask, x.dtype)
-            for transformer_block in transformer_blocks:
-                x = transformer_block(
-                    hidden_states=x,
-                    attention_mask=attn_mask,
-                    timestep=t,
-                )
-            x = rearrange(x, "b t c -> b c t").contiguous()
-            x = upsample(x * mask_up)
-        x = self.final_block(x, mask_up)
-        output = self.final_proj(x * mask_up)
-        return output * mask
+            x = run_resnet(resnet, x)
+            x = run_transformer_blocks(transformer_blocks, x)
+            x = run_conv(upsample, x)
+        x, final_cache = self.final_block.forward_chunk(x, mask, next(cache) if cache is not None else None)
+        new_cache.append(final_cache)
+        output = self.final_proj(x)
+        return output, new_cache
@@ -21,6 +21,15 @@ from omegaconf import DictConfig
 from cosyvoice.utils.mask import make_pad_mask
 
 
+def pad_frames(xs):
+    """ Right pad (1, C, T_i) tensors to (B, C, T_max), mask (B, 1, T_max) marks real frames """
+    lengths = torch.tensor([x.size(2) for x in xs])
+    padded = xs[0].new_zeros(len(xs), xs[0].size(1), int(lengths.max()))
+    for i, x in enumerate(xs):
+        padded[i, :, :x.size(2)] = x[0]
+    return padded, (~make_pad_mask(lengths)).unsqueeze(1).to(padded)
+
+
 class MaskedDiffWithXvec(torch.nn.Module):
     def __init__(self,
                  input_size: int = 512,
@@ -101,6 +110,15 @@ class MaskedDiffWithXvec(torch.nn.Module):
         )
         return {'loss': loss}
 
+    @torch.inference_mode()
+    def prompt_condition(self, prompt_token, prompt_feat, embedding):
+        """ Conditioning which only depends on the prompt, pass it to inference() as prompt_cache.
+
+        The encoder attends to prompt and new tokens together, so only the xvec projection is kept.
+        """
+        embedding = F.normalize(embedding, dim=1)
+        return {'embedding': self.spk_embed_affine_layer(embedding)}
+
     @torch.inference_mode()
     def inference(self,
                   token,
@@ -110,11 +128,80 @@ class MaskedDiffWithXvec(torch.nn.Module):
                   prompt_feat,
                   prompt_feat_len,
                   embedding,
-                  flow_cache):
+                  flow_cache,
+                  prompt_cache=None,
+                  n_timesteps=10,
+                  inference_cfg_rate=None,
+                  cfg_end=1.0):
         assert token.shape[0] == 1
+        embedding, h, conds = self.encode(token, token_len, prompt_token, prompt_token_len, prompt_feat, embedding, prompt_cache)
+        mel_len1 = prompt_feat.shape[1]
+
+        mask = (~make_pad_mask(torch.tensor([h.shape[1]]))).to(h)
+        feat, flow_cache = self.decoder(
+            mu=h.transpose(1, 2).contiguous(),
+            mask=mask.unsqueeze(1),
+            spks=embedding,
+            cond=conds,
+            n_timesteps=n_timesteps,
+            inference_cfg_rate=inference_cfg_rate,
+            cfg_end=cfg_end,
+            prompt_len=mel_len1,
+            cache=flow_cache
+        )
+        feat = feat[:, :, mel_len1:]
+        return feat.float(), flow_cache
+
+    @torch.inference_mode()
+    def inference_batch(self, requests, n_timesteps=10, inference_cfg_rate=None, cfg_end=1.0):
+        """ inference() of several requests with shared ode solves, every estimator step runs a group of them at once.
+
+        NOTE GroupNorm of the decoder normalizes over padded frames too, so only requests with
+        the same number of mel frames, e.g. streaming chunks of sessions with the same prompt,
+        are grouped into one solve.
+
+        Args:
+            requests (list): inference() keyword arguments of every request, without n_timesteps,
+                inference_cfg_rate and cfg_end, which are shared by the batch
+
+        Returns:
+            list of (feat, flow_cache) of every request, the same as inference() returns
+        """
+        assert len(requests) == 1 or isinstance(self.decoder.estimator, torch.nn.Module), 'trt estimator only supports batch 1!'
+        embeddings, mus, zs, conds, caches = [], [], [], [], []
+        for r in requests:
+            assert r['token'].shape[0] == 1
+            embedding, h, cond = self.encode(r['token'], r['token_len'], r['prompt_token'], r['prompt_token_len'], r['prompt_feat'],
+                                             r['embedding'], r.get('prompt_cache'))
+            mu = h.transpose(1, 2).contiguous()
+            z, cache = self.decoder.prior(mu, prompt_len=r['prompt_feat'].shape[1], cache=r['flow_cache'])
+            embeddings.append(embedding)
+            mus.append(mu)
+            zs.append(z)
+            conds.append(cond)
+            caches.append(cache)
+        groups = {}
+        for i, mu in enumerate(mus):
+            groups.setdefault(mu.shape[2], []).append(i)
+        feats = [None] * len(requests)
+        for group in groups.values():
+            mu = torch.concat([mus[i] for i in group], dim=0)
+            mask = torch.ones(len(group), 1, mu.shape[2], device=mu.device, dtype=mu.dtype)
+            feat = self.decoder.solve(torch.concat([zs[i] for i in group], dim=0), self.decoder.time_span(n_timesteps, mu.dtype), mu, mask,
+                                      torch.concat([embeddings[i] for i in group], dim=0), torch.concat([conds[i] for i in group], dim=0),
+                                      inference_cfg_rate=inference_cfg_rate, cfg_end=cfg_end)
+            for j, i in enumerate(group):
+                feats[i] = feat[j:j + 1, :, requests[i]['prompt_feat'].shape[1]:].float()
+        return list(zip(feats, caches))
+
+    def encode(self, token, token_len, prompt_token, prompt_token_len, prompt_feat, embedding, prompt_cache=None):
+        """ Projected speaker embedding, length regulated encoder output h (1, T, C) and conds (1, C, T) of one request """
         # xvec projection
-        embedding = F.normalize(embedding, dim=1)
-        embedding = self.spk_embed_affine_layer(embedding)
+        if prompt_cache is not None:
+            embedding = prompt_cache['embedding']
+        else:
+            embedding = F.normalize(embedding, dim=1)
+            embedding = self.spk_embed_affine_layer(embedding)
 
         # concat speech token and prompt speech token
         token_len1, token_len2 = prompt_token.shape[1], token.shape[1]
@@ -127,25 +214,12 @@ class MaskedDiffWithXvec(torch.nn.Module):
         h = self.encoder_proj(h)
         mel_len1, mel_len2 = prompt_feat.shape[1], int(token_len2 / self.input_frame_rate * 22050 / 256)
         h, h_lengths = self.length_regulator.inference(h[:, :token_len1], h[:, token_len1:], mel_len1, mel_len2, self.input_frame_rate)
+        assert h.shape[1] == mel_len1 + mel_len2
 
         # get conditions
         conds = torch.zeros([1, mel_len1 + mel_len2, self.output_size], device=token.device).to(h.dtype)
         conds[:, :mel_len1] = prompt_feat
-        conds = conds.transpose(1, 2)
-
-        mask = (~make_pad_mask(torch.tensor([mel_len1 + mel_len2]))).to(h)
-        feat, flow_cache = self.decoder(
-            mu=h.transpose(1, 2).contiguous(),
-            mask=mask.unsqueeze(1),
-            spks=embedding,
-            cond=conds,
-            n_timesteps=10,
-            prompt_len=mel_len1,
-            cache=flow_cache
-        )
-        feat = feat[:, :, mel_len1:]
-        assert feat.shape[2] == mel_len2
-        return feat.float(), flow_cache
+        return embedding, h, conds.transpose(1, 2)
 
 
 class CausalMaskedDiffWithXvec(torch.nn.Module):
@@ -232,6 +306,40 @@ class CausalMaskedDiffWithXvec(torch.nn.Module):
         )
         return {'loss': loss}
 
+    @torch.inference_mode()
+    def prompt_condition(self, prompt_token, prompt_feat, embedding, streaming=False, cache_estimator=False, n_timesteps=10,
+                         inference_cfg_rate=None, cfg_end=1.0):
+        """ Conditioning which only depends on the prompt, pass it to inference() as prompt_cache.
+
+        Besides the xvec projection, streaming keeps the chunk_cache of the leading prompt chunks,
+        chunk masks and causal convs make them independent of the tokens after them, so the
+        first chunk of every request with this prompt starts right after them.
+        """
+        embedding = F.normalize(embedding, dim=1)
+        embedding = self.spk_embed_affine_layer(embedding)
+        prompt_cache = {'embedding': embedding}
+        if streaming is False or not hasattr(self.encoder, 'forward_chunk'):
+            return prompt_cache
+        # whole chunks whose lookahead tokens are still prompt tokens
+        num_token = (prompt_token.shape[1] - self.pre_lookahead_len) // self.encoder.static_chunk_size * self.encoder.static_chunk_size
+        if num_token <= 0:
+            return prompt_cache
+        token = self.input_embedding(torch.clamp(prompt_token[:, :num_token + self.pre_lookahead_len], min=0))
+        h, encoder_cache = self.encoder.forward_chunk(token[:, :num_token], token[:, num_token:])
+        h = self.encoder_proj(h)
+        prompt_cache['chunk'] = {'encoder': encoder_cache, 'h': h}
+        if cache_estimator is True:
+            _, prompt_cache['chunk']['decoder'] = self.decoder.forward_chunk(
+                mu=h.transpose(1, 2).contiguous(),
+                n_timesteps=n_timesteps,
+                inference_cfg_rate=inference_cfg_rate,
+                cfg_end=cfg_end,
+                spks=embedding,
+                cond=prompt_feat[:, :h.shape[1]].transpose(1, 2).to(h.dtype),
+                prompt_len=prompt_feat.shape[1]
+            )
+        return prompt_cache
+
     @torch.inference_mode()
     def inference(self,
                   token,
@@ -242,28 +350,36 @@ class CausalMaskedDiffWithXvec(torch.nn.Module):
                   prompt_feat_len,
                   embedding,
                   streaming,
-                  finalize):
+                  finalize,
+                  chunk_cache=None,
+                  cache_estimator=False,
+                  prompt_cache=None,
+                  n_timesteps=10,
+                  inference_cfg_rate=None,
+                  cfg_end=1.0):
         assert token.shape[0] == 1
-        # xvec projection
-        embedding = F.normalize(embedding, dim=1)
-        embedding = self.spk_embed_affine_layer(embedding)
-
-        # concat text and prompt_text
-        token, token_len = torch.concat([prompt_token, token], dim=1), prompt_token_len + token_len
-        mask = (~make_pad_mask(token_len)).unsqueeze(-1).to(embedding)
-        token = self.input_embedding(torch.clamp(token, min=0)) * mask
-
-        # text encode
-        if finalize is True:
-            h, h_lengths = self.encoder(token, token_len, streaming=streaming)
-        else:
-            token, context = token[:, :-self.pre_lookahead_len], token[:, -self.pre_lookahead_len:]
-            h, h_lengths = self.encoder(token, token_len, context=context, streaming=streaming)
+        embedding, h = self.encode(token, token_len, prompt_token, prompt_token_len, embedding, streaming, finalize, chunk_cache, prompt_cache)
         mel_len1, mel_len2 = prompt_feat.shape[1], h.shape[1] - prompt_feat.shape[1]
-        h = self.encoder_proj(h)
+
+        if cache_estimator is True and streaming is True and finalize is False and chunk_cache is not None:
+            # NOTE only decode frames after the cached ones and return their mel, prompt frames are all in the first chunk
+            offset = chunk_cache['decoder']['offset'] if 'decoder' in chunk_cache else 0
+            conds = torch.zeros([1, h.shape[1] - offset, self.output_size], device=h.device).to(h.dtype)
+            conds[:, :max(mel_len1 - offset, 0)] = prompt_feat[:, offset:]
+            feat, chunk_cache['decoder'] = self.decoder.forward_chunk(
+                mu=h[:, offset:].transpose(1, 2).contiguous(),
+                n_timesteps=n_timesteps,
+                inference_cfg_rate=inference_cfg_rate,
+                cfg_end=cfg_end,
+                spks=embedding,
+                cond=conds.transpose(1, 2),
+                cache=chunk_cache.get('decoder'),
+                prompt_len=mel_len1
+            )
+            return feat[:, :, max(mel_len1 - offset, 0):], chunk_cache
 
         # get conditions
-        conds = torch.zeros([1, mel_len1 + mel_len2, self.output_size], device=token.device).to(h.dtype)
+        conds = torch.zeros([1, mel_len1 + mel_len2, self.output_size], device=h.device).to(h.dtype)
         conds[:, :mel_len1] = prompt_feat
         conds = conds.transpose(1, 2)
 
@@ -273,9 +389,87 @@ class CausalMaskedDiffWithXvec(torch.nn.Module):
             mask=mask.unsqueeze(1),
             spks=embedding,
             cond=conds,
-            n_timesteps=10,
+            n_timesteps=n_timesteps,
+            inference_cfg_rate=inference_cfg_rate,
+            cfg_end=cfg_end,
             streaming=streaming
         )
         feat = feat[:, :, mel_len1:]
         assert feat.shape[2] == mel_len2
-        return feat.float(), None
+        return feat.float(), chunk_cache
+
+    @torch.inference_mode()
+    def inference_batch(self, requests, n_timesteps=10, inference_cfg_rate=None, cfg_end=1.0):
+        """ inference() of several requests in one ode solve, every estimator step runs all of them at once.
+
+        Requests may be streaming chunks of different sessions, but all of them streaming or none,
+        and without estimator cache. Encoders still run request by request.
+
+        Args:
+            requests (list): inference() keyword arguments of every request, without n_timesteps,
+                inference_cfg_rate and cfg_end, which are shared by the batch
+
+        Returns:
+            list of (feat, chunk_cache) of every request, the same as inference() returns
+        """
+        assert len(requests) == 1 or isinstance(self.decoder.estimator, torch.nn.Module), 'trt estimator only supports batch 1!'
+        streaming = requests[0]['streaming']
+        assert all(r['streaming'] == streaming for r in requests), 'requests of a batch should be all streaming or all non streaming!'
+        assert all(r.get('cache_estimator', False) is False for r in requests), 'inference_batch does not support estimator cache!'
+        embeddings, mus, conds = [], [], []
+        for r in requests:
+            assert r['token'].shape[0] == 1
+            embedding, h = self.encode(r['token'], r['token_len'], r['prompt_token'], r['prompt_token_len'], r['embedding'],
+                                       streaming, r['finalize'], r.get('chunk_cache'), r.get('prompt_cache'))
+            cond = torch.zeros([1, self.output_size, h.shape[1]], device=h.device).to(h.dtype)
+            cond[:, :, :r['prompt_feat'].shape[1]] = r['prompt_feat'].transpose(1, 2)
+            embeddings.append(embedding)
+            mus.append(h.transpose(1, 2).contiguous())
+            conds.append(cond)
+        mu, mask = pad_frames(mus)
+        feat, _ = self.decoder(
+            mu=mu,
+            mask=mask,
+            spks=torch.concat(embeddings, dim=0),
+            cond=pad_frames(conds)[0],
+            n_timesteps=n_timesteps,
+            inference_cfg_rate=inference_cfg_rate,
+            cfg_end=cfg_end,
+            streaming=streaming
+        )
+        return [(feat[i:i + 1, :, r['prompt_feat'].shape[1]:mus[i].shape[2]].float(), r.get('chunk_cache')) for i, r in enumerate(requests)]
+
+    def encode(self, token, token_len, prompt_token, prompt_token_len, embedding, streaming, finalize, chunk_cache=None, prompt_cache=None):
+        """ Projected speaker embedding and encoder output h (1, T, C) of prompt and tokens of one request """
+        # xvec projection
+        if prompt_cache is not None:
+            embedding = prompt_cache['embedding']
+        else:
+            embedding = F.normalize(embedding, dim=1)
+            embedding = self.spk_embed_affine_layer(embedding)
+
+        # concat text and prompt_text
+        token, token_len = torch.concat([prompt_token, token], dim=1), prompt_token_len + token_len
+        mask = (~make_pad_mask(token_len)).unsqueeze(-1).to(embedding)
+        token = self.input_embedding(torch.clamp(token, min=0)) * mask
+
+        # text encode
+        if finalize is True:
+            h, h_lengths = self.encoder(token, token_len, streaming=streaming)
+            h = self.encoder_proj(h)
+        elif streaming is True and chunk_cache is not None and hasattr(self.encoder, 'forward_chunk'):
+            # NOTE only encode tokens after the cached ones, chunk_cache is {} for the first chunk
+            if len(chunk_cache) == 0 and prompt_cache is not None and 'chunk' in prompt_cache:
+                chunk_cache.update(prompt_cache['chunk'])
+            offset = chunk_cache['h'].shape[1] // self.token_mel_ratio if 'h' in chunk_cache else 0
+            token, context = token[:, offset:-self.pre_lookahead_len], token[:, -self.pre_lookahead_len:]
+            h, chunk_cache['encoder'] = self.encoder.forward_chunk(token, context, chunk_cache.get('encoder'))
+            h = self.encoder_proj(h)
+            if offset != 0:
+                h = torch.concat([chunk_cache['h'], h], dim=1)
+            chunk_cache['h'] = h
+        else:
+            token, context = token[:, :-self.pre_lookahead_len], token[:, -self.pre_lookahead_len:]
+            h, h_lengths = self.encoder(token, token_len, context=context, streaming=streaming)
+            h = self.encoder_proj(h)
+        return embedding, h
@@ -15,6 +15,8 @@
 import torch
 import torch.nn.functional as F
 from matcha.models.components.flow_matching import BASECFM
+from cosyvoice.cli.buffer_pool import BufferPool
+from cosyvoice.flow.ode_solver import ODE_SOLVERS
 from cosyvoice.utils.common import set_all_random_seed
 
 
@@ -32,9 +34,12 @@ class ConditionalCFM(BASECFM):
         in_channels = in_channels + (spk_emb_dim if n_spks > 0 else 0)
         # Just change the architecture of the estimator here
         self.estimator = estimator
+        # estimator input buffers reused across calls and chunks, None allocates them for every call
+        self.workspace = BufferPool(max_bytes=64 * 1024 * 1024)
 
     @torch.inference_mode()
-    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None, prompt_len=0, cache=torch.zeros(1, 80, 0, 2)):
+    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None, prompt_len=0, cache=torch.zeros(1, 80, 0, 2),
+                inference_cfg_rate=None, cfg_end=1.0):
         """Forward diffusion
 
         Args:
@@ -47,12 +52,20 @@ class ConditionalCFM(BASECFM):
             spks (torch.Tensor, optional): speaker ids. Defaults to None.
                 shape: (batch_size, spk_emb_dim)
             cond: Not used but kept for future purposes
+            inference_cfg_rate (float, optional): guidance scale, None for cfm_params.inference_cfg_rate
+            cfg_end (float, optional): guidance only runs at ode time t < cfg_end, see solve()
 
         Returns:
             sample: generated mel-spectrogram
                 shape: (batch_size, n_feats, mel_timesteps)
         """
 
+        z, cache = self.prior(mu, temperature, prompt_len, cache)
+        return self.solve(z, t_span=self.time_span(n_timesteps, mu.dtype), mu=mu, mask=mask, spks=spks, cond=cond,
+                          inference_cfg_rate=inference_cfg_rate, cfg_end=cfg_end), cache
+
+    def prior(self, mu, temperature=1.0, prompt_len=0, cache=torch.zeros(1, 80, 0, 2)):
+        """ Noise of one request, prompt and overlap frames of z and mu are fixed by cache, mu is updated in place """
         z = torch.randn_like(mu).to(mu.device).to(mu.dtype) * temperature
         cache_size = cache.shape[2]
         # fix prompt and overlap part mu and z
@@ -62,15 +75,21 @@ class ConditionalCFM(BASECFM):
         z_cache = torch.concat([z[:, :, :prompt_len], z[:, :, -34:]], dim=2)
         mu_cache = torch.concat([mu[:, :, :prompt_len], mu[:, :, -34:]], dim=2)
         cache = torch.stack([z_cache, mu_cache], dim=-1)
+        return z, cache
 
-        t_span = torch.linspace(0, 1, n_timesteps + 1, device=mu.device, dtype=mu.dtype)
+    def time_span(self, n_timesteps, dtype):
+        # NOTE t_span stays on cpu, so that solvers step t without device syncs
+        t_span = torch.linspace(0, 1, n_timesteps + 1, dtype=dtype)
         if self.t_scheduler == 'cosine':
             t_span = 1 - torch.cos(t_span * 0.5 * torch.pi)
-        return self.solve_euler(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond), cache
+        return t_span
 
-    def solve_euler(self, x, t_span, mu, mask, spks, cond, streaming=False):
+    def solve(self, x, t_span, mu, mask, spks, cond, streaming=False, inference_cfg_rate=None, cfg_end=1.0):
         """
-        Fixed euler solver for ODEs.
+        ODE solver selected by cfm_params.solver, see cosyvoice/flow/ode_solver.py.
+        Steps without guidance (t >= cfg_end or inference_cfg_rate 0) only run the conditional branch,
+        a trt estimator whose min batch is twice the batch runs both branches and keeps the conditional one.
+        Rows of a batch are independent requests, padded frames are masked out by mask.
         Args:
             x (torch.Tensor): random noise
             t_span (torch.Tensor): n_timesteps interpolated
@@ -82,45 +101,97 @@ class ConditionalCFM(BASECFM):
             spks (torch.Tensor, optional): speaker ids. Defaults to None.
                 shape: (batch_size, spk_emb_dim)
             cond: Not used but kept for future purposes
+            inference_cfg_rate (float, optional): guidance scale, None for cfm_params.inference_cfg_rate
+            cfg_end (float, optional): guidance only runs at ode time t < cfg_end, 1.0 for every step
         """
-        t, _, dt = t_span[0], t_span[-1], t_span[1] - t_span[0]
-        t = t.unsqueeze(dim=0)
-
-        # I am storing this because I can later plot it by putting a debugger here and saving it to a file
-        # Or in future might add like a return_all_steps flag
-        sol = []
-
+        inference_cfg_rate = self.inference_cfg_rate if inference_cfg_rate is None else inference_cfg_rate
         # Do not use concat, it may cause memory format changed and trt infer with wrong results!
-        x_in = torch.zeros([2, 80, x.size(2)], device=x.device, dtype=x.dtype)
-        mask_in = torch.zeros([2, 1, x.size(2)], device=x.device, dtype=x.dtype)
-        mu_in = torch.zeros([2, 80, x.size(2)], device=x.device, dtype=x.dtype)
-        t_in = torch.zeros([2], device=x.device, dtype=x.dtype)
-        spks_in = torch.zeros([2, 80], device=x.device, dtype=x.dtype)
-        cond_in = torch.zeros([2, 80, x.size(2)], device=x.device, dtype=x.dtype)
-        for step in range(1, len(t_span)):
+        # conditional rows first, then unconditional ones
+        batch_size = x.size(0)
+        inputs, buffer = self.acquire_inputs(x)
+        x_in, mask_in, mu_in, t_in, spks_in, cond_in = inputs['x'], inputs['mask'], inputs['mu'], inputs['t'], inputs['spks'], inputs['cond']
+        mask_in[:batch_size] = mask
+        mask_in[batch_size:] = mask
+        mu_in[:batch_size] = mu
+        spks_in[:batch_size] = spks
+        cond_in[:batch_size] = cond
+        context, time_emb = None, {}
+        if isinstance(self.estimator, torch.nn.Module):
+            # NOTE masks, packed conditioning and time embeddings of t_span do not change between steps
+            context = self.estimator.prepare(mask_in, mu_in, spks_in, cond_in, streaming=streaming)
+            emb = self.estimator.time_embedding(t_span.to(x.device))
+            time_emb = {t: emb[i:i + 1] for i, t in enumerate(t_span.tolist())}
+
+        def velocity(x, t):
             # Classifier-Free Guidance inference introduced in VoiceBox
-            x_in[:] = x
-            mask_in[:] = mask
-            mu_in[0] = mu
-            t_in[:] = t.unsqueeze(0)
-            spks_in[0] = spks
-            cond_in[0] = cond
-            dphi_dt = self.forward_estimator(
-                x_in, mask_in,
-                mu_in, t_in,
-                spks_in,
-                cond_in,
-                streaming
-            )
-            dphi_dt, cfg_dphi_dt = torch.split(dphi_dt, [x.size(0), x.size(0)], dim=0)
-            dphi_dt = ((1.0 + self.inference_cfg_rate) * dphi_dt - self.inference_cfg_rate * cfg_dphi_dt)
-            x = x + dt * dphi_dt
-            t = t + dt
-            sol.append(x)
-            if step < len(t_span) - 1:
-                dt = t_span[step + 1] - t
-
-        return sol[-1].float()
+            guided = self.use_cfg(inference_cfg_rate, cfg_end, t)
+            batch = self.estimator_batch(batch_size, guided)
+            x_in[:batch_size] = x
+            if batch > batch_size:
+                x_in[batch_size:batch] = x
+            if context is not None:
+                # solvers may evaluate t off the t_span grid, e.g. midpoint
+                if float(t) not in time_emb:
+                    time_emb[float(t)] = self.estimator.time_embedding(t.reshape(1).to(x.device))
+                dphi_dt = self.estimator.forward_prepared(x_in[:batch], time_emb[float(t)].expand(batch, -1), context)
+            else:
+                t_in[:batch] = t
+                dphi_dt = self.forward_estimator(
+                    x_in[:batch], mask_in[:batch],
+                    mu_in[:batch], t_in[:batch],
+                    spks_in[:batch],
+                    cond_in[:batch],
+                    streaming
+                )
+                # NOTE trt writes its output into x_in, which the next step overwrites
+                if not guided:
+                    dphi_dt = dphi_dt[:batch_size].clone()
+            return self.guidance(dphi_dt, batch_size, guided, inference_cfg_rate)
+
+        x = ODE_SOLVERS[self.solver](velocity, x, t_span).float()
+        self.release_inputs(buffer)
+        return x
+
+    def acquire_inputs(self, x):
+        """ Estimator inputs of twice the batch of x, the unconditional half of mu, spks and cond is zero
+
+        With a workspace they are views of one flat buffer of the pool, so concurrent solves never share
+        a buffer, release_inputs() gives it back for the next solve or streaming chunk.
+        """
+        batch, length = 2 * x.size(0), x.size(2)
+        shapes = [('x', (batch, 80, length)), ('mask', (batch, 1, length)), ('mu', (batch, 80, length)),
+                  ('cond', (batch, 80, length)), ('t', (batch,)), ('spks', (batch, 80))]
+        if self.workspace is None:
+            return {k: torch.zeros(shape, device=x.device, dtype=x.dtype) for k, shape in shapes}, None
+        numels = [torch.Size(shape).numel() for _, shape in shapes]
+        flat, buffer = self.workspace.acquire((sum(numels),), x.dtype, x.device)
+        inputs = {k: v.view(shape) for (k, shape), v in zip(shapes, flat.split(numels))}
+        for k in ['mu', 'spks', 'cond']:
+            inputs[k][x.size(0):].zero_()
+        return inputs, buffer
+
+    def release_inputs(self, buffer):
+        if buffer is not None:
+            self.workspace.recycle(buffer)
+
+    def use_cfg(self, inference_cfg_rate, cfg_end, t):
+        return inference_cfg_rate != 0 and float(t) < cfg_end
+
+    def estimator_batch(self, batch_size, guided):
+        if guided:
+            return 2 * batch_size
+        # NOTE trt engines built with a batch 2 min shape can not run the conditional branch alone,
+        # they run both branches and guidance() keeps the conditional one without the cfg mix
+        if not isinstance(self.estimator, torch.nn.Module) and self.estimator.trt_engine.get_tensor_profile_shape('x', 0)[0][0] > batch_size:
+            return 2 * batch_size
+        return batch_size
+
+    def guidance(self, dphi_dt, batch_size, guided, inference_cfg_rate):
+        if not guided:
+            return dphi_dt[:batch_size]
+        dphi_dt, cfg_dphi_dt = dphi_dt[:batch_size], dphi_dt[batch_size:]
+        # (1 + rate) * dphi_dt - rate * cfg_dphi_dt in one kernel and allocation
+        return torch.lerp(cfg_dphi_dt, dphi_dt, 1.0 + inference_cfg_rate)
 
     def forward_estimator(self, x, mask, mu, t, spks, cond, streaming=False):
         if isinstance(self.estimator, torch.nn.Module):
@@ -130,12 +201,12 @@ class ConditionalCFM(BASECFM):
             # NOTE need to synchronize when switching stream
             torch.cuda.current_stream().synchronize()
             with stream:
-                estimator.set_input_shape('x', (2, 80, x.size(2)))
-                estimator.set_input_shape('mask', (2, 1, x.size(2)))
-                estimator.set_input_shape('mu', (2, 80, x.size(2)))
-                estimator.set_input_shape('t', (2,))
-                estimator.set_input_shape('spks', (2, 80))
-                estimator.set_input_shape('cond', (2, 80, x.size(2)))
+                estimator.set_input_shape('x', (x.size(0), 80, x.size(2)))
+                estimator.set_input_shape('mask', (x.size(0), 1, x.size(2)))
+                estimator.set_input_shape('mu', (x.size(0), 80, x.size(2)))
+                estimator.set_input_shape('t', (x.size(0),))
+                estimator.set_input_shape('spks', (x.size(0), 80))
+                estimator.set_input_shape('cond', (x.size(0), 80, x.size(2)))
                 data_ptrs = [x.contiguous().data_ptr(),
                              mask.contiguous().data_ptr(),
                              mu.contiguous().data_ptr(),
@@ -199,8 +270,15 @@ class CausalConditionalCFM(ConditionalCFM):
         set_all_random_seed(0)
         self.rand_noise = torch.randn([1, 80, 50 * 300])
 
+    def noise(self, start, end, mu):
+        # NOTE rand_noise is a plain attribute, not a buffer, so ddp does not broadcast it every forward,
+        # it moves to the device of mu once instead of being copied for every call
+        if self.rand_noise.device != mu.device:
+            self.rand_noise = self.rand_noise.to(mu.device)
+        return self.rand_noise[:, :, start:end].to(mu.dtype)
+
     @torch.inference_mode()
-    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None, streaming=False):
+    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None, streaming=False, inference_cfg_rate=None, cfg_end=1.0):
         """Forward diffusion
 
         Args:
@@ -213,15 +291,68 @@ class CausalConditionalCFM(ConditionalCFM):
             spks (torch.Tensor, optional): speaker ids. Defaults to None.
                 shape: (batch_size, spk_emb_dim)
             cond: Not used but kept for future purposes
+            inference_cfg_rate (float, optional): guidance scale, None for cfm_params.inference_cfg_rate
+            cfg_end (float, optional): guidance only runs at ode time t < cfg_end, see solve()
 
         Returns:
             sample: generated mel-spectrogram
                 shape: (batch_size, n_feats, mel_timesteps)
         """
 
-        z = self.rand_noise[:, :, :mu.size(2)].to(mu.device).to(mu.dtype) * temperature
-        # fix prompt and overlap part mu and z
-        t_span = torch.linspace(0, 1, n_timesteps + 1, device=mu.device, dtype=mu.dtype)
-        if self.t_scheduler == 'cosine':
-            t_span = 1 - torch.cos(t_span * 0.5 * torch.pi)
-        return self.solve_euler(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond, streaming=streaming), None
+        # NOTE every row starts at frame 0 of the noise bank, the same noise as a batch 1 call
+        z = self.noise(0, mu.size(2), mu).expand(mu.size(0), -1, -1) * temperature
+        return self.solve(z, t_span=self.time_span(n_timesteps, mu.dtype), mu=mu, mask=mask, spks=spks, cond=cond, streaming=streaming,
+                          inference_cfg_rate=inference_cfg_rate, cfg_end=cfg_end), None
+
+    @torch.inference_mode()
+    def forward_chunk(self, mu, n_timesteps, temperature=1.0, spks=None, cond=None, cache=None, prompt_len=0, inference_cfg_rate=None, cfg_end=1.0):
+        """Streaming forward diffusion of new frames only
+
+        The estimator keeps conv and attention caches of every timestep, see
+        CausalConditionalDecoder.forward_chunk.
+
+        Args:
+            mu (torch.Tensor): output of encoder for new frames
+                shape: (1, n_feats, mel_timesteps)
+            n_timesteps (int): number of diffusion steps, must not change between chunks
+            cache (dict): returned by previous forward_chunk, None for the first chunk
+            prompt_len (int): number of prompt frames at the start of the first chunk
+            inference_cfg_rate, cfg_end: see solve(), must not change between chunks
+
+        Returns:
+            sample: generated mel-spectrogram of new frames
+                shape: (1, n_feats, mel_timesteps)
+            cache: cache for next chunk
+        """
+        assert isinstance(self.estimator, torch.nn.Module), 'forward_chunk does not support trt estimator'
+        inference_cfg_rate = self.inference_cfg_rate if inference_cfg_rate is None else inference_cfg_rate
+        offset, estimator_cache = (cache['offset'], cache['estimator']) if cache is not None else (0, [])
+        x = self.noise(offset, offset + mu.size(2), mu) * temperature
+        t_span = self.time_span(n_timesteps, mu.dtype)
+
+        inputs, buffer = self.acquire_inputs(x)
+        x_in, mu_in, t_in, spks_in, cond_in = inputs['x'], inputs['mu'], inputs['t'], inputs['spks'], inputs['cond']
+        mu_in[0] = mu
+        spks_in[0] = spks
+        cond_in[0] = cond
+        # one estimator cache per NFE, the solver must evaluate the same time points for every chunk
+        new_estimator_cache = []
+
+        def velocity(x, t):
+            # Classifier-Free Guidance inference introduced in VoiceBox
+            guided = self.use_cfg(inference_cfg_rate, cfg_end, t)
+            batch = 2 if guided else 1
+            x_in[:batch] = x
+            t_in[:batch] = t
+            nfe = len(new_estimator_cache)
+            if nfe < len(estimator_cache):
+                assert abs(estimator_cache[nfe][0] - t.item()) < 1e-5, 'solver {} does not support forward_chunk'.format(self.solver)
+            dphi_dt, step_cache = self.estimator.forward_chunk(x_in[:batch], mu_in[:batch], t_in[:batch], spks_in[:batch], cond_in[:batch],
+                                                               estimator_cache[nfe][1] if nfe < len(estimator_cache) else None, prompt_len)
+            new_estimator_cache.append((t.item(), step_cache))
+            return self.guidance(dphi_dt, 1, guided, inference_cfg_rate)
+
+        x = ODE_SOLVERS[self.solver](velocity, x, t_span)
+        self.release_inputs(buffer)
+        assert cache is None or len(new_estimator_cache) == len(estimator_cache), 'n_timesteps must not change between chunks'
+        return x.float(), {'offset': offset + mu.size(2), 'estimator': new_estimator_cache}
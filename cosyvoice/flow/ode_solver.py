@@ -0,0 +1,107 @@
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""ODE solvers for flow matching inference.
+
+A solver integrates dx/dt = velocity(x, t) from t_span[0] to t_span[-1] and returns x,
+velocity(x, t) runs the estimator (with classifier free guidance) once, i.e. one NFE.
+Fixed grid solvers evaluate the velocity at the same time points for every call, which
+streaming estimator caches rely on. Register new solvers in ODE_SOLVERS, cfm_params.solver
+selects one by name.
+"""
+import torch
+
+
+def euler(velocity, x, t_span):
+    """ First order, one NFE per step """
+    t, dt = t_span[0], t_span[1] - t_span[0]
+    for step in range(1, len(t_span)):
+        x = x + dt * velocity(x, t)
+        t = t + dt
+        if step < len(t_span) - 1:
+            dt = t_span[step + 1] - t
+    return x
+
+
+def midpoint(velocity, x, t_span):
+    """ Second order, two NFE per step """
+    for step in range(1, len(t_span)):
+        t, dt = t_span[step - 1], t_span[step] - t_span[step - 1]
+        dphi_dt = velocity(x, t)
+        x = x + dt * velocity(x + 0.5 * dt * dphi_dt, t + 0.5 * dt)
+    return x
+
+
+def heun(velocity, x, t_span):
+    """ Second order, two NFE per step """
+    for step in range(1, len(t_span)):
+        t, dt = t_span[step - 1], t_span[step] - t_span[step - 1]
+        dphi_dt = velocity(x, t)
+        dphi_dt_next = velocity(x + dt * dphi_dt, t_span[step])
+        x = x + 0.5 * dt * (dphi_dt + dphi_dt_next)
+    return x
+
+
+def dpm(velocity, x, t_span):
+    """ Second order multistep, one NFE per step.
+
+    For a velocity estimator, DPM-Solver++(2M) reduces to variable step Adams-Bashforth,
+    the previous velocity corrects the current one, the first step is euler.
+    """
+    dphi_dt_prev, dt_prev = None, None
+    for step in range(1, len(t_span)):
+        t, dt = t_span[step - 1], t_span[step] - t_span[step - 1]
+        dphi_dt = velocity(x, t)
+        if dphi_dt_prev is None:
+            x = x + dt * dphi_dt
+        else:
+            r = dt / (2 * dt_prev)
+            x = x + dt * ((1 + r) * dphi_dt - r * dphi_dt_prev)
+        dphi_dt_prev, dt_prev = dphi_dt, dt
+    return x
+
+
+def adaptive_heun(velocity, x, t_span, rtol=0.05, atol=0.05, max_nfe=None):
+    """ Heun with embedded euler error estimate and step size control.
+
+    The first step size is that of t_span, at most max_nfe (default 4 * len(t_span)) NFE are
+    run, the last step is then taken as is. Time points depend on the input, so it does not
+    work with streaming estimator caches.
+    """
+    t, t_end = t_span[0], t_span[-1]
+    dt = t_span[1] - t_span[0]
+    max_nfe = 4 * len(t_span) if max_nfe is None else max_nfe
+    nfe = 0
+    while t_end - t > 1e-6:
+        # no NFE left for another step after this one, finish in one step
+        last = nfe + 4 > max_nfe
+        dt = t_end - t if last else torch.minimum(dt, t_end - t)
+        dphi_dt = velocity(x, t)
+        x_euler = x + dt * dphi_dt
+        x_heun = x + 0.5 * dt * (dphi_dt + velocity(x_euler, t + dt))
+        nfe += 2
+        scale = atol + rtol * torch.maximum(x.abs(), x_heun.abs())
+        error = ((x_heun - x_euler) / scale).float().pow(2).mean().sqrt().item()
+        if error <= 1.0 or last:
+            x, t = x_heun, t + dt
+        dt = dt * min(5.0, max(0.2, 0.9 * max(error, 1e-6) ** -0.5))
+    return x
+
+
+ODE_SOLVERS = {
+    'euler': euler,
+    'midpoint': midpoint,
+    'heun': heun,
+    'dpm': dpm,
+    'adaptive_heun': adaptive_heun,
+}
@@ -20,11 +20,13 @@ from typing import Dict, Optional, Callable, List, Generator
 import torch
 from torch import nn
 import torch.nn.functional as F
-from transformers import Qwen2ForCausalLM
+from transformers import Qwen2Config, Qwen2ForCausalLM
+from transformers.modeling_utils import no_init_weights
+from transformers.cache_utils import DynamicCache, StaticCache
 from torch.nn.utils.rnn import pad_sequence, unpad_sequence
 from cosyvoice.utils.common import IGNORE_ID
 from cosyvoice.transformer.label_smoothing_loss import LabelSmoothingLoss
-from cosyvoice.utils.common import th_accuracy
+from cosyvoice.utils.common import th_accuracy, TokenWindow
 from cosyvoice.utils.file_utils import logging
 from cosyvoice.utils.mask import make_pad_mask
 
@@ -147,19 +149,23 @@ class TransformerLM(torch.nn.Module):
     def sampling_ids(
             self,
             weighted_scores: torch.Tensor,
-            decoded_tokens: List,
+            decoded_tokens: TokenWindow,
             sampling: int,
             ignore_eos: bool = True,
+            allow_fill: bool = False,
     ):
-        num_trials, max_trials = 0, 100
-        while True:
-            top_ids = self.sampling(weighted_scores, decoded_tokens, sampling)
-            if (not ignore_eos) or (self.speech_token_size not in top_ids):
-                break
-            num_trials += 1
-            if num_trials > max_trials:
-                raise RuntimeError('sampling reaches max_trials {} and still get eos when ignore_eos is True, check your input!'.format(max_trials))
-        return top_ids
+        """ Sample ids of weighted_scores (vocab,) or (batch, vocab), ignore_eos may be a (batch,) bool tensor.
+
+        Ids which must not be drawn are masked before sampling, which is the distribution of resampling
+        until an allowed id is drawn, with exactly one draw.
+        """
+        mask = torch.zeros_like(weighted_scores, dtype=torch.bool)
+        mask[..., self.speech_token_size] = ignore_eos
+        # NOTE ids after eos are never valid outputs, except fill tokens in bistream decoding
+        mask[..., self.speech_token_size + 1:] = True
+        if allow_fill:
+            mask[..., self.speech_token_size + 2] = False
+        return self.sampling(weighted_scores, decoded_tokens, sampling, mask=mask)
 
     @torch.inference_mode()
     def inference(
@@ -207,57 +213,145 @@ class TransformerLM(torch.nn.Module):
 
         # 5. step by step decode
         out_tokens = []
+        # NOTE ras_sampling counts repetitions in a device ring buffer of recent tokens
+        window = TokenWindow(device=device)
         offset = 0
         att_cache, cnn_cache = torch.zeros((0, 0, 0, 0), device=lm_input.device), torch.zeros((0, 0, 0, 0), device=lm_input.device)
+        # NOTE keys and values are written in place into a buffer of the prompt and max_len - 1 decode steps,
+        # jit models exported before cache_offset existed keep concatenating the cache
+        inplace = not isinstance(self.llm, torch.jit.ScriptModule)
+        if inplace:
+            att_cache = self.llm.init_att_cache(lm_input.shape[1] + max_len - 1, lm_input.device, lm_input.dtype)
+        step_mask = torch.ones((1, 1, 1), dtype=torch.bool, device=lm_input.device)
         for i in range(max_len):
-            y_pred, att_cache, cnn_cache = self.llm.forward_chunk(lm_input, offset=offset, required_cache_size=-1,
-                                                                  att_cache=att_cache, cnn_cache=cnn_cache,
-                                                                  att_mask=torch.tril(torch.ones((1, lm_input.shape[1], lm_input.shape[1]),
-                                                                                                 device=lm_input.device)).to(torch.bool))
+            # a single new position attends to the whole cache, only the prompt needs a causal mask
+            att_mask = torch.tril(torch.ones((1, lm_input.shape[1], lm_input.shape[1]), device=lm_input.device)).to(torch.bool) if lm_input.shape[1] > 1 else step_mask
+            if inplace:
+                y_pred, att_cache, cnn_cache = self.llm.forward_chunk(lm_input, offset=offset, required_cache_size=-1,
+                                                                      att_cache=att_cache, cnn_cache=cnn_cache, att_mask=att_mask, cache_offset=offset)
+            else:
+                y_pred, att_cache, cnn_cache = self.llm.forward_chunk(lm_input, offset=offset, required_cache_size=-1,
+                                                                      att_cache=att_cache, cnn_cache=cnn_cache, att_mask=att_mask)
             logp = self.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1)
             # force continue decode first token
             if i == 0:
                 logp[:, self.speech_token_size] = -float('inf')
-            top_ids = self.sampling_ids(logp.squeeze(dim=0), out_tokens, sampling, ignore_eos=True if i < min_len else False).item()
+            top_ids = self.sampling_ids(logp.squeeze(dim=0), window, sampling, ignore_eos=True if i < min_len else False).item()
             if top_ids == self.speech_token_size:
                 break
             # in stream mode, yield token one by one
             yield top_ids
             out_tokens.append(top_ids)
+            window.append(top_ids)
             offset += lm_input.size(1)
             lm_input = self.speech_embedding.weight[top_ids].reshape(1, 1, -1)
 
 
+class StaticKVCache:
+    """ Preallocated kv cache of one session for Qwen2Encoder.forward_static_step.
+
+    Keys and values of max_len positions are written in place, and the additive attention mask
+    row is updated in O(1) per step, instead of growing the cache by concatenation and building
+    a (L, L) mask for every token.
+    """
+
+    def __init__(self, config: Qwen2Config, max_len: int, device: torch.device, dtype: torch.dtype):
+        self.kv = StaticCache(config=config, max_batch_size=1, max_cache_len=max_len, device=device, dtype=dtype)
+        self.max_len = max_len
+        self.offset = 0
+        self.positions = torch.arange(max_len, device=device)
+        # 0 for written positions, min for the rest
+        self.mask = torch.full((1, 1, 1, max_len), torch.finfo(dtype).min, dtype=dtype, device=device)
+
+
 class Qwen2Encoder(torch.nn.Module):
-    def __init__(self, pretrain_path):
+    def __init__(self, pretrain_path, load_pretrained=True):
         super().__init__()
-        self.model = Qwen2ForCausalLM.from_pretrained(pretrain_path)
-
+        if load_pretrained is True:
+            self.model = Qwen2ForCausalLM.from_pretrained(pretrain_path)
+        else:
+            # NOTE weights are loaded later from llm checkpoint, only build the architecture and skip random init
+            with no_init_weights():
+                self.model = Qwen2ForCausalLM(Qwen2Config.from_pretrained(pretrain_path))
+            # NOTE no_init_weights also skips tying lm_head to embed_tokens, which from_pretrained does
+            self.model.tie_weights()
+
+    # NOTE only the last hidden state is used, so run self.model.model, which neither keeps the hidden states
+    # of every layer nor computes lm_head logits over the text vocabulary
     def forward(self, xs: torch.Tensor, xs_lens: torch.Tensor):
         T = xs.size(1)
         masks = ~make_pad_mask(xs_lens, T)
-        outs = self.model(
+        outs = self.model.model(
             inputs_embeds=xs,
             attention_mask=masks,
-            output_hidden_states=True,
             return_dict=True,
         )
-        return outs.hidden_states[-1], masks.unsqueeze(1)
+        return outs.last_hidden_state, masks.unsqueeze(1)
 
-    def forward_one_step(self, xs, masks, cache=None):
-        input_masks = masks[:, -1, :]
-        outs = self.model(
+    def forward_one_step(self, xs, masks=None, cache=None):
+        """ Decode step with a growing cache, masks is unused, the model builds the causal mask
+        of new positions itself, and a single position needs none.
+        """
+        outs = self.model.model(
             inputs_embeds=xs,
-            attention_mask=input_masks,
-            output_hidden_states=True,
             return_dict=True,
             use_cache=True,
             past_key_values=cache,
         )
-        xs = outs.hidden_states[-1]
+        xs = outs.last_hidden_state
         new_cache = outs.past_key_values
         return xs, new_cache
 
+    def init_static_cache(self, max_len: int, device: torch.device, dtype: torch.dtype):
+        return StaticKVCache(self.model.config, max_len, device, dtype)
+
+    def forward_static_step(self, xs, cache: StaticKVCache):
+        """ Decode step, or prefill when xs has more than one position, with a preallocated cache
+
+        Args:
+            xs (torch.Tensor): (1, T, D)
+            cache (StaticKVCache): from init_static_cache, T more positions are written
+        """
+        start, end = cache.offset, cache.offset + xs.size(1)
+        assert end <= cache.max_len, 'static cache of {} positions is full'.format(cache.max_len)
+        cache.mask[..., start:end] = 0
+        if xs.size(1) == 1:
+            masks = cache.mask
+        else:
+            # prefill, causal within the new positions
+            masks = cache.mask.masked_fill(cache.positions > cache.positions[start:end].unsqueeze(dim=1), torch.finfo(cache.mask.dtype).min)
+        outs = self.model.model(
+            inputs_embeds=xs,
+            attention_mask=masks,
+            cache_position=cache.positions[start:end],
+            return_dict=True,
+            use_cache=True,
+            past_key_values=cache.kv,
+        )
+        cache.offset = end
+        return outs.last_hidden_state, cache
+
+    def forward_batch_step(self, xs, masks, position_ids, cache=None):
+        """ Run one decode step for a batch of sessions sharing a left padded cache.
+
+        Args:
+            xs (torch.Tensor): (B, T, D), T is 1 except for single session prefill
+            masks (torch.Tensor): (B, cache_len + T) padding mask, False for left padding
+            position_ids (torch.Tensor): (B, T) real position of every session
+            cache: past_key_values in legacy tuple format, or None
+        """
+        outs = self.model.model(
+            inputs_embeds=xs,
+            attention_mask=masks,
+            position_ids=position_ids,
+            return_dict=True,
+            use_cache=True,
+            past_key_values=DynamicCache.from_legacy_cache(cache) if cache is not None else None,
+        )
+        xs = outs.last_hidden_state
+        new_cache = outs.past_key_values.to_legacy_cache()
+        return xs, new_cache
+
 
 class Qwen2LM(TransformerLM):
     def __init__(
@@ -301,6 +395,9 @@ class Qwen2LM(TransformerLM):
         self.stop_token_ids = [speech_token_size + i for i in range(3)]
         self.vllm_output_queue = {}
 
+        # 6. decode with a preallocated kv cache, off by default, see CosyVoice2Model.enable_static_cache
+        self.static_cache = False
+
     def prepare_lm_input_target(self, text_token, text_token_emb, text_token_len, speech_token, speech_token_emb, speech_token_len):
         lm_target, lm_input = [], []
         text_token = unpad_sequence(text_token, text_token_len.cpu(), batch_first=True)
@@ -439,9 +536,29 @@ class Qwen2LM(TransformerLM):
             min_token_text_ratio: float = 2,
             uuid: str = '',
     ) -> Generator[torch.Tensor, None, None]:
+        lm_input, min_len, max_len = self.prepare_lm_input(text, text_len, prompt_text, prompt_text_len,
+                                                           prompt_speech_token, prompt_speech_token_len,
+                                                           max_token_text_ratio, min_token_text_ratio)
+
+        # 5. step by step decode
+        for token in self.inference_wrapper(lm_input, sampling, min_len, max_len, uuid):
+            yield token
+
+    @torch.inference_mode()
+    def prepare_lm_input(
+            self,
+            text: torch.Tensor,
+            text_len: torch.Tensor,
+            prompt_text: torch.Tensor,
+            prompt_text_len: torch.Tensor,
+            prompt_speech_token: torch.Tensor,
+            prompt_speech_token_len: torch.Tensor,
+            max_token_text_ratio: float = 20,
+            min_token_text_ratio: float = 2,
+    ):
         device = text.device
         text = torch.concat([prompt_text, text], dim=1)
-        text_len += prompt_text_len
+        text_len = text_len + prompt_text_len
         text = self.llm.model.model.embed_tokens(text)
 
         # 3. concat llm_input
@@ -456,10 +573,7 @@ class Qwen2LM(TransformerLM):
         # 4. cal min/max_length
         min_len = int((text_len - prompt_text_len) * min_token_text_ratio)
         max_len = int((text_len - prompt_text_len) * max_token_text_ratio)
-
-        # 5. step by step decode
-        for token in self.inference_wrapper(lm_input, sampling, min_len, max_len, uuid):
-            yield token
+        return lm_input, min_len, max_len
 
     @torch.inference_mode()
     def inference_wrapper(self, lm_input, sampling, min_len, max_len, uuid):
@@ -473,41 +587,50 @@ class Qwen2LM(TransformerLM):
                 self.vllm.add_request(uuid, {"prompt_embeds": lm_input.squeeze(0).to(torch.bfloat16).to(lm_input.device)}, sampling_params)
                 self.vllm_output_queue[uuid] = queue.Queue()
             out_tokens = []
-            while True:
+            try:
+                while True:
+                    with self.lock:
+                        if self.vllm_output_queue[uuid].empty() is True:
+                            request_outputs: List[RequestOutput] = self.vllm.step()
+                            for request_output in request_outputs:
+                                top_ids = list(request_output.outputs[0].token_ids)[-1]
+                                self.vllm_output_queue[request_output.request_id].put(top_ids)
+                    if self.vllm_output_queue[uuid].empty() is False:
+                        top_ids = self.vllm_output_queue[uuid].get()
+                        if top_ids in self.stop_token_ids:
+                            break
+                        # in stream mode, yield token one by one
+                        yield top_ids
+                        out_tokens.append(top_ids)
+                        if len(out_tokens) == max_len:
+                            break
+                    time.sleep(0.001)
+            finally:
+                # NOTE abort is a no-op for finished request, it stops decoding when the generator is closed early
                 with self.lock:
-                    if self.vllm_output_queue[uuid].empty() is True:
-                        request_outputs: List[RequestOutput] = self.vllm.step()
-                        for request_output in request_outputs:
-                            top_ids = list(request_output.outputs[0].token_ids)[-1]
-                            self.vllm_output_queue[request_output.request_id].put(top_ids)
-                if self.vllm_output_queue[uuid].empty() is False:
-                    top_ids = self.vllm_output_queue[uuid].get()
-                    if top_ids in self.stop_token_ids:
-                        break
-                    # in stream mode, yield token one by one
-                    yield top_ids
-                    out_tokens.append(top_ids)
-                    if len(out_tokens) == max_len:
-                        break
-                time.sleep(0.001)
-            with self.lock:
-                self.vllm_output_queue.pop(uuid)
+                    self.vllm.abort_request(uuid)
+                    self.vllm_output_queue.pop(uuid)
         else:
             out_tokens = []
-            cache = None
+            window = TokenWindow(device=lm_input.device)
+            if self.static_cache is True:
+                # NOTE the last sampled token is never fed back, so max_len - 1 decode steps follow the prompt
+                cache = self.llm.init_static_cache(lm_input.shape[1] + max_len - 1, lm_input.device, lm_input.dtype)
+            else:
+                cache = None
             for i in range(max_len):
-                y_pred, cache = self.llm.forward_one_step(lm_input,
-                                                          masks=torch.tril(torch.ones((1, lm_input.shape[1], lm_input.shape[1]), device=lm_input.device)).to(torch.bool),
-                                                          cache=cache)
+                if self.static_cache is True:
+                    y_pred, cache = self.llm.forward_static_step(lm_input, cache)
+                else:
+                    y_pred, cache = self.llm.forward_one_step(lm_input, cache=cache)
                 logp = self.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1)
-                top_ids = self.sampling_ids(logp.squeeze(dim=0), out_tokens, sampling, ignore_eos=True if i < min_len else False).item()
+                top_ids = self.sampling_ids(logp.squeeze(dim=0), window, sampling, ignore_eos=True if i < min_len else False).item()
                 if top_ids == self.speech_token_size:
                     break
-                if top_ids > self.speech_token_size:
-                    continue
                 # in stream mode, yield token one by one
                 yield top_ids
                 out_tokens.append(top_ids)
+                window.append(top_ids)
                 lm_input = self.speech_embedding.weight[top_ids].reshape(1, 1, -1)
 
     @torch.inference_mode()
@@ -536,6 +659,7 @@ class Qwen2LM(TransformerLM):
 
         # 2. iterate text
         out_tokens = []
+        window = TokenWindow(device=device)
         cache = None
         # NOTE init prompt_text as text_cache as it is basically impossible prompt_speech_token/prompt_text < 15/5
         text_cache = self.llm.model.model.embed_tokens(prompt_text)
@@ -568,20 +692,19 @@ class Qwen2LM(TransformerLM):
                         logging.info('not enough text token to decode, wait for more')
                         continue
                 while True:
-                    seq_len = lm_input.shape[1] if cache is None else lm_input.shape[1] + cache[0][0].size(2)
-                    y_pred, cache = self.llm.forward_one_step(lm_input,
-                                                              masks=torch.tril(torch.ones((1, seq_len, seq_len), device=lm_input.device)).to(torch.bool),
-                                                              cache=cache)
+                    # NOTE total length is unknown until text ends, keep a growing cache
+                    y_pred, cache = self.llm.forward_one_step(lm_input, cache=cache)
                     logp = self.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1)
                     if next_fill_index != -1 and len(out_tokens) == next_fill_index:
                         top_ids = self.speech_token_size + 2
                         next_fill_index += (self.mix_ratio[1] + 1)
                     else:
-                        top_ids = self.sampling_ids(logp.squeeze(dim=0), out_tokens, sampling, ignore_eos=True).item()
+                        top_ids = self.sampling_ids(logp.squeeze(dim=0), window, sampling, ignore_eos=True, allow_fill=True).item()
                     if top_ids == self.speech_token_size + 2:
                         next_fill_index = len(out_tokens) + self.mix_ratio[1] + 1
                         logging.info('fill_token index {} next fill_token index {}'.format(len(out_tokens), next_fill_index))
                     out_tokens.append(top_ids)
+                    window.append(top_ids)
                     if top_ids >= self.speech_token_size:
                         if top_ids == self.speech_token_size + 2:
                             break
@@ -594,13 +717,11 @@ class Qwen2LM(TransformerLM):
         lm_input = torch.concat([lm_input, text_cache, task_id_emb], dim=1)
         logging.info('no more text token, decode until met eos')
         while True:
-            seq_len = lm_input.shape[1] if cache is None else lm_input.shape[1] + cache[0][0].size(2)
-            y_pred, cache = self.llm.forward_one_step(lm_input,
-                                                      masks=torch.tril(torch.ones((1, seq_len, seq_len), device=lm_input.device)).to(torch.bool),
-                                                      cache=cache)
+            y_pred, cache = self.llm.forward_one_step(lm_input, cache=cache)
             logp = self.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1)
-            top_ids = self.sampling_ids(logp.squeeze(dim=0), out_tokens, sampling, ignore_eos=False).item()
+            top_ids = self.sampling_ids(logp.squeeze(dim=0), window, sampling, ignore_eos=False).item()
             out_tokens.append(top_ids)
+            window.append(top_ids)
             if top_ids >= self.speech_token_size:
                 if top_ids == self.speech_token_size:
                     break
@@ -126,6 +126,22 @@ class MultiHeadedAttention(nn.Module):
 
         return self.linear_out(x)  # (batch, time1, d_model)
 
+    def write_cache(
+        self, k: torch.Tensor, v: torch.Tensor, cache: torch.Tensor, cache_offset: int
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """Write k, v (#batch=1, head, time1, d_k) into the preallocated cache
+        (1, head, max_t, d_k * 2) after its cache_offset valid positions.
+
+        Returns:
+            torch.Tensor: keys of all valid positions, a view of cache.
+            torch.Tensor: values of all valid positions, a view of cache.
+            torch.Tensor: the cache buffer itself.
+        """
+        end = cache_offset + k.size(2)
+        cache[:, :, cache_offset:end, :self.d_k] = k
+        cache[:, :, cache_offset:end, self.d_k:] = v
+        return cache[:, :, :end, :self.d_k], cache[:, :, :end, self.d_k:], cache
+
     def forward(
         self,
         query: torch.Tensor,
@@ -133,7 +149,8 @@ class MultiHeadedAttention(nn.Module):
         value: torch.Tensor,
         mask: torch.Tensor = torch.ones((0, 0, 0), dtype=torch.bool),
         pos_emb: torch.Tensor = torch.empty(0),
-        cache: torch.Tensor = torch.zeros((0, 0, 0, 0))
+        cache: torch.Tensor = torch.zeros((0, 0, 0, 0)),
+        cache_offset: int = -1
     ) -> Tuple[torch.Tensor, torch.Tensor]:
         """Compute scaled dot product attention.
 
@@ -156,6 +173,10 @@ class MultiHeadedAttention(nn.Module):
             cache (torch.Tensor): Cache tensor (1, head, cache_t, d_k * 2),
                 where `cache_t == chunk_size * num_decoding_left_chunks`
                 and `head * d_k == size`
+            cache_offset (int): -1 to concatenate cache, otherwise cache is a
+                preallocated (1, head, max_t, d_k * 2) buffer with cache_offset
+                valid positions, new keys and values are written in place
+                after them and the buffer is returned as the new cache
 
 
         Returns:
@@ -183,15 +204,18 @@ class MultiHeadedAttention(nn.Module):
         # >>> torch.equal(b, c)        # True
         # >>> d = torch.split(a, 2, dim=-1)
         # >>> torch.equal(d[0], d[1])  # True
-        if cache.size(0) > 0:
-            key_cache, value_cache = torch.split(cache,
-                                                 cache.size(-1) // 2,
-                                                 dim=-1)
-            k = torch.cat([key_cache, k], dim=2)
-            v = torch.cat([value_cache, v], dim=2)
-        # NOTE(xcsong): We do cache slicing in encoder.forward_chunk, since it's
-        #   non-trivial to calculate `next_cache_start` here.
-        new_cache = torch.cat((k, v), dim=-1)
+        if cache_offset >= 0:
+            k, v, new_cache = self.write_cache(k, v, cache, cache_offset)
+        else:
+            if cache.size(0) > 0:
+                key_cache, value_cache = torch.split(cache,
+                                                     cache.size(-1) // 2,
+                                                     dim=-1)
+                k = torch.cat([key_cache, k], dim=2)
+                v = torch.cat([value_cache, v], dim=2)
+            # NOTE(xcsong): We do cache slicing in encoder.forward_chunk, since it's
+            #   non-trivial to calculate `next_cache_start` here.
+            new_cache = torch.cat((k, v), dim=-1)
 
         scores = torch.matmul(q, k.transpose(-2, -1)) / math.sqrt(self.d_k)
         return self.forward_attention(v, scores, mask), new_cache
@@ -253,7 +277,8 @@ class RelPositionMultiHeadedAttention(MultiHeadedAttention):
         value: torch.Tensor,
         mask: torch.Tensor = torch.ones((0, 0, 0), dtype=torch.bool),
         pos_emb: torch.Tensor = torch.empty(0),
-        cache: torch.Tensor = torch.zeros((0, 0, 0, 0))
+        cache: torch.Tensor = torch.zeros((0, 0, 0, 0)),
+        cache_offset: int = -1
     ) -> Tuple[torch.Tensor, torch.Tensor]:
         """Compute 'Scaled Dot Product Attention' with rel. positional encoding.
         Args:
@@ -267,6 +292,10 @@ class RelPositionMultiHeadedAttention(MultiHeadedAttention):
             cache (torch.Tensor): Cache tensor (1, head, cache_t, d_k * 2),
                 where `cache_t == chunk_size * num_decoding_left_chunks`
                 and `head * d_k == size`
+            cache_offset (int): -1 to concatenate cache, otherwise cache is a
+                preallocated (1, head, max_t, d_k * 2) buffer with cache_offset
+                valid positions, new keys and values are written in place
+                after them and the buffer is returned as the new cache
         Returns:
             torch.Tensor: Output tensor (#batch, time1, d_model).
             torch.Tensor: Cache tensor (1, head, cache_t + time1, d_k * 2)
@@ -292,15 +321,18 @@ class RelPositionMultiHeadedAttention(MultiHeadedAttention):
         # >>> torch.equal(b, c)        # True
         # >>> d = torch.split(a, 2, dim=-1)
         # >>> torch.equal(d[0], d[1])  # True
-        if cache.size(0) > 0:
-            key_cache, value_cache = torch.split(cache,
-                                                 cache.size(-1) // 2,
-                                                 dim=-1)
-            k = torch.cat([key_cache, k], dim=2)
-            v = torch.cat([value_cache, v], dim=2)
-        # NOTE(xcsong): We do cache slicing in encoder.forward_chunk, since it's
-        #   non-trivial to calculate `next_cache_start` here.
-        new_cache = torch.cat((k, v), dim=-1)
+        if cache_offset >= 0:
+            k, v, new_cache = self.write_cache(k, v, cache, cache_offset)
+        else:
+            if cache.size(0) > 0:
+                key_cache, value_cache = torch.split(cache,
+                                                     cache.size(-1) // 2,
+                                                     dim=-1)
+                k = torch.cat([key_cache, k], dim=2)
+                v = torch.cat([value_cache, v], dim=2)
+            # NOTE(xcsong): We do cache slicing in encoder.forward_chunk, since it's
+            #   non-trivial to calculate `next_cache_start` here.
+            new_cache = torch.cat((k, v), dim=-1)
 
         n_batch_pos = pos_emb.size(0)
         p = self.linear_pos(pos_emb).view(n_batch_pos, -1, self.h, self.d_k)
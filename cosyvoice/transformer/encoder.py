@@ -189,6 +189,7 @@ class BaseEncoder(torch.nn.Module):
         att_cache: torch.Tensor = torch.zeros(0, 0, 0, 0),
         cnn_cache: torch.Tensor = torch.zeros(0, 0, 0, 0),
         att_mask: torch.Tensor = torch.ones((0, 0, 0), dtype=torch.bool),
+        cache_offset: int = -1,
     ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
         """ Forward just one chunk
 
@@ -209,6 +210,11 @@ class BaseEncoder(torch.nn.Module):
             cnn_cache (torch.Tensor): cache tensor for cnn_module in conformer,
                 (elayers, b=1, hidden-dim, cache_t2), where
                 `cache_t2 == cnn.lorder - 1`
+            cache_offset (int): -1 to concatenate att_cache, otherwise
+                att_cache is a preallocated buffer from init_att_cache with
+                cache_offset valid positions, keys and values of xs are written
+                in place after them and the buffer is returned as the new
+                attention cache, only required_cache_size < 0 is supported
 
         Returns:
             torch.Tensor: output of current input xs,
@@ -233,6 +239,9 @@ class BaseEncoder(torch.nn.Module):
         xs, pos_emb, _ = self.embed(xs, tmp_masks, offset)
         # NOTE(xcsong): After  embed, shape(xs) is (b=1, chunk_size, hidden-dim)
         elayers, cache_t1 = att_cache.size(0), att_cache.size(2)
+        if cache_offset >= 0:
+            assert required_cache_size < 0
+            cache_t1 = cache_offset
         chunk_size = xs.size(1)
         attention_key_size = cache_t1 + chunk_size
         pos_emb = self.embed.position_encoding(offset=offset - cache_t1,
@@ -254,23 +263,34 @@ class BaseEncoder(torch.nn.Module):
                 att_mask,
                 pos_emb,
                 att_cache=att_cache[i:i + 1] if elayers > 0 else att_cache,
-                cnn_cache=cnn_cache[i] if cnn_cache.size(0) > 0 else cnn_cache)
+                cnn_cache=cnn_cache[i] if cnn_cache.size(0) > 0 else cnn_cache,
+                cache_offset=cache_offset)
             # NOTE(xcsong): After layer.forward
             #   shape(new_att_cache) is (1, head, attention_key_size, d_k * 2),
             #   shape(new_cnn_cache) is (b=1, hidden-dim, cache_t2)
-            r_att_cache.append(new_att_cache[:, :, next_cache_start:, :])
+            if cache_offset < 0:
+                r_att_cache.append(new_att_cache[:, :, next_cache_start:, :])
             r_cnn_cache.append(new_cnn_cache.unsqueeze(0))
         if self.normalize_before:
             xs = self.after_norm(xs)
 
         # NOTE(xcsong): shape(r_att_cache) is (elayers, head, ?, d_k * 2),
         #   ? may be larger than cache_t1, it depends on required_cache_size
-        r_att_cache = torch.cat(r_att_cache, dim=0)
+        # NOTE layers wrote into att_cache in place when cache_offset >= 0
+        r_att_cache = torch.cat(r_att_cache, dim=0) if cache_offset < 0 else att_cache
         # NOTE(xcsong): shape(r_cnn_cache) is (e, b=1, hidden-dim, cache_t2)
         r_cnn_cache = torch.cat(r_cnn_cache, dim=0)
 
         return (xs, r_att_cache, r_cnn_cache)
 
+    @torch.jit.unused
+    def init_att_cache(self, max_len: int, device: torch.device, dtype: torch.dtype) -> torch.Tensor:
+        """ Preallocated attention cache of max_len positions for forward_chunk with cache_offset >= 0,
+        (elayers, head, max_len, d_k * 2)
+        """
+        attn = self.encoders[0].self_attn
+        return torch.zeros((len(self.encoders), attn.h, max_len, attn.d_k * 2), device=device, dtype=dtype)
+
     @torch.jit.unused
     def forward_chunk_by_chunk(
         self,
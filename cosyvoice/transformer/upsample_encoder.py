@@ -15,7 +15,7 @@
 # limitations under the License.
 # Modified from ESPnet(https://github.com/espnet/espnet)
 """Encoder definition."""
-from typing import Tuple
+from typing import Dict, Optional, Tuple
 
 import torch
 from torch import nn
@@ -32,6 +32,7 @@ from cosyvoice.utils.class_utils import (
 )
 from cosyvoice.utils.mask import make_pad_mask
 from cosyvoice.utils.mask import add_optional_chunk_mask
+from cosyvoice.utils.mask import subsequent_chunk_mask
 
 
 class Upsample1D(nn.Module):
@@ -62,6 +63,17 @@ class Upsample1D(nn.Module):
         outputs = self.conv(outputs)
         return outputs, input_lengths * self.stride
 
+    def forward_chunk(self, inputs: torch.Tensor, cache: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        inputs: (batch_size, channels, seq_len)
+        cache: (batch_size, channels, 2), last 2 inputs of previous chunk, zeros for the first chunk
+        """
+        # NOTE stride * 2 padded frames are exactly the interpolated last 2 inputs
+        inputs = torch.concat([cache, inputs], dim=2)
+        outputs = F.interpolate(inputs, scale_factor=float(self.stride), mode="nearest")
+        outputs = self.conv(outputs)
+        return outputs, inputs[:, :, -2:]
+
 
 class PreLookaheadLayer(nn.Module):
     def __init__(self, channels: int, pre_lookahead_len: int = 1):
@@ -101,6 +113,27 @@ class PreLookaheadLayer(nn.Module):
         outputs = outputs + inputs
         return outputs
 
+    def forward_chunk(self, inputs: torch.Tensor, context: torch.Tensor, cache: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        inputs: (batch_size, seq_len, channels)
+        context: (batch_size, pre_lookahead_len, channels)
+        cache: (batch_size, channels, 2), last 2 conv1 outputs of previous chunk, zeros for the first chunk
+        """
+        outputs = inputs.transpose(1, 2).contiguous()
+        context = context.transpose(1, 2).contiguous()
+        # look ahead
+        outputs = F.pad(torch.concat([outputs, context], dim=2), (0, self.pre_lookahead_len - context.size(2)), mode='constant', value=0.0)
+        outputs = F.leaky_relu(self.conv1(outputs))
+        # outputs, cached conv1 outputs replace the causal padding
+        outputs = torch.concat([cache, outputs], dim=2)
+        new_cache = outputs[:, :, -(self.conv2.kernel_size[0] - 1):]
+        outputs = self.conv2(outputs)
+        outputs = outputs.transpose(1, 2).contiguous()
+
+        # residual connection
+        outputs = outputs + inputs
+        return outputs, new_cache
+
 
 class UpsampleConformerEncoder(torch.nn.Module):
 
@@ -305,6 +338,70 @@ class UpsampleConformerEncoder(torch.nn.Module):
         # for cross attention with decoder later
         return xs, masks
 
+    def forward_chunk(
+        self,
+        xs: torch.Tensor,
+        context: torch.Tensor,
+        cache: Optional[Dict[str, torch.Tensor]] = None,
+    ) -> Tuple[torch.Tensor, Dict[str, torch.Tensor]]:
+        """Streaming encode of new tokens only, carrying caches across chunks.
+
+        Every chunk must start at a multiple of static_chunk_size, then the output equals
+        the new frames of forward(all tokens, streaming=True), as chunk masks never let
+        earlier frames see later ones.
+
+        Args:
+            xs: new input tensor (1, T, D)
+            context: lookahead input tensor (1, pre_lookahead_len, D)
+            cache: returned by previous forward_chunk, None for the first chunk
+                pre_lookahead: (1, D, 2) last conv1 outputs of pre_lookahead_layer
+                att: (num_blocks, head, cache_t, d_k * 2) key and value of encoders
+                up: (1, D, 2) last inputs of up_layer
+                up_att: (num_up_blocks, head, cache_t * 2, d_k * 2) key and value of up_encoders
+        Returns:
+            xs: output tensor of new frames (1, T * stride, D)
+            cache: cache for next chunk
+        """
+        assert self.training is False and xs.size(0) == 1 and self.static_chunk_size > 0
+        if cache is None:
+            cache = {'pre_lookahead': xs.new_zeros(1, xs.size(2), 2),
+                     'att': xs.new_zeros(len(self.encoders), 0, 0, 0),
+                     'up': xs.new_zeros(1, xs.size(2), 2),
+                     'up_att': xs.new_zeros(len(self.up_encoders), 0, 0, 0)}
+        offset = cache['att'].size(2)
+        if self.global_cmvn is not None:
+            xs = self.global_cmvn(xs)
+        masks = torch.ones(1, 1, xs.size(1), dtype=torch.bool, device=xs.device)
+        # NOTE pos_emb of offset covers relative positions of cached keys, see RelPositionMultiHeadedAttention.rel_shift
+        xs, pos_emb, masks = self.embed(xs, masks, offset=offset)
+        context, _, _ = self.embed(context, torch.ones(1, 1, context.size(1)).to(masks), offset=offset + xs.size(1))
+        chunk_masks = subsequent_chunk_mask(xs.size(1), self.static_chunk_size, device=xs.device, offset=offset).unsqueeze(0)
+        # lookahead + conformer encoder
+        xs, pre_lookahead_cache = self.pre_lookahead_layer.forward_chunk(xs, context, cache['pre_lookahead'])
+        att_cache = []
+        for i, layer in enumerate(self.encoders):
+            xs, _, new_att_cache, _ = layer(xs, chunk_masks, pos_emb, masks, att_cache=cache['att'][i:i + 1] if offset > 0 else torch.zeros(0, 0, 0, 0))
+            att_cache.append(new_att_cache)
+
+        # upsample + conformer encoder
+        xs, up_cache = self.up_layer.forward_chunk(xs.transpose(1, 2).contiguous(), cache['up'])
+        xs = xs.transpose(1, 2).contiguous()
+        up_offset = offset * self.up_layer.stride
+        masks = torch.ones(1, 1, xs.size(1), dtype=torch.bool, device=xs.device)
+        xs, pos_emb, masks = self.up_embed(xs, masks, offset=up_offset)
+        chunk_masks = subsequent_chunk_mask(xs.size(1), self.static_chunk_size * self.up_layer.stride, device=xs.device, offset=up_offset).unsqueeze(0)
+        up_att_cache = []
+        for i, layer in enumerate(self.up_encoders):
+            xs, _, new_att_cache, _ = layer(xs, chunk_masks, pos_emb, masks, att_cache=cache['up_att'][i:i + 1] if offset > 0 else torch.zeros(0, 0, 0, 0))
+            up_att_cache.append(new_att_cache)
+
+        if self.normalize_before:
+            xs = self.after_norm(xs)
+        return xs, {'pre_lookahead': pre_lookahead_cache,
+                    'att': torch.concat(att_cache, dim=0),
+                    'up': up_cache,
+                    'up_att': torch.concat(up_att_cache, dim=0)}
+
     def forward_layers(self, xs: torch.Tensor, chunk_masks: torch.Tensor,
                        pos_emb: torch.Tensor,
                        mask_pad: torch.Tensor) -> torch.Tensor:
@@ -75,9 +75,9 @@ COSYVOICE_ATTENTION_CLASSES = {
 
 
 def get_model_type(configs):
-    # NOTE CosyVoice2Model inherits CosyVoiceModel
-    if isinstance(configs['llm'], TransformerLM) and isinstance(configs['flow'], MaskedDiffWithXvec) and isinstance(configs['hift'], HiFTGenerator):
+    # NOTE CosyVoice2Model inherits CosyVoiceModel, llm is None when it is not loaded yet, then flow decides
+    if (configs['llm'] is None or isinstance(configs['llm'], TransformerLM)) and isinstance(configs['flow'], MaskedDiffWithXvec) and isinstance(configs['hift'], HiFTGenerator):
         return CosyVoiceModel
-    if isinstance(configs['llm'], Qwen2LM) and isinstance(configs['flow'], CausalMaskedDiffWithXvec) and isinstance(configs['hift'], HiFTGenerator):
+    if (configs['llm'] is None or isinstance(configs['llm'], Qwen2LM)) and isinstance(configs['flow'], CausalMaskedDiffWithXvec) and isinstance(configs['hift'], HiFTGenerator):
         return CosyVoice2Model
     raise TypeError('No valid model type found!')
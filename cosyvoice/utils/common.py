@@ -107,35 +107,129 @@ def init_weights(m, mean=0.0, std=0.01):
         m.weight.data.normal_(mean, std)
 
 
+class TokenWindow:
+    """ Ring buffer of the last capacity decoded tokens of a batch of sessions, kept on device,
+    so that ras_sampling counts repetitions without building tensors from lists or host syncs.
+
+    Every row appends one token per step, so rows share the write offset, the order of tokens in
+    a row does not matter for counting. Empty slots are -1 and never match a token.
+    """
+
+    def __init__(self, batch_size: int = 1, capacity: int = 32, device: torch.device = torch.device('cpu')):
+        self.tokens = torch.full((batch_size, capacity), -1, dtype=torch.long, device=device)
+        self.offset = 0
+        # recent[o, j] is the slot of the token written j + 1 steps ago when the next write offset is o
+        index = torch.arange(capacity, device=device)
+        self.recent = (index.unsqueeze(dim=1) - 1 - index) % capacity
+
+    def append(self, ids):
+        """ ids: int for batch 1, or (batch,) / (batch, 1) tensor """
+        self.tokens[:, self.offset] = ids if isinstance(ids, int) else ids.reshape(-1)
+        self.offset = (self.offset + 1) % self.tokens.size(1)
+
+    def count(self, ids, win_size):
+        """ Number of the last win_size tokens of every row which equal each of ids (batch, n), returns (batch, n) """
+        assert win_size <= self.tokens.size(1), 'win_size {} is larger than capacity {}'.format(win_size, self.tokens.size(1))
+        tokens = self.tokens[:, self.recent[self.offset, :win_size]]
+        return (tokens.unsqueeze(dim=1) == ids.unsqueeze(dim=2)).sum(dim=-1, dtype=torch.int32)
+
+    def select(self, index):
+        """ Keep rows of index, e.g. sessions that are still decoding """
+        self.tokens = self.tokens[index]
+
+    def extend(self, batch_size):
+        """ Append empty rows for new sessions """
+        self.tokens = torch.concat([self.tokens, self.tokens.new_full((batch_size, self.tokens.size(1)), -1)], dim=0)
+
+
 # Repetition Aware Sampling in VALL-E 2
-def ras_sampling(weighted_scores, decoded_tokens, sampling, top_p=0.8, top_k=25, win_size=10, tau_r=0.1):
-    top_ids = nucleus_sampling(weighted_scores, top_p=top_p, top_k=top_k)
-    rep_num = (torch.tensor(decoded_tokens[-win_size:]).to(weighted_scores.device) == top_ids).sum().item()
-    if rep_num >= win_size * tau_r:
-        top_ids = random_sampling(weighted_scores, decoded_tokens, sampling)
-    return top_ids
+def ras_sampling(weighted_scores, decoded_tokens, sampling, top_p=0.8, top_k=25, win_size=10, tau_r=0.1, mask=None):
+    # NOTE decoded_tokens is a TokenWindow in llm decode loops, and may be a list elsewhere
+    if not isinstance(decoded_tokens, TokenWindow):
+        window = TokenWindow(capacity=max(win_size, 1), device=weighted_scores.device)
+        for token in decoded_tokens[-win_size:]:
+            window.append(token)
+        decoded_tokens = window
+    if weighted_scores.dim() == 2:
+        return ras_sampling_batch(weighted_scores, decoded_tokens, top_p=top_p, top_k=top_k, win_size=win_size, tau_r=tau_r, mask=mask)
+    mask = mask.unsqueeze(dim=0) if mask is not None else None
+    return ras_sampling_batch(weighted_scores.unsqueeze(dim=0), decoded_tokens, top_p=top_p, top_k=top_k, win_size=win_size, tau_r=tau_r, mask=mask)[0]
+
+
+def ras_sampling_batch(weighted_scores, window, top_p=0.8, top_k=25, win_size=10, tau_r=0.1, mask=None):
+    """ ras_sampling of every row of weighted_scores (batch, vocab), window holds the decoded tokens of
+    every row, returns ids (batch, 1). On gpu no host sync is needed.
+
+    ras_sampling draws a nucleus candidate, and replaces it with a random sample when it repeats.
+    Both branches are one categorical over the nucleus candidates which do not repeat plus the
+    random branch, weighted by the probability of the candidates which repeat. Ids where mask is
+    True are removed from both branches, which is the distribution of resampling until an allowed
+    id is drawn, with one draw.
+    """
+    top_prob, top_idx = nucleus_candidates(weighted_scores, top_p=top_p, top_k=top_k)
+    repeated = window.count(top_idx, win_size) >= win_size * tau_r
+    weights = torch.concat([top_prob * ~repeated, (top_prob * repeated).sum(dim=-1, keepdim=True)], dim=-1)
+    if mask is not None:
+        mask = mask.expand_as(weighted_scores)
+        allowed = torch.concat([~mask.gather(-1, top_idx), mask.new_ones(mask.size(0), 1)], dim=-1)
+        # the random branch only draws allowed ids
+        weights[:, -1:] *= weighted_scores.softmax(dim=-1).masked_fill(mask, 0).sum(dim=-1, keepdim=True)
+        weights = mask_candidates(weights, allowed)
+    choice = weights.multinomial(1, replacement=True)
+    use_random = choice == top_idx.size(-1)
+    top_ids = top_idx.gather(-1, choice.clamp(max=top_idx.size(-1) - 1))
+    if not weighted_scores.is_cuda:
+        # NOTE host sync is free on cpu, only draw random samples for the rows which need them
+        index = use_random.squeeze(dim=1).nonzero().squeeze(dim=1)
+        if index.numel() != 0:
+            top_ids[index] = random_sampling(weighted_scores[index], window, None, mask=mask[index] if mask is not None else None)
+        return top_ids
+    return torch.where(use_random, random_sampling(weighted_scores, window, None, mask=mask), top_ids)
+
+
+def nucleus_sampling(weighted_scores, top_p=0.8, top_k=25, mask=None):
+    mask = mask.unsqueeze(dim=0) if mask is not None else None
+    return nucleus_sampling_batch(weighted_scores.unsqueeze(dim=0), top_p=top_p, top_k=top_k, mask=mask)[0]
+
+
+def nucleus_sampling_batch(weighted_scores, top_p=0.8, top_k=25, mask=None):
+    """ Top-k and top-p sampling of every row of weighted_scores (batch, vocab), returns ids (batch, 1).
+    Ids where mask (broadcastable to weighted_scores) is True are removed from the nucleus.
+    """
+    top_prob, top_idx = nucleus_candidates(weighted_scores, top_p=top_p, top_k=top_k)
+    if mask is not None:
+        top_prob = mask_candidates(top_prob, ~mask.expand_as(weighted_scores).gather(-1, top_idx))
+    return top_idx.gather(-1, top_prob.multinomial(1, replacement=True))
 
 
-def nucleus_sampling(weighted_scores, top_p=0.8, top_k=25):
-    prob, indices = [], []
-    cum_prob = 0.0
-    sorted_value, sorted_idx = weighted_scores.softmax(dim=0).sort(descending=True, stable=True)
-    for i in range(len(sorted_idx)):
-        # sampling both top-p and numbers.
-        if cum_prob < top_p and len(prob) < top_k:
-            cum_prob += sorted_value[i]
-            prob.append(sorted_value[i])
-            indices.append(sorted_idx[i])
-        else:
-            break
-    prob = torch.tensor(prob).to(weighted_scores)
-    indices = torch.tensor(indices, dtype=torch.long).to(weighted_scores.device)
-    top_ids = indices[prob.multinomial(1, replacement=True)]
-    return top_ids
+def nucleus_candidates(weighted_scores, top_p=0.8, top_k=25):
+    """ The top_k most probable ids (batch, top_k) of every row of weighted_scores (batch, vocab), and
+    their probability, zero out of the nucleus.
+
+    Ids are kept from the most probable one while the cumulative probability before them is below
+    top_p, top_p may also be a (batch,) tensor.
+    """
+    prob = weighted_scores.softmax(dim=-1)
+    # NOTE topk is sorted, and ids after the top_k ones are never kept, so the vocabulary is not sorted
+    top_prob, top_idx = prob.topk(min(top_k, prob.size(-1)), dim=-1)
+    top_p = top_p.unsqueeze(dim=-1) if torch.is_tensor(top_p) else top_p
+    keep = top_prob.cumsum(dim=-1) - top_prob < top_p
+    return top_prob.masked_fill(~keep, 0), top_idx
+
+
+def mask_candidates(weights, allowed):
+    """ Zero weights (batch, n) of candidates which are not allowed. A row with no weight left, where
+    resampling would never draw an allowed id, keeps its first allowed candidate, the most probable one.
+    """
+    weights = weights * allowed
+    empty = weights.sum(dim=-1, keepdim=True) == 0
+    return weights + (empty & allowed & (allowed.cumsum(dim=-1) == 1))
 
 
-def random_sampling(weighted_scores, decoded_tokens, sampling):
-    top_ids = weighted_scores.softmax(dim=0).multinomial(1, replacement=True)
+def random_sampling(weighted_scores, decoded_tokens, sampling, mask=None):
+    if mask is not None:
+        weighted_scores = weighted_scores.masked_fill(mask, -float('inf'))
+    top_ids = weighted_scores.softmax(dim=-1).multinomial(1, replacement=True)
     return top_ids
 
 
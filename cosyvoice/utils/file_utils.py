@@ -50,6 +50,49 @@ def load_wav(wav, target_sr):
     return speech
 
 
+def get_checkpoint(model_dir, name):
+    # NOTE prefer {name}.safetensors written by cosyvoice/bin/export_safetensors.py
+    if os.path.exists('{}/{}.safetensors'.format(model_dir, name)):
+        return '{}/{}.safetensors'.format(model_dir, name)
+    return '{}/{}.pt'.format(model_dir, name)
+
+
+def load_checkpoint(checkpoint, device):
+    """ Load state dict from .pt or .safetensors file.
+
+    safetensors on cpu are memory mapped instead of copied, load them with
+    load_state_dict(assign=True) so that parameters keep pointing to the page cache,
+    which is then shared by all worker processes.
+    """
+    if checkpoint.endswith('.safetensors'):
+        from safetensors import safe_open
+        from safetensors.torch import load_file
+        with safe_open(checkpoint, framework='pt') as f:
+            metadata = f.metadata() or {}
+        state_dict = load_file(checkpoint, device=str(device))
+        # NOTE tied tensors are written once by export_safetensors.py, alias them to the kept one
+        for k, v in json.loads(metadata.get('tied', '{}')).items():
+            state_dict[k] = state_dict[v]
+        return state_dict
+    return torch.load(checkpoint, map_location=device)
+
+
+def load_state_dict(model, state_dict, assign=False):
+    """ model.load_state_dict(strict=True), and with assign=True tie again the parameters the model
+    shares under several names, e.g. qwen2 embed_tokens and lm_head. assign gives every name its own
+    parameter, which half() or to() would then convert into separate copies.
+    """
+    tied = {}
+    for name, param in model.named_parameters(remove_duplicate=False):
+        tied.setdefault(id(param), []).append(name)
+    model.load_state_dict(state_dict, strict=True, assign=assign)
+    for names in tied.values():
+        param = model.get_parameter(names[0])
+        for name in names[1:]:
+            module_name, _, param_name = name.rpartition('.')
+            setattr(model.get_submodule(module_name), param_name, param)
+
+
 def convert_onnx_to_trt(trt_model, trt_kwargs, onnx_model, fp16):
     import tensorrt as trt
     logging.info("Converting onnx to trt...")
@@ -69,9 +112,15 @@ def convert_onnx_to_trt(trt_model, trt_kwargs, onnx_model, fp16):
             for error in range(parser.num_errors):
                 print(parser.get_error(error))
             raise ValueError('failed to parse {}'.format(onnx_model))
-    # set input shapes
+    # set input shapes, static dims of the onnx model (e.g. batch 2 of older estimator exports) override trt_kwargs
+    network_inputs = {network.get_input(i).name: network.get_input(i) for i in range(network.num_inputs)}
     for i in range(len(trt_kwargs['input_names'])):
-        profile.set_shape(trt_kwargs['input_names'][i], trt_kwargs['min_shape'][i], trt_kwargs['opt_shape'][i], trt_kwargs['max_shape'][i])
+        static_shape = tuple(network_inputs[trt_kwargs['input_names'][i]].shape)
+        if -1 not in static_shape:
+            continue
+        shapes = [tuple(d if d != -1 else s for d, s in zip(static_shape, shape))
+                  for shape in [trt_kwargs['min_shape'][i], trt_kwargs['opt_shape'][i], trt_kwargs['max_shape'][i]]]
+        profile.set_shape(trt_kwargs['input_names'][i], *shapes)
     tensor_dtype = trt.DataType.HALF if fp16 else trt.DataType.FLOAT
     # set input and output data type
     for i in range(network.num_inputs):
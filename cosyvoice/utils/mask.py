@@ -129,6 +129,7 @@ def subsequent_chunk_mask(
         chunk_size: int,
         num_left_chunks: int = -1,
         device: torch.device = torch.device("cpu"),
+        offset: int = 0,
 ) -> torch.Tensor:
     """Create mask for subsequent steps (size, size) with chunk size,
        this is for streaming encoder
@@ -140,6 +141,8 @@ def subsequent_chunk_mask(
             <0: use full chunk
             >=0: use num_left_chunks
         device (torch.device): "cpu" or "cuda" or torch.Tensor.device
+        offset (int): number of cached steps before the first query,
+            the mask is then (size, offset + size)
 
     Returns:
         torch.Tensor: mask
@@ -152,8 +155,8 @@ def subsequent_chunk_mask(
          [1, 1, 1, 1]]
     """
     # NOTE this modified implementation meets onnx export requirements, but it doesn't support num_left_chunks
-    pos_idx = torch.arange(size, device=device)
-    block_value = (torch.div(pos_idx, chunk_size, rounding_mode='trunc') + 1) * chunk_size
+    pos_idx = torch.arange(offset + size, device=device)
+    block_value = (torch.div(pos_idx[offset:], chunk_size, rounding_mode='trunc') + 1) * chunk_size
     ret = pos_idx.unsqueeze(0) < block_value.unsqueeze(1)
     return ret
 
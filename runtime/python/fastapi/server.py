@@ -15,10 +15,12 @@ import os
 import sys
 import argparse
 import logging
+import threading
 logging.getLogger('matplotlib').setLevel(logging.WARNING)
 from fastapi import FastAPI, UploadFile, Form, File
 from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.concurrency import iterate_in_threadpool
 import uvicorn
 import numpy as np
 ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -37,48 +39,57 @@ app.add_middleware(
     allow_headers=["*"])
 
 
-def generate_data(model_output):
-    for i in model_output:
-        tts_audio = (i['tts_speech'].numpy() * (2 ** 15)).astype(np.int16).tobytes()
-        yield tts_audio
+async def generate_data(model_output, cancel_event):
+    # when client disconnects the response task is cancelled, cancel_event stops the synthesis at its next step
+    try:
+        async for i in iterate_in_threadpool(model_output):
+            tts_audio = (i['tts_speech'].numpy() * (2 ** 15)).astype(np.int16).tobytes()
+            yield tts_audio
+    finally:
+        cancel_event.set()
 
 
 @app.get("/inference_sft")
 @app.post("/inference_sft")
 async def inference_sft(tts_text: str = Form(), spk_id: str = Form()):
-    model_output = cosyvoice.inference_sft(tts_text, spk_id)
-    return StreamingResponse(generate_data(model_output))
+    cancel_event = threading.Event()
+    model_output = cosyvoice.inference_sft(tts_text, spk_id, cancel_event=cancel_event)
+    return StreamingResponse(generate_data(model_output, cancel_event))
 
 
 @app.get("/inference_zero_shot")
 @app.post("/inference_zero_shot")
 async def inference_zero_shot(tts_text: str = Form(), prompt_text: str = Form(), prompt_wav: UploadFile = File()):
     prompt_speech_16k = load_wav(prompt_wav.file, 16000)
-    model_output = cosyvoice.inference_zero_shot(tts_text, prompt_text, prompt_speech_16k)
-    return StreamingResponse(generate_data(model_output))
+    cancel_event = threading.Event()
+    model_output = cosyvoice.inference_zero_shot(tts_text, prompt_text, prompt_speech_16k, cancel_event=cancel_event)
+    return StreamingResponse(generate_data(model_output, cancel_event))
 
 
 @app.get("/inference_cross_lingual")
 @app.post("/inference_cross_lingual")
 async def inference_cross_lingual(tts_text: str = Form(), prompt_wav: UploadFile = File()):
     prompt_speech_16k = load_wav(prompt_wav.file, 16000)
-    model_output = cosyvoice.inference_cross_lingual(tts_text, prompt_speech_16k)
-    return StreamingResponse(generate_data(model_output))
+    cancel_event = threading.Event()
+    model_output = cosyvoice.inference_cross_lingual(tts_text, prompt_speech_16k, cancel_event=cancel_event)
+    return StreamingResponse(generate_data(model_output, cancel_event))
 
 
 @app.get("/inference_instruct")
 @app.post("/inference_instruct")
 async def inference_instruct(tts_text: str = Form(), spk_id: str = Form(), instruct_text: str = Form()):
-    model_output = cosyvoice.inference_instruct(tts_text, spk_id, instruct_text)
-    return StreamingResponse(generate_data(model_output))
+    cancel_event = threading.Event()
+    model_output = cosyvoice.inference_instruct(tts_text, spk_id, instruct_text, cancel_event=cancel_event)
+    return StreamingResponse(generate_data(model_output, cancel_event))
 
 
 @app.get("/inference_instruct2")
 @app.post("/inference_instruct2")
 async def inference_instruct2(tts_text: str = Form(), instruct_text: str = Form(), prompt_wav: UploadFile = File()):
     prompt_speech_16k = load_wav(prompt_wav.file, 16000)
-    model_output = cosyvoice.inference_instruct2(tts_text, instruct_text, prompt_speech_16k)
-    return StreamingResponse(generate_data(model_output))
+    cancel_event = threading.Event()
+    model_output = cosyvoice.inference_instruct2(tts_text, instruct_text, prompt_speech_16k, cancel_event=cancel_event)
+    return StreamingResponse(generate_data(model_output, cancel_event))
 
 
 if __name__ == '__main__':
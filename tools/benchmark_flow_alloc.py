@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Count tensor allocations per streaming chunk of the flow ode solve, with and without the solver workspace.
+
+Every op output that does not share storage with an op input counts as one allocation, so the
+numbers are the same on cpu and gpu, estimator steps are counted apart. Chunks are either solved
+on the whole prefix (flow.decoder.forward, the default streaming path) or on new frames only
+(flow.decoder.forward_chunk, see CosyVoice2Model.enable_estimator_cache). Two requests run,
+the second one is counted. On gpu, the CausalConditionalCFM noise slice used to be copied to
+the device for every chunk, it moves to the device once now, which cpu counts do not show.
+"""
+import os
+import sys
+import argparse
+import torch
+from torch.utils._python_dispatch import TorchDispatchMode
+from torch.utils._pytree import tree_flatten
+sys.path.append('{}/..'.format(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append('{}/../third_party/Matcha-TTS'.format(os.path.dirname(os.path.abspath(__file__))))
+
+
+class AllocationCounter(TorchDispatchMode):
+
+    def __init__(self):
+        super().__init__()
+        # allocations of the estimator calls and of everything else, i.e. the solver
+        self.in_estimator = False
+        self.num_alloc = {True: 0, False: 0}
+        self.num_bytes = {True: 0, False: 0}
+
+    def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+        out = func(*args, **(kwargs or {}))
+        inputs = {t.untyped_storage().data_ptr() for t in tree_flatten((args, kwargs))[0] if isinstance(t, torch.Tensor)}
+        for t in tree_flatten(out)[0]:
+            if isinstance(t, torch.Tensor) and t.untyped_storage().nbytes() > 0 and t.untyped_storage().data_ptr() not in inputs:
+                self.num_alloc[self.in_estimator] += 1
+                self.num_bytes[self.in_estimator] += t.untyped_storage().nbytes()
+        return out
+
+
+def count_estimator(estimator, counter):
+    """ Attribute allocations of estimator steps to the estimator """
+    for name in ['forward', 'forward_prepared', 'forward_chunk']:
+        def wrapper(*args, fn=getattr(estimator, name), **kwargs):
+            counter[0].in_estimator = True
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                counter[0].in_estimator = False
+        setattr(estimator, name, wrapper)
+
+
+@torch.inference_mode()
+def run_chunks(decoder, args, device, use_forward_chunk):
+    mu = torch.randn(1, 80, args.num_chunks * args.chunk_frames, device=device)
+    spks = torch.randn(1, 80, device=device)
+    cond = torch.zeros(1, 80, mu.size(2), device=device)
+    counts, cache, counter = [], None, [None]
+    count_estimator(decoder.estimator, counter)
+    for i in range(args.num_chunks):
+        start, end = i * args.chunk_frames, (i + 1) * args.chunk_frames
+        counter[0] = AllocationCounter()
+        with counter[0]:
+            if use_forward_chunk:
+                _, cache = decoder.forward_chunk(mu[:, :, start:end], n_timesteps=args.n_timesteps, spks=spks,
+                                                 cond=cond[:, :, start:end], cache=cache)
+            else:
+                decoder(mu[:, :, :end], torch.ones(1, 1, end, device=device), n_timesteps=args.n_timesteps, spks=spks, cond=cond[:, :, :end])
+        counts.append((counter[0].num_alloc, counter[0].num_bytes))
+    for name in ['forward', 'forward_prepared', 'forward_chunk']:
+        delattr(decoder.estimator, name)
+    return counts
+
+
+def main(args):
+    from cosyvoice.cli.cosyvoice import CosyVoice, CosyVoice2
+    from cosyvoice.cli.buffer_pool import BufferPool
+    from cosyvoice.flow.flow_matching import CausalConditionalCFM
+    if os.path.exists('{}/cosyvoice2.yaml'.format(args.model_dir)):
+        cosyvoice = CosyVoice2(args.model_dir, components=[])
+    else:
+        cosyvoice = CosyVoice(args.model_dir, components=[])
+    decoder, device = cosyvoice.model.flow.decoder, cosyvoice.model.device
+    modes = [('forward', False)]
+    if isinstance(decoder, CausalConditionalCFM):
+        modes.append(('forward_chunk', True))
+    for name, use_forward_chunk in modes:
+        for workspace in [None, BufferPool(max_bytes=64 * 1024 * 1024)]:
+            decoder.workspace = workspace
+            # the first request fills the workspace, the second one is counted
+            run_chunks(decoder, args, device, use_forward_chunk)
+            counts = run_chunks(decoder, args, device, use_forward_chunk)
+            print('{:<14} workspace {:<5}  solver allocations/chunk {:6.1f} {:8.3f}MB  estimator allocations/chunk {:7.1f} {:8.2f}MB'.format(
+                name, str(workspace is not None),
+                sum(c[0][False] for c in counts) / len(counts), sum(c[1][False] for c in counts) / len(counts) / 1024 / 1024,
+                sum(c[0][True] for c in counts) / len(counts), sum(c[1][True] for c in counts) / len(counts) / 1024 / 1024))
+    decoder.workspace = BufferPool(max_bytes=64 * 1024 * 1024)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_dir', type=str, required=True)
+    parser.add_argument('--chunk_frames', type=int, default=50, help='mel frames per chunk, 25 tokens of CosyVoice2')
+    parser.add_argument('--num_chunks', type=int, default=8)
+    parser.add_argument('--n_timesteps', type=int, default=10)
+    args = parser.parse_args()
+    main(args)
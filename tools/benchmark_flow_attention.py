@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Compare cpu latency and peak rss of a flow decoder transformer block with a dense
+time x time bias (BasicTransformerBlock.forward) and with SDPABasicTransformerBlock.forward_sdpa.
+
+Every mode and length runs in a fresh process, so that peak rss is not shared between them.
+"""
+import os
+import sys
+import argparse
+import resource
+import subprocess
+import time
+import torch
+sys.path.append('{}/..'.format(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append('{}/../third_party/Matcha-TTS'.format(os.path.dirname(os.path.abspath(__file__))))
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+@torch.inference_mode()
+def run(args):
+    from cosyvoice.flow.decoder import SDPABasicTransformerBlock
+    from cosyvoice.utils.common import mask_to_bias
+    from cosyvoice.utils.mask import add_optional_chunk_mask
+    torch.set_num_threads(args.num_threads)
+    block = SDPABasicTransformerBlock(dim=args.dim, num_attention_heads=args.num_heads, attention_head_dim=args.dim // args.num_heads,
+                                      dropout=0.0, activation_fn='gelu').eval()
+    # classifier free guidance batch
+    x = torch.randn(2, args.seq_len, args.dim)
+    mask = torch.ones(2, 1, args.seq_len, dtype=torch.bool)
+    start_rss = peak_rss_mb()
+    start_time = time.time()
+    for _ in range(args.num_runs):
+        if args.mode == 'bias':
+            # what ConditionalDecoder.forward used to build for every block and step
+            if args.chunk_size > 0:
+                attn_mask = add_optional_chunk_mask(x, mask, False, False, 0, args.chunk_size, -1)
+            else:
+                attn_mask = add_optional_chunk_mask(x, mask, False, False, 0, 0, -1).repeat(1, x.size(1), 1)
+            block(x, attention_mask=mask_to_bias(attn_mask, x.dtype))
+        else:
+            block.forward_sdpa(x, mask, args.chunk_size)
+    print('{:<5} chunk_size {:3d} seq_len {:6d}  latency {:9.2f}ms  peak rss +{:8.1f}MB'.format(
+        args.mode, args.chunk_size, args.seq_len, (time.time() - start_time) * 1000 / args.num_runs, peak_rss_mb() - start_rss))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--seq_lens', type=int, nargs='+', default=[500, 1000, 2000, 4000])
+    parser.add_argument('--chunk_size', type=int, default=0, help='decoder static_chunk_size, 0 without chunk mask')
+    parser.add_argument('--dim', type=int, default=256)
+    parser.add_argument('--num_heads', type=int, default=8)
+    parser.add_argument('--num_runs', type=int, default=5)
+    parser.add_argument('--num_threads', type=int, default=4)
+    parser.add_argument('--mode', type=str, default='', choices=['', 'bias', 'sdpa'], help='empty to compare both')
+    parser.add_argument('--seq_len', type=int, default=0, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.mode != '':
+        run(args)
+    else:
+        for seq_len in args.seq_lens:
+            for mode in ['bias', 'sdpa']:
+                subprocess.run([sys.executable, os.path.abspath(__file__), '--mode', mode, '--seq_len', str(seq_len),
+                                '--chunk_size', str(args.chunk_size), '--dim', str(args.dim), '--num_heads', str(args.num_heads),
+                                '--num_runs', str(args.num_runs), '--num_threads', str(args.num_threads)], check=True)
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Compare flow throughput of batch_size requests run one by one with flow.inference and
+together with flow.inference_batch, and the max mel difference between the two.
+
+Requests are random streaming chunks (or whole utterances with --non_stream) of sessions with
+different prompts, like the chunks the flow stage batches with enable_engine(max_batch_size={'flow': n}).
+CosyVoice only groups requests of the same mel length, so all of them use one prompt there.
+"""
+import os
+import sys
+import argparse
+import time
+import torch
+sys.path.append('{}/..'.format(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append('{}/../third_party/Matcha-TTS'.format(os.path.dirname(os.path.abspath(__file__))))
+
+
+def make_requests(flow, args, batch_size, device, cosyvoice2):
+    requests = []
+    for i in range(batch_size):
+        num_prompt_token = args.prompt_tokens if not cosyvoice2 else args.prompt_tokens + 5 * i
+        num_prompt_feat = num_prompt_token * 2 if cosyvoice2 else int(num_prompt_token / flow.input_frame_rate * 22050 / 256)
+        request = {'token': torch.randint(0, flow.vocab_size, (1, args.num_tokens), device=device),
+                   'token_len': torch.tensor([args.num_tokens], device=device),
+                   'prompt_token': torch.randint(0, flow.vocab_size, (1, num_prompt_token), device=device),
+                   'prompt_token_len': torch.tensor([num_prompt_token], device=device),
+                   'prompt_feat': torch.randn(1, num_prompt_feat, 80, device=device),
+                   'prompt_feat_len': torch.tensor([num_prompt_feat], device=device),
+                   'embedding': torch.randn(1, 192, device=device)}
+        if cosyvoice2:
+            request.update({'streaming': not args.non_stream, 'finalize': args.non_stream})
+        else:
+            request['flow_cache'] = torch.zeros(1, 80, 0, 2, device=device)
+        requests.append(request)
+    return requests
+
+
+def timeit(fn, num_runs):
+    fn()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    start_time = time.time()
+    for _ in range(num_runs):
+        out = fn()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return (time.time() - start_time) / num_runs, out
+
+
+def main(args):
+    from cosyvoice.cli.cosyvoice import CosyVoice, CosyVoice2
+    torch.set_num_threads(args.num_threads)
+    cosyvoice2 = os.path.exists('{}/cosyvoice2.yaml'.format(args.model_dir))
+    cosyvoice = (CosyVoice2 if cosyvoice2 else CosyVoice)(args.model_dir, components=[])
+    flow, device = cosyvoice.model.flow, cosyvoice.model.device
+    for batch_size in args.batch_sizes:
+        requests = make_requests(flow, args, batch_size, device, cosyvoice2)
+        # NOTE CosyVoice draws noise from the global rng, reseed so that both see the same noise
+        torch.manual_seed(0)
+        sequential_time, sequential = timeit(lambda requests=requests: [flow.inference(**r)[0] for r in requests], args.num_runs)
+        torch.manual_seed(0)
+        batch_time, batch = timeit(lambda requests=requests: [feat for feat, _ in flow.inference_batch(requests)], args.num_runs)
+        diff = max((a - b).abs().max().item() for a, b in zip(sequential, batch))
+        print('batch_size {:2d}  sequential {:8.2f}ms  inference_batch {:8.2f}ms  speedup {:5.2f}x  max mel diff {:.2e}'.format(
+            batch_size, sequential_time * 1000, batch_time * 1000, sequential_time / batch_time, diff))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_dir', type=str, required=True)
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--num_tokens', type=int, default=28, help='speech tokens per request, a 25 token chunk with lookahead by default')
+    parser.add_argument('--prompt_tokens', type=int, default=75)
+    parser.add_argument('--non_stream', action='store_true')
+    parser.add_argument('--num_runs', type=int, default=5)
+    parser.add_argument('--num_threads', type=int, default=4)
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Simulate streaming playback with fixed and adaptive hop length.
+
+The llm produces tokens at --llm_rate token/s, one chunk of hop tokens costs
+(--chunk_overhead + --token_cost * hop) seconds, multiplied by --overload between
+--overload_start and --overload_end to mimic an overloaded host. The client starts
+playing at the first chunk and stalls whenever its buffer runs dry.
+Reports TTFB, number of underruns and total stall time for every policy.
+"""
+import os
+import sys
+import argparse
+sys.path.append('{}/..'.format(os.path.dirname(os.path.abspath(__file__))))
+from cosyvoice.cli.hop_policy import AdaptiveHopPolicy
+
+
+def chunk_cost(args, hop_len, now):
+    load = args.overload if args.overload_start <= now < args.overload_end else 1.0
+    return (args.chunk_overhead + args.token_cost * hop_len) * load
+
+
+def simulate(args, policy=None):
+    now, token_offset, play_end = 0.0, 0, None
+    ttfb, underruns, stall, num_chunk = None, 0, 0.0, 0
+    while token_offset < args.num_tokens:
+        hop_len = args.hop_len if policy is None else policy.next_hop_len(now)
+        hop_len = min(hop_len, args.num_tokens - token_offset)
+        start_time = now
+        # wait for llm, then synthesize this chunk
+        token_ready_time = min(token_offset + hop_len + args.lookahead_len, args.num_tokens) / args.llm_rate
+        now = max(now, token_ready_time) + chunk_cost(args, hop_len, now)
+        if policy is not None:
+            policy.update(start_time, now, hop_len)
+        duration = hop_len / args.token_rate
+        if play_end is None:
+            ttfb = now
+            play_end = now + duration
+        elif play_end < now:
+            underruns += 1
+            stall += now - play_end
+            play_end = now + duration
+        else:
+            play_end += duration
+        token_offset += hop_len
+        num_chunk += 1
+    return {'ttfb': ttfb, 'underruns': underruns, 'stall': stall, 'chunks': num_chunk, 'wall': now}
+
+
+def main(args):
+    policies = [('fixed {}'.format(args.hop_len), None)]
+    # NOTE no warm start run, host rtf is only read before the first update of a session, when the hop is min_hop_len anyway
+    policies.append(('adaptive', AdaptiveHopPolicy(args.token_rate, args.min_hop_len, args.max_hop_len, args.hop_step, margin=args.margin)))
+    print('{:<12} {:>8} {:>10} {:>9} {:>7} {:>8}'.format('policy', 'ttfb', 'underruns', 'stall', 'chunks', 'wall'))
+    for name, policy in policies:
+        r = simulate(args, policy)
+        print('{:<12} {:>7.2f}s {:>10} {:>8.2f}s {:>7} {:>7.2f}s'.format(name, r['ttfb'], r['underruns'], r['stall'], r['chunks'], r['wall']))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    # defaults follow CosyVoice2, 25 token/s, hop multiple of 25
+    parser.add_argument('--num_tokens', type=int, default=500)
+    parser.add_argument('--token_rate', type=float, default=25)
+    parser.add_argument('--llm_rate', type=float, default=60)
+    parser.add_argument('--lookahead_len', type=int, default=3)
+    parser.add_argument('--hop_len', type=int, default=25, help='hop length of fixed policy')
+    parser.add_argument('--min_hop_len', type=int, default=25)
+    parser.add_argument('--max_hop_len', type=int, default=100)
+    parser.add_argument('--hop_step', type=int, default=25)
+    parser.add_argument('--margin', type=float, default=0.3)
+    parser.add_argument('--chunk_overhead', type=float, default=0.3)
+    parser.add_argument('--token_cost', type=float, default=0.012)
+    parser.add_argument('--overload', type=float, default=2.5)
+    parser.add_argument('--overload_start', type=float, default=4)
+    parser.add_argument('--overload_end', type=float, default=12)
+    args = parser.parse_args()
+    main(args)
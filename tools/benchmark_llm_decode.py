@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Compare per token latency of llm decoding at the start and at the tail of a long utterance.
+
+CosyVoice2: the former decode step (causal lm with the hidden states of every layer, a
+concatenated cache and a (L, L) mask per token), Qwen2Encoder.forward_one_step, the default,
+and Qwen2Encoder.forward_static_step, opt-in by CosyVoice2Model.enable_static_cache.
+CosyVoice: TransformerLM forward_chunk with a concatenated cache and with a preallocated cache
+written in place (cache_offset).
+On gpu, allocator calls per token are counted too.
+"""
+import os
+import sys
+import argparse
+import time
+import torch
+sys.path.append('{}/..'.format(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append('{}/../third_party/Matcha-TTS'.format(os.path.dirname(os.path.abspath(__file__))))
+
+
+def former_step(encoder, xs, cache):
+    seq_len = xs.shape[1] if cache is None else xs.shape[1] + cache[0][0].size(2)
+    masks = torch.tril(torch.ones((1, seq_len, seq_len), device=xs.device)).to(torch.bool)
+    outs = encoder.model(inputs_embeds=xs, attention_mask=masks[:, -1, :], output_hidden_states=True,
+                         return_dict=True, use_cache=True, past_key_values=cache)
+    return outs.hidden_states[-1], outs.past_key_values
+
+
+def num_alloc(device):
+    return torch.cuda.memory_stats(device)['allocation.all.allocated'] if device.type == 'cuda' else 0
+
+
+@torch.inference_mode()
+def decode(encoder, step, args, device, dtype, input_size):
+    """ Prefill the prompt then feed num_tokens tokens, returns per token seconds and allocations """
+    xs = torch.randn(1, args.prompt_len, input_size, device=device, dtype=dtype)
+    next_xs = torch.randn(1, 1, input_size, device=device, dtype=dtype)
+    cache, offset = None, 0
+    if step == 'static':
+        cache = encoder.init_static_cache(args.prompt_len + args.num_tokens, device, dtype)
+    elif step in ['concat', 'inplace']:
+        att_cache = encoder.init_att_cache(args.prompt_len + args.num_tokens, device, dtype) if step == 'inplace' else \
+            torch.zeros((0, 0, 0, 0), device=device, dtype=dtype)
+        cache = (att_cache, torch.zeros((0, 0, 0, 0), device=device, dtype=dtype))
+    times, allocs = [], []
+    for i in range(args.num_tokens + 1):
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        start_time, start_alloc = time.time(), num_alloc(device)
+        if step == 'former':
+            y, cache = former_step(encoder, xs, cache)
+        elif step == 'one_step':
+            y, cache = encoder.forward_one_step(xs, cache=cache)
+        elif step == 'static':
+            y, cache = encoder.forward_static_step(xs, cache)
+        else:
+            # the mask TransformerLM.inference used to build for every token
+            att_mask = torch.tril(torch.ones((1, xs.shape[1], xs.shape[1]), device=device)).to(torch.bool)
+            kwargs = {'cache_offset': offset} if step == 'inplace' else {}
+            y, att_cache, cnn_cache = encoder.forward_chunk(xs, offset=offset, required_cache_size=-1, att_cache=cache[0], cnn_cache=cache[1],
+                                                            att_mask=att_mask, **kwargs)
+            cache = (att_cache, cnn_cache)
+            offset += xs.shape[1]
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        if i != 0:
+            times.append(time.time() - start_time)
+            allocs.append(num_alloc(device) - start_alloc)
+        xs = next_xs
+    return times, allocs
+
+
+def main(args):
+    from cosyvoice.cli.cosyvoice import CosyVoice, CosyVoice2
+    torch.set_num_threads(args.num_threads)
+    if os.path.exists('{}/cosyvoice2.yaml'.format(args.model_dir)):
+        cosyvoice, steps = CosyVoice2(args.model_dir, components=['llm']), ['former', 'one_step', 'static']
+    else:
+        cosyvoice, steps = CosyVoice(args.model_dir, components=['llm']), ['concat', 'inplace']
+    encoder, device = cosyvoice.model.llm.llm, cosyvoice.model.device
+    dtype, input_size = next(encoder.parameters()).dtype, cosyvoice.model.llm.llm_input_size
+    n = args.num_tokens // 10
+    for step in steps:
+        decode(encoder, step, args, device, dtype, input_size)
+        times, allocs = decode(encoder, step, args, device, dtype, input_size)
+        print('{:<9} first {} tokens {:7.3f}ms  last {} tokens {:7.3f}ms  allocations/token {:7.1f}'.format(
+            step, n, sum(times[:n]) * 1000 / n, n, sum(times[-n:]) * 1000 / n, sum(allocs) / len(allocs)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_dir', type=str, required=True)
+    parser.add_argument('--prompt_len', type=int, default=150, help='prompt text, text and prompt speech tokens')
+    parser.add_argument('--num_tokens', type=int, default=1500, help='decoded speech tokens, 60s of speech')
+    parser.add_argument('--num_threads', type=int, default=4)
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Compare load time and rss of llm/flow/hift in .pt and .safetensors format, end to end.
+
+Every format is loaded in a fresh process, run cosyvoice/bin/export_safetensors.py first.
+Time covers building the modules from the yaml and loading their checkpoints into them,
+as CosyVoice/CosyVoice2 do. rss is measured right after loading, mmapped safetensors pages
+are only counted once touched and are shared with other processes through the page cache.
+"""
+import os
+import sys
+import argparse
+import subprocess
+import time
+sys.path.append('{}/..'.format(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append('{}/../third_party/Matcha-TTS'.format(os.path.dirname(os.path.abspath(__file__))))
+
+
+def rss_mb():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 / 1024
+
+
+def load(args):
+    from hyperpyyaml import load_hyperpyyaml
+    from cosyvoice.utils.class_utils import get_model_type
+    start_rss, start_time = rss_mb(), time.time()
+    if os.path.exists('{}/cosyvoice2.yaml'.format(args.model_dir)):
+        # NOTE qwen weights are overwritten by llm checkpoint, as in CosyVoice2
+        hyper_yaml_path = '{}/cosyvoice2.yaml'.format(args.model_dir)
+        overrides = {'qwen_pretrain_path': os.path.join(args.model_dir, 'CosyVoice-BlankEN'), 'llm': {'llm': {'load_pretrained': False}}}
+    else:
+        hyper_yaml_path, overrides = '{}/cosyvoice.yaml'.format(args.model_dir), None
+    with open(hyper_yaml_path, 'r') as f:
+        configs = load_hyperpyyaml(f, overrides=overrides)
+    model = get_model_type(configs)(configs['llm'], configs['flow'], configs['hift'])
+    build_time = time.time() - start_time
+    model.load(*['{}/{}.{}'.format(args.model_dir, name, args.format) for name in ['llm', 'flow', 'hift']])
+    total_time = time.time() - start_time
+    print('{:<12} build {:8.3f}s  load {:8.3f}s  total {:8.3f}s  rss +{:8.1f}MB'.format(
+        args.format, build_time, total_time - build_time, total_time, rss_mb() - start_rss))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_dir', type=str, required=True)
+    parser.add_argument('--format', type=str, default='', choices=['', 'pt', 'safetensors'], help='empty to compare both')
+    args = parser.parse_args()
+    if args.format != '':
+        load(args)
+    else:
+        for f in ['pt', 'safetensors']:
+            subprocess.run([sys.executable, os.path.abspath(__file__), '--model_dir', args.model_dir, '--format', f], check=True)
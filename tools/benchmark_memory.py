@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Report buffer pool hit rate and peak memory of streaming tts.
+
+With --model_dir, run concurrent streaming zero shot inference and print
+cosyvoice.memory_stats(). Without --model_dir, replay the chunk buffer pattern of
+CosyVoice2Model.mel2wav (concatenated mel, mel/source/speech caches) for many sessions,
+with the BufferPool or with fresh tensors (--no_pool), peak rss is per process so run
+both modes separately to compare.
+"""
+import os
+import sys
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+import torch
+sys.path.append('{}/..'.format(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append('{}/../third_party/Matcha-TTS'.format(os.path.dirname(os.path.abspath(__file__))))
+from cosyvoice.cli.buffer_pool import BufferPool, peak_rss_mb
+from cosyvoice.cli.session import TTSSession
+
+
+def fake_session(pool, args):
+    session = TTSSession('', pool=pool)
+    mel_cache_len, source_cache_len = 8, 8 * 480
+    for i in range(args.num_chunks):
+        # chunk lengths vary a little like real streaming chunks
+        chunk_len = args.chunk_len + i % 3
+        tts_mel = torch.randn(1, 80, chunk_len)
+        hift_cache = session.hift_cache
+        if hift_cache is not None:
+            cache_mel = session.acquire((1, 80, mel_cache_len + chunk_len))
+            tts_mel = torch.concat([hift_cache['mel'], tts_mel], dim=2, out=cache_mel)
+        tts_source = torch.randn(1, 1, tts_mel.shape[2] * 480)
+        tts_speech = tts_source[:, 0]
+        session.hift_cache = {'mel': session.keep(tts_mel[:, :, -mel_cache_len:]),
+                              'source': session.keep(tts_source[:, :, -source_cache_len:]),
+                              'speech': session.keep(tts_speech[:, -source_cache_len:])}
+        if hift_cache is not None:
+            session.recycle(cache_mel, *hift_cache.values())
+    session.release()
+
+
+def benchmark_fake(args):
+    pool = None if args.no_pool else BufferPool()
+    start_time = time.time()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        for f in [executor.submit(fake_session, pool, args) for _ in range(args.num_runs)]:
+            f.result()
+    elapsed = time.time() - start_time
+    print('{} sessions x {} chunks, {:.2f}ms per chunk'.format(args.num_runs, args.num_chunks, elapsed * 1000 / (args.num_runs * args.num_chunks)))
+    print(pool.stats() if pool is not None else {'peak_rss_mb': peak_rss_mb()})
+
+
+def benchmark_model(args):
+    from cosyvoice.cli.cosyvoice import CosyVoice, CosyVoice2
+    from cosyvoice.utils.file_utils import load_wav
+    if os.path.exists('{}/cosyvoice2.yaml'.format(args.model_dir)):
+        cosyvoice = CosyVoice2(args.model_dir, fp16=args.fp16)
+    else:
+        cosyvoice = CosyVoice(args.model_dir, fp16=args.fp16)
+    prompt_speech_16k = load_wav(args.prompt_wav, 16000)
+
+    def single_job():
+        for _ in cosyvoice.inference_zero_shot(args.text, args.prompt_text, prompt_speech_16k, stream=True):
+            pass
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        for f in [executor.submit(single_job) for _ in range(args.num_runs)]:
+            f.result()
+    print(cosyvoice.memory_stats())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_dir', type=str, default='')
+    parser.add_argument('--prompt_wav', type=str, default='asset/zero_shot_prompt.wav')
+    parser.add_argument('--prompt_text', type=str, default='希望你以后能够做的比我还好呦。')
+    parser.add_argument('--text', type=str, default='收到好友从远方寄来的生日礼物，那份意外的惊喜与深深的祝福让我心中充满了甜蜜的快乐，笑容如花儿般绽放。')
+    parser.add_argument('--fp16', action='store_true')
+    parser.add_argument('--num_runs', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--num_chunks', type=int, default=20)
+    parser.add_argument('--chunk_len', type=int, default=50)
+    parser.add_argument('--no_pool', action='store_true')
+    args = parser.parse_args()
+    if args.model_dir != '':
+        benchmark_model(args)
+    else:
+        benchmark_fake(args)
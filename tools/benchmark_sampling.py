@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Compare per token latency of top-k/top-p sampling, the former python loop against
+nucleus_sampling and nucleus_sampling_batch, and check that they sample the same distribution.
+Also compare ras_sampling with a list of decoded tokens against a device TokenWindow.
+"""
+import os
+import sys
+import argparse
+import time
+import torch
+sys.path.append('{}/..'.format(os.path.dirname(os.path.abspath(__file__))))
+from cosyvoice.utils.common import nucleus_sampling, nucleus_sampling_batch, ras_sampling, TokenWindow
+
+
+def loop_nucleus_sampling(weighted_scores, top_p=0.8, top_k=25):
+    # the former implementation, one python iteration and scalar tensor per kept id
+    prob, indices = [], []
+    cum_prob = 0.0
+    sorted_value, sorted_idx = weighted_scores.softmax(dim=0).sort(descending=True, stable=True)
+    for i in range(len(sorted_idx)):
+        if cum_prob < top_p and len(prob) < top_k:
+            cum_prob += sorted_value[i]
+            prob.append(sorted_value[i])
+            indices.append(sorted_idx[i])
+        else:
+            break
+    prob = torch.tensor(prob).to(weighted_scores)
+    indices = torch.tensor(indices, dtype=torch.long).to(weighted_scores.device)
+    return indices[prob.multinomial(1, replacement=True)]
+
+
+def latency(fn, num_runs):
+    fn()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    start_time = time.time()
+    for _ in range(num_runs):
+        fn()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return (time.time() - start_time) / num_runs
+
+
+def main(args):
+    torch.set_num_threads(args.num_threads)
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    # llm like logits, a few likely ids and a long tail
+    weighted_scores = (torch.randn(max(args.batch_sizes), args.vocab_size, device=device) * args.temperature).log_softmax(dim=-1)
+
+    for batch_size in args.batch_sizes:
+        scores = weighted_scores[:batch_size]
+        loop_time = latency(lambda scores=scores: [loop_nucleus_sampling(x, args.top_p, args.top_k) for x in scores], args.num_runs)
+        vectorized_time = latency(lambda scores=scores: [nucleus_sampling(x, args.top_p, args.top_k) for x in scores], args.num_runs)
+        batch_time = latency(lambda scores=scores: nucleus_sampling_batch(scores, args.top_p, args.top_k), args.num_runs)
+        print('batch_size {:3d}  loop {:8.3f}ms  nucleus_sampling {:8.3f}ms  nucleus_sampling_batch {:8.3f}ms  per token {:8.4f}ms'.format(
+            batch_size, loop_time * 1000, vectorized_time * 1000, batch_time * 1000, batch_time * 1000 / batch_size))
+
+    # repetition aware sampling, decoded tokens as a list rebuilt every step or a device ring buffer
+    decoded_tokens = torch.randint(0, args.vocab_size, (args.num_decoded,)).tolist()
+    window = TokenWindow(device=device)
+    for token in decoded_tokens[-32:]:
+        window.append(token)
+    list_time = latency(lambda: ras_sampling(weighted_scores[0], decoded_tokens, 25, args.top_p, args.top_k), args.num_runs)
+    window_time = latency(lambda: ras_sampling(weighted_scores[0], window, 25, args.top_p, args.top_k), args.num_runs)
+    print('ras_sampling  list {:8.3f}ms  TokenWindow {:8.3f}ms'.format(list_time * 1000, window_time * 1000))
+    for batch_size in args.batch_sizes:
+        window = TokenWindow(batch_size, device=device)
+        batch_time = latency(lambda batch_size=batch_size, window=window: ras_sampling(weighted_scores[:batch_size], window, 25, args.top_p, args.top_k),
+                             args.num_runs)
+        print('batch_size {:3d}  ras_sampling batch {:8.3f}ms  per token {:8.4f}ms'.format(batch_size, batch_time * 1000, batch_time * 1000 / batch_size))
+
+    # total variation distance between sampled id histograms of the first row
+    loop_count = torch.zeros(args.vocab_size)
+    for _ in range(args.num_samples):
+        loop_count[loop_nucleus_sampling(weighted_scores[0], args.top_p, args.top_k).item()] += 1
+    batch_ids = nucleus_sampling_batch(weighted_scores[:1].expand(args.num_samples, -1), args.top_p, args.top_k)
+    batch_count = torch.bincount(batch_ids.reshape(-1).cpu(), minlength=args.vocab_size).float()
+    tv = (loop_count - batch_count).abs().sum().item() / 2 / args.num_samples
+    print('total variation distance of {} samples {:.4f}, same support {}'.format(
+        args.num_samples, tv, torch.equal(loop_count > 0, batch_count > 0)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--vocab_size', type=int, default=6564, help='CosyVoice2 speech tokens plus eos and fill tokens')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 4, 16, 64])
+    parser.add_argument('--top_p', type=float, default=0.8)
+    parser.add_argument('--top_k', type=int, default=25)
+    parser.add_argument('--temperature', type=float, default=3.0, help='scale of random logits, larger is more peaky')
+    parser.add_argument('--num_decoded', type=int, default=500, help='decoded tokens of a ras_sampling session')
+    parser.add_argument('--num_samples', type=int, default=20000)
+    parser.add_argument('--num_runs', type=int, default=100)
+    parser.add_argument('--num_threads', type=int, default=1)
+    args = parser.parse_args()
+    main(args)
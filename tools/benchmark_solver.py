@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Compare flow ode solvers and step counts by latency, NFE and mel mse.
+
+Speech tokens of the zero shot prompt are generated once, then non streaming token2mel
+runs for every solver x n_timesteps, mse is against the mel of 10 step euler. Every run is
+seeded with --seed, CosyVoice draws new prior noise on every call, so that all runs start from
+the same noise. The sanity row runs the reference again, its mse should be about 0.
+"""
+import os
+import sys
+import argparse
+import time
+import torch
+sys.path.append('{}/..'.format(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append('{}/../third_party/Matcha-TTS'.format(os.path.dirname(os.path.abspath(__file__))))
+from cosyvoice.cli.session import TTSSession
+from cosyvoice.flow.ode_solver import ODE_SOLVERS
+
+
+def token2mel(model, token, model_input, n_timesteps, seed):
+    # NOTE ConditionalCFM.prior draws torch.randn_like noise, seed it so runs are comparable
+    torch.manual_seed(seed)
+    session = TTSSession('')
+    session.flow_kwargs = {'n_timesteps': n_timesteps}
+    if hasattr(model, 'estimator_cache'):
+        return model.token2mel(token, model_input['flow_prompt_speech_token'], model_input['prompt_speech_feat'],
+                               model_input['flow_embedding'], 0, session, stream=False, finalize=True)
+    return model.token2mel(token, model_input['flow_prompt_speech_token'], model_input['prompt_speech_feat'],
+                           model_input['flow_embedding'], session)
+
+
+def main(args):
+    from cosyvoice.cli.cosyvoice import CosyVoice, CosyVoice2
+    from cosyvoice.utils.file_utils import load_wav
+    if os.path.exists('{}/cosyvoice2.yaml'.format(args.model_dir)):
+        cosyvoice = CosyVoice2(args.model_dir, fp16=args.fp16)
+    else:
+        cosyvoice = CosyVoice(args.model_dir, fp16=args.fp16)
+    model = cosyvoice.model
+    prompt_speech_16k = load_wav(args.prompt_wav, 16000)
+    model_input = cosyvoice.frontend.frontend_zero_shot(args.text, args.prompt_text, prompt_speech_16k, cosyvoice.sample_rate, '')
+    session = model.start_tts(**model_input)
+    session.job.join()
+    token = session.tokens()
+    print('{} speech tokens'.format(token.shape[1]))
+
+    num_nfe = [0]
+    if isinstance(model.flow.decoder.estimator, torch.nn.Module):
+        model.flow.decoder.estimator.register_forward_pre_hook(lambda *_: num_nfe.__setitem__(0, num_nfe[0] + 1))
+    default_solver = model.flow.decoder.solver
+    model.flow.decoder.solver = 'euler'
+    reference = token2mel(model, token, model_input, 10, args.seed)
+    mse = (token2mel(model, token, model_input, 10, args.seed).float() - reference.float()).pow(2).mean().item()
+    print('{:<14} n_timesteps {:3d}  sanity, reference run again       mel mse {:.6f}'.format('euler', 10, mse))
+    for solver in args.solvers:
+        model.flow.decoder.solver = solver
+        for n_timesteps in args.n_timesteps:
+            token2mel(model, token, model_input, n_timesteps, args.seed)
+            num_nfe[0] = 0
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+            start_time = time.time()
+            for _ in range(args.num_runs):
+                mel = token2mel(model, token, model_input, n_timesteps, args.seed)
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+            latency = (time.time() - start_time) / args.num_runs
+            mse = (mel.float() - reference.float()).pow(2).mean().item()
+            print('{:<14} n_timesteps {:3d}  nfe {:5.1f}  latency {:8.2f}ms  mel mse {:.6f}'.format(
+                solver, n_timesteps, num_nfe[0] / args.num_runs, latency * 1000, mse))
+    model.flow.decoder.solver = default_solver
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_dir', type=str, required=True)
+    parser.add_argument('--prompt_wav', type=str, default='asset/zero_shot_prompt.wav')
+    parser.add_argument('--prompt_text', type=str, default='希望你以后能够做的比我还好呦。')
+    parser.add_argument('--text', type=str, default='收到好友从远方寄来的生日礼物，那份意外的惊喜与深深的祝福让我心中充满了甜蜜的快乐，笑容如花儿般绽放。')
+    parser.add_argument('--fp16', action='store_true')
+    parser.add_argument('--solvers', type=str, nargs='+', default=list(ODE_SOLVERS.keys()), choices=list(ODE_SOLVERS.keys()))
+    parser.add_argument('--n_timesteps', type=int, nargs='+', default=[10, 5, 4, 3])
+    parser.add_argument('--num_runs', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=1986)
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Benchmark time to first audio (TTFB) of streaming tts.
+
+With --model_dir, run streaming zero shot inference and report TTFB and chunk gaps.
+Without --model_dir, compare the token handoff between llm and token2wav alone,
+the old 100ms sleep polling against the blocking TTSSession, using a fake llm
+which produces tokens at --token_rate.
+"""
+import os
+import sys
+import argparse
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+sys.path.append('{}/..'.format(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append('{}/../third_party/Matcha-TTS'.format(os.path.dirname(os.path.abspath(__file__))))
+from cosyvoice.cli.session import TTSSession
+
+
+def fake_llm(append, close, num_tokens, token_rate):
+    for i in range(num_tokens):
+        time.sleep(1 / token_rate)
+        append(i)
+    close()
+
+
+def polling_consumer(num_tokens, chunk_len, token_rate, poll_interval=0.1):
+    tokens, end, ready_time = [], [False], {}
+
+    def append(i):
+        tokens.append(i)
+        if len(tokens) % chunk_len == 0:
+            ready_time[len(tokens)] = time.time()
+
+    p = threading.Thread(target=fake_llm, args=(append, lambda: end.__setitem__(0, True), num_tokens, token_rate))
+    p.start()
+    latency, offset = [], 0
+    while True:
+        time.sleep(poll_interval)
+        if len(tokens) - offset >= chunk_len:
+            offset += chunk_len
+            latency.append(time.time() - ready_time[offset])
+        if end[0] is True and len(tokens) - offset < chunk_len:
+            break
+    p.join()
+    return latency
+
+
+def channel_consumer(num_tokens, chunk_len, token_rate):
+    channel, ready_time = TTSSession(''), {}
+
+    def append(i):
+        if (channel.num_token + 1) % chunk_len == 0:
+            ready_time[channel.num_token + 1] = time.time()
+        channel.append(i)
+
+    p = threading.Thread(target=fake_llm, args=(append, channel.close, num_tokens, token_rate))
+    p.start()
+    latency, offset = [], 0
+    while channel.wait(offset + chunk_len):
+        offset += chunk_len
+        latency.append(time.time() - ready_time[offset])
+    p.join()
+    return latency
+
+
+def report(name, values):
+    values = np.array(values) * 1000
+    print('{:<12} mean {:8.2f}ms  p50 {:8.2f}ms  p90 {:8.2f}ms  max {:8.2f}ms'.format(name, values.mean(), np.percentile(values, 50),
+                                                                                      np.percentile(values, 90), values.max()))
+
+
+def benchmark_handoff(args):
+    print('fake llm at {} token/s, chunk {} tokens, {} sessions'.format(args.token_rate, args.chunk_len, args.concurrency))
+    for name, consumer in [('polling', polling_consumer), ('channel', channel_consumer)]:
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            futures = [executor.submit(consumer, args.num_tokens, args.chunk_len, args.token_rate) for _ in range(args.concurrency)]
+            latency = [l for f in futures for l in f.result()]
+        report('{} first'.format(name), latency[::args.num_tokens // args.chunk_len])
+        report('{} all'.format(name), latency)
+
+
+def benchmark_model(args):
+    from cosyvoice.cli.cosyvoice import CosyVoice, CosyVoice2
+    from cosyvoice.utils.file_utils import load_wav
+    if os.path.exists('{}/cosyvoice2.yaml'.format(args.model_dir)):
+        cosyvoice = CosyVoice2(args.model_dir, fp16=args.fp16)
+    else:
+        cosyvoice = CosyVoice(args.model_dir, fp16=args.fp16)
+    prompt_speech_16k = load_wav(args.prompt_wav, 16000)
+
+    def single_job():
+        start_time, last_time, ttfb, gaps = time.time(), None, None, []
+        for _ in cosyvoice.inference_zero_shot(args.text, args.prompt_text, prompt_speech_16k, stream=True):
+            now = time.time()
+            if ttfb is None:
+                ttfb = now - start_time
+            else:
+                gaps.append(now - last_time)
+            last_time = now
+        return ttfb, gaps
+
+    # warmup
+    single_job()
+    ttfbs, gaps = [], []
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        for f in [executor.submit(single_job) for _ in range(args.num_runs)]:
+            ttfb, gap = f.result()
+            ttfbs.append(ttfb)
+            gaps.extend(gap)
+    report('ttfb', ttfbs)
+    if len(gaps) != 0:
+        report('chunk gap', gaps)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_dir', type=str, default='')
+    parser.add_argument('--prompt_wav', type=str, default='asset/zero_shot_prompt.wav')
+    parser.add_argument('--prompt_text', type=str, default='希望你以后能够做的比我还好呦。')
+    parser.add_argument('--text', type=str, default='收到好友从远方寄来的生日礼物，那份意外的惊喜与深深的祝福让我心中充满了甜蜜的快乐，笑容如花儿般绽放。')
+    parser.add_argument('--fp16', action='store_true')
+    parser.add_argument('--num_runs', type=int, default=10)
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--num_tokens', type=int, default=200)
+    parser.add_argument('--chunk_len', type=int, default=28)
+    parser.add_argument('--token_rate', type=float, default=100)
+    args = parser.parse_args()
+    if args.model_dir != '':
+        benchmark_model(args)
+    else:
+        benchmark_handoff(args)
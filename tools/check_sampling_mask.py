@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Check that sampling with masked ids draws the same distribution as the former rejection
+sampling, which drew again until the id was allowed, e.g. not eos before min_len.
+
+For every sampling function and case, num_samples ids are drawn both ways and the total variation
+distance of their histograms is compared against the distance of two rejection sampling runs,
+i.e. the sampling noise. Exits with an error when masking is off by more than --tolerance.
+"""
+import os
+import sys
+import argparse
+import torch
+sys.path.append('{}/..'.format(os.path.dirname(os.path.abspath(__file__))))
+from cosyvoice.utils.common import ras_sampling, random_sampling, TokenWindow
+
+
+def rejection_sampling(sampling, weighted_scores, window, mask, max_trials=100):
+    # the former sampling_ids, every row draws again until it gets an allowed id
+    top_ids = sampling(weighted_scores, window, 25)
+    for _ in range(max_trials):
+        retry = mask.gather(-1, top_ids)
+        if not retry.any():
+            return top_ids
+        top_ids = torch.where(retry, sampling(weighted_scores, window, 25), top_ids)
+    raise RuntimeError('sampling reaches max_trials {}'.format(max_trials))
+
+
+def histogram(ids, vocab_size):
+    return torch.bincount(ids.reshape(-1), minlength=vocab_size).float() / ids.numel()
+
+
+def make_case(name, args):
+    """ llm like scores of speech tokens, eos and two fill like tokens, and a window of decoded tokens """
+    speech_token_size = args.vocab_size - 3
+    scores = torch.randn(args.vocab_size) * 2
+    window = TokenWindow(args.num_samples, device=torch.device('cpu'))
+    mask = torch.zeros(args.vocab_size, dtype=torch.bool)
+    mask[speech_token_size] = True
+    mask[speech_token_size + 1:] = True
+    top = scores.topk(3).indices
+    if name == 'eos_likely':
+        # eos is in the nucleus, masking must keep the other nucleus ids in proportion
+        scores[speech_token_size] = scores.max() + 0.5
+    elif name == 'eos_and_repeat':
+        # the most likely speech token repeats, so ras_sampling falls back to random sampling
+        scores[speech_token_size] = scores.max() + 0.5
+        for _ in range(5):
+            window.append(top[0].item())
+    elif name == 'fill_allowed':
+        # bistream decoding, fill token is allowed and likely, eos is not
+        scores[speech_token_size + 2] = scores.max() + 1
+        mask[speech_token_size + 2] = False
+    return scores.log_softmax(dim=-1).expand(args.num_samples, -1), window, mask.expand(args.num_samples, -1)
+
+
+def main(args):
+    torch.manual_seed(args.seed)
+    samplings = {'ras_sampling': lambda scores, window, sampling, mask=None: ras_sampling(scores, window, sampling, top_p=args.top_p, top_k=args.top_k, mask=mask),
+                 'random_sampling': random_sampling}
+    failed = False
+    for case in ['eos_likely', 'eos_and_repeat', 'fill_allowed']:
+        scores, window, mask = make_case(case, args)
+        for name, sampling in samplings.items():
+            rejection = histogram(rejection_sampling(sampling, scores, window, mask), args.vocab_size)
+            noise = histogram(rejection_sampling(sampling, scores, window, mask), args.vocab_size)
+            masked_ids = sampling(scores, window, 25, mask=mask)
+            masked = histogram(masked_ids, args.vocab_size)
+            tv, noise_tv = (rejection - masked).abs().sum().item() / 2, (rejection - noise).abs().sum().item() / 2
+            leaked = mask[0][masked_ids.reshape(-1)].any().item()
+            ok = not leaked and tv <= noise_tv + args.tolerance
+            failed |= not ok
+            print('{:<15} {:<15} tv masked {:.4f}  tv rejection noise {:.4f}  masked id drawn {}  {}'.format(
+                case, name, tv, noise_tv, leaked, 'ok' if ok else 'MISMATCH'))
+    if failed:
+        sys.exit('masked sampling does not match rejection sampling')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--vocab_size', type=int, default=64, help='speech tokens plus eos and two fill like tokens')
+    parser.add_argument('--top_p', type=float, default=0.8)
+    parser.add_argument('--top_k', type=int, default=25)
+    parser.add_argument('--num_samples', type=int, default=50000)
+    parser.add_argument('--tolerance', type=float, default=0.015)
+    parser.add_argument('--seed', type=int, default=1986)
+    args = parser.parse_args()
+    main(args)